@@ -5,6 +5,7 @@ from tkinter import filedialog
 import re
 import os
 import sys
+import time
 from functools import partial
 
 # --- Dependency Check ---
@@ -25,6 +26,21 @@ except ImportError as e:
     print("pip install flet pandas openpyxl xlsxwriter")
     sys.exit(1)
 
+import numpy as np
+
+# Lógica compartida con la versión de consola
+from programGem import (save_report, parallel_groupby, resolve_client_identities, plan_execution,
+                        describe_plan, aggregate_in_chunks, validate_headers, split_by_source,
+                        source_labels, source_report_paths, save_reports_parallel, apply_discount,
+                        build_drilldown_index, save_drilldown_index, index_path_for, explain_client,
+                        control_totals, reconciliation_report, save_reconciliation, print_reconciliation,
+                        add_period_column, pivot_periods, PERIODS, PERIOD_COL, DATE_COL, REQUIRED_COLS,
+                        ReportView, find_workbooks, find_sheets, split_sheet_ref, inspect_workbook,
+                        describe_batch, read_workbooks, store_report, query_store, STORE_PATH, NUMERIC_FINAL_COLS,
+                        preview_report, spec_for, filter_rows,
+                        checkpoint_key, load_checkpoint, save_checkpoint, clear_checkpoints, CHECKPOINT_DIR,
+                        SOURCE_COL, ROW_FILE_COL, ROW_POS_COL, INDEX_SUFFIX, EXCEL_MAX_ROWS)
+
 # --- Funciones de Procesamiento de Datos (Síncronas) ---
 
 def clean_tipo_documento(tipo_doc_series):
@@ -32,11 +48,54 @@ def clean_tipo_documento(tipo_doc_series):
     # Asegura que la serie es de tipo string antes de aplicar regex
     return tipo_doc_series.astype(str).str.replace(r'^\d+\s*', '', regex=True)
 
-def process_data_internal_sync(df_combined, mode):
+def prepare_dataset(df):
+    """
+    Limpieza independiente del modo: conversión numérica, consolidación de nombres
+    y limpieza de TIPO_DE_DOCUMENTO. Modifica y devuelve df, marcándolo en
+    df.attrs['preparado'] para que process_data_internal_sync no la repita.
+    """
+    # Ensure numeric conversions happen early for relevant columns
+    for col_sum in ['UNIDADES', 'MontoBruto', 'Descuento', 'IVA']:
+        if col_sum in df.columns:
+             df[col_sum] = pd.to_numeric(df[col_sum], errors='coerce').fillna(0)
+    print("[Proceso Datos] Conversión a numérico aplicada.")
+
+    # 1. Consolidar nombres específicos y patrones (BEFORE grouping)
+    final_pattern_regex = r'(?i)(cliente|consumidor).*finall?'
+    specific_names_to_consolidate_upper = [
+        "CLIENTE CLIENTE".upper(),
+        "CLIENTE CONSUMIDOR CLIENTE CONSUMID CLIENTE CONSUMID".upper(),
+        "CLIENTE CONSUMIDOR CLIENTE CONSUMID CLIENTE CONSUMID CLIENTE CONSUMID".upper(),
+        "CLIENTE UNO".upper(),
+        "CLIENTES VARIOS CLIENTES VARIOS".upper(),
+        "CONSUMIDOR FINAL".upper()
+    ]
+
+    df['NOMBRECLIENTE'] = df['NOMBRECLIENTE'].astype(str)
+    mask_regex_match = df['NOMBRECLIENTE'].str.contains(final_pattern_regex, na=False)
+    mask_exact_match = df['NOMBRECLIENTE'].str.upper().isin(specific_names_to_consolidate_upper)
+    total_consolidation_mask = mask_regex_match | mask_exact_match
+    df.loc[total_consolidation_mask, 'NOMBRECLIENTE'] = 'CONSUMIDOR FINAL'
+    print("[Proceso Datos] Consolidación de nombres aplicada.")
+
+    # 2. Limpiar TIPO_DE_DOCUMENTO (BEFORE grouping)
+    df['TIPO_DE_DOCUMENTO_CLEANED'] = clean_tipo_documento(df['TIPO_DE_DOCUMENTO'])
+    print("[Proceso Datos] Limpieza de TIPO_DE_DOCUMENTO aplicada.")
+
+    df.attrs['preparado'] = True
+    return df
+
+def process_data_internal_sync(df_combined, mode, workers=1, resolve_identities=False, by_source=False,
+                               index_out=None, period=None):
     """
     Función interna SÍNCRONA que filtra, limpia, agrupa y agrega los datos.
     Opera sobre un DataFrame combinado.
     Aplica la lógica de split antes de agrupar si el modo es 'split'.
+    Con workers > 1 la agrupación se reparte en varios procesos (parallel_groupby).
+    Con resolve_identities unifica nombres duplicados de un mismo cliente antes de agrupar.
+    Con by_source agrupa además por SOURCE_COL (ver split_by_source).
+    Si index_out es un dict se llena con el índice de detalle cliente -> filas de origen.
+    Con period agrupa además por PERIOD_COL según DATE_COL (ver add_period_column).
     """
     print(f"[Proceso Datos] Iniciando procesamiento interno SÍNCRONO para '{mode}'...")
 
@@ -60,109 +119,61 @@ def process_data_internal_sync(df_combined, mode):
     df_filtered = pd.DataFrame()
 
     try:
+        # --- Mode-independent cleaning (skipped for a prepared workspace) ---
+        if not df_combined.attrs.get('preparado'):
+            df_combined = prepare_dataset(df_combined)
+
         # --- Mode-Specific Filtering ---
-        if mode == 'debito':
-            print("[Proceso Datos] Aplicando filtro: UNIDADES > 0")
-            df_filtered = df_combined[df_combined['UNIDADES'] > 0].copy()
-        elif mode == 'credito':
-            print("[Proceso Datos] Aplicando filtro: UNIDADES < 0")
-            df_filtered = df_combined[df_combined['UNIDADES'] < 0].copy()
-        elif mode == 'split':
-            print("[Proceso Datos] Procesando todos los registros.")
-            df_filtered = df_combined.copy()
-        else:
-            raise ValueError(f"[Proceso Datos] Modo de procesamiento interno inválido especificado: '{mode}'.")
+        # The mode's filters, measures and columns come from its compiled spec, the same one
+        # programGem.process_data runs, so the GUI and the console cannot drift apart.
+        # Copy-on-Write (enabled by programGem): filters are new frames and the shallow copy
+        # shares data until a column is written, so the workspace DataFrame is never modified
+        spec = spec_for(mode)
+        print(f"[Proceso Datos] Aplicando filtros de '{mode}': {spec['filters'] or 'ninguno'}")
+        df_filtered = filter_rows(df_combined, spec)
 
         if df_filtered.empty:
             print(f"[Proceso Datos] No se encontraron registros que coincidan con el filtro ({mode}).")
-            # Return an empty DataFrame with potential output columns based on mode
-            if mode in ['debito', 'credito']:
-                 empty_cols = ['NOMBRECLIENTE', 'IDENTIFICACION', 'TIPO DE DOCUMENTO',
-                                 'PRIMER_APELLIDO', 'SEGUNDO_APELLIDO', 'PRIMER_NOMBRE',
-                                 'OTROS_NOMBRES', 'MontoBruto', 'Descuento', 'Iva']
-            elif mode == 'split':
-                 empty_cols = ['NOMBRECLIENTE', 'IDENTIFICACION', 'TIPO DE DOCUMENTO',
-                                 'PRIMER_APELLIDO', 'SEGUNDO_APELLIDO', 'PRIMER_NOMBRE',
-                                 'OTROS_NOMBRES', 'MontoBruto Positivo', 'MontoBruto Negativo', 'Descuento', 'Iva']
-            else:
-                 empty_cols = [] # Should be caught by the ValueError above
-
-            return pd.DataFrame(columns=empty_cols)
+            # Return an empty DataFrame with the mode's output columns
+            return pd.DataFrame(columns=spec['columns'])
 
 
         print(f"[Proceso Datos] Filas encontradas para procesar después de filtrar ({mode}): {len(df_filtered)}")
 
-        # Ensure numeric conversions happen early for relevant columns
-        for col_sum in ['UNIDADES', 'MontoBruto', 'Descuento', 'IVA']:
-            if col_sum in df_filtered.columns:
-                 df_filtered[col_sum] = pd.to_numeric(df_filtered[col_sum], errors='coerce').fillna(0)
-        print("[Proceso Datos] Conversión a numérico aplicada.")
-
-
-        # --- Apply Split Logic *Before* Grouping (for split mode only) ---
-        # Initialize split columns for all modes to avoid KeyError during aggregation definition
-        df_filtered['MontoBruto Positivo_Temp'] = 0.0
-        df_filtered['MontoBruto Negativo_Temp'] = 0.0
-
-        if mode == 'split':
-            print("[Proceso Datos] Aplicando split de MontoBruto *antes* de agrupar para modo 'split'.")
-            # Populate the positive/negative columns based on ORIGINAL row MontoBruto
-            # Only do this if MontoBruto column actually exists
-            if 'MontoBruto' in df_filtered.columns:
-                df_filtered['MontoBruto Positivo_Temp'] = df_filtered['MontoBruto'].apply(lambda x: x if x > 0 else 0)
-                df_filtered['MontoBruto Negativo_Temp'] = df_filtered['MontoBruto'].apply(lambda x: x if x < 0 else 0)
-                # Drop the original MontoBruto column if it's not needed in final output for 'split'
-                # We need it for debito/credito, so drop conditionally after potential split logic
-                # df_filtered = df_filtered.drop(columns=['MontoBruto'], errors='ignore').copy() # Don't drop yet, handle in aggregation/selection
-            else:
-                 print("[Proceso Datos] Advertencia: Columna 'MontoBruto' no encontrada para aplicar split en modo 'split'.")
-
-
-        # 1. Consolidar nombres específicos y patrones (Apply AFTER filtering, BEFORE grouping)
-        final_pattern_regex = r'(?i)(cliente|consumidor).*finall?'
-        specific_names_to_consolidate_upper = [
-            "CLIENTE CLIENTE".upper(),
-            "CLIENTE CONSUMIDOR CLIENTE CONSUMID CLIENTE CONSUMID".upper(),
-            "CLIENTE CONSUMIDOR CLIENTE CONSUMID CLIENTE CONSUMID CLIENTE CONSUMID".upper(),
-            "CLIENTE UNO".upper(),
-            "CLIENTES VARIOS CLIENTES VARIOS".upper(),
-            "CONSUMIDOR FINAL".upper()
-        ]
-
-        df_filtered['NOMBRECLIENTE'] = df_filtered['NOMBRECLIENTE'].astype(str)
-        mask_regex_match = df_filtered['NOMBRECLIENTE'].str.contains(final_pattern_regex, na=False)
-        mask_exact_match = df_filtered['NOMBRECLIENTE'].str.upper().isin(specific_names_to_consolidate_upper)
-        total_consolidation_mask = mask_regex_match | mask_exact_match
-        df_filtered.loc[total_consolidation_mask, 'NOMBRECLIENTE'] = 'CONSUMIDOR FINAL'
-        print("[Proceso Datos] Consolidación de nombres aplicada.")
-
-        # 2. Limpiar TIPO_DE_DOCUMENTO (Apply AFTER filtering, BEFORE grouping)
-        df_filtered['TIPO_DE_DOCUMENTO_CLEANED'] = clean_tipo_documento(df_filtered['TIPO_DE_DOCUMENTO'])
-        print("[Proceso Datos] Limpieza de TIPO_DE_DOCUMENTO aplicada.")
-
-
-        # --- Aggregation Definition (Conditional based on mode) ---
-        group_keys = ['NOMBRECLIENTE', 'IDENTIFICACION'] # Group by name and ID for all modes
-
-        # Base aggregation dictionary for identity/name columns
-        agg_dict = {
-            'TIPO_DE_DOCUMENTO_CLEANED': 'first',
-            'PRIMER_APELLIDO': 'first',
-            'SEGUNDO_APELLIDO': 'first',
-            'PRIMER_NOMBRE': 'first',
-            'OTROS_NOMBRES': 'first',
-            'Descuento': 'sum',
-            'IVA': 'sum'
-        }
-
-        # Add MontoBruto aggregation based on mode
-        if mode == 'split':
-            # For split, sum the new temporary positive/negative columns
-            agg_dict['MontoBruto Positivo_Temp'] = 'sum'
-            agg_dict['MontoBruto Negativo_Temp'] = 'sum'
-        else: # 'debito' or 'credito' modes
-            # For other modes, sum the original MontoBruto
-            agg_dict['MontoBruto'] = 'sum'
+        # Writes to df_filtered copy only the touched columns, so the shared workspace keeps the original names
+        if resolve_identities:
+            df_filtered = resolve_client_identities(df_filtered)
+            print("[Proceso Datos] Resolución de identidades de clientes aplicada.")
+
+        # Group by name and ID for all modes (the spec's keys plus IDENTIFICACION)
+        client_keys = list(dict.fromkeys(spec['keys'] + ['IDENTIFICACION']))
+
+        if index_out is not None and ROW_POS_COL in df_filtered.columns:
+            index_out.update(build_drilldown_index(df_filtered, client_keys, spec['label_col'], spec['id_col']))
+            print("[Proceso Datos] Índice de detalle construido.")
+
+        if period:
+            add_period_column(df_filtered, period)
+            print(f"[Proceso Datos] Periodo '{period}' calculado desde '{DATE_COL}'.")
+
+        # --- Apply Split Logic *Before* Grouping (modes with signed amounts: split) ---
+        # The signed columns are only aggregated when the spec has them, so other modes don't allocate them
+        for out_col, (src_col, sign) in spec['by_sign'].items():
+            print(f"[Proceso Datos] Separando '{src_col}' por signo en '{out_col}' *antes* de agrupar.")
+            df_filtered[out_col] = df_filtered[src_col].clip(lower=0) if sign == '+' else df_filtered[src_col].clip(upper=0)
+
+
+        # --- Aggregation Definition (from the spec) ---
+        group_keys = client_keys
+        if period:
+            group_keys = [PERIOD_COL] + group_keys
+        if by_source:
+            group_keys = [SOURCE_COL] + group_keys
+
+        # prepare_dataset already cleaned TIPO_DE_DOCUMENTO into its own column
+        gui_sources = {'TIPO_DE_DOCUMENTO': 'TIPO_DE_DOCUMENTO_CLEANED'}
+        agg_dict = {gui_sources.get(col, col): agg_func for col, agg_func in spec['agg'].items()
+                    if col not in group_keys}
 
         print("[Proceso Datos] Agrupando por NOMBRECLIENTE e IDENTIFICACION...")
         # Ensure all columns in agg_dict and group_keys are actually in df_filtered before grouping
@@ -180,65 +191,50 @@ def process_data_internal_sync(df_combined, mode):
              return empty_df_with_error
 
 
-        df_grouped = df_filtered.groupby(valid_group_keys, as_index=False).agg(valid_agg_dict)
+        if workers > 1:
+            df_grouped = parallel_groupby(df_filtered, valid_group_keys, valid_agg_dict, workers=workers)
+        else:
+            df_grouped = df_filtered.groupby(valid_group_keys, as_index=False, observed=True).agg(valid_agg_dict)
         print(f"[Proceso Datos] Agrupación completada. Registros resultantes: {len(df_grouped)}")
 
         # --- Renaming ---
-        rename_map = {
-            'TIPO_DE_DOCUMENTO_CLEANED': 'TIPO DE DOCUMENTO',
-            'IVA': 'Iva',
-            'MontoBruto Positivo_Temp': 'MontoBruto Positivo', # Rename temp columns to final names
-            'MontoBruto Negativo_Temp': 'MontoBruto Negativo'
-        }
+        rename_map = {gui_sources.get(col, col): out_col for col, out_col in spec['rename'].items()}
         # Apply renaming, ignoring keys that are not in the grouped df columns
         df_grouped = df_grouped.rename(columns={k:v for k,v in rename_map.items() if k in df_grouped.columns})
         print("[Proceso Datos] Columnas renombradas.")
 
 
-        # --- Final Column Selection/Ordering (Conditional based on mode) ---
-        if mode in ['debito', 'credito']:
-             final_cols_order = [
-                 'TIPO DE DOCUMENTO', 'IDENTIFICACION', 'NOMBRECLIENTE', 'PRIMER_APELLIDO',
-                 'SEGUNDO_APELLIDO', 'PRIMER_NOMBRE', 'OTROS_NOMBRES', 'MontoBruto',
-                 'Descuento', 'Iva'
-             ]
-        elif mode == 'split':
-             final_cols_order = [
-                 'TIPO DE DOCUMENTO', 'IDENTIFICACION', 'NOMBRECLIENTE', 'PRIMER_APELLIDO',
-                 'SEGUNDO_APELLIDO', 'PRIMER_NOMBRE', 'OTROS_NOMBRES',
-                 'MontoBruto Positivo', 'MontoBruto Negativo', # Use the renamed columns
-                 'Descuento', 'Iva'
-             ]
-        else:
-             # Fallback, should not happen due to initial check
-             print(f"[Proceso Datos] Advertencia: Modo desconocido '{mode}' para definir columnas finales.")
-             final_cols_order = df_grouped.columns.tolist()
+        # --- Final Column Selection/Ordering (the spec's columns) ---
+        final_cols_order = list(spec['columns'])
+
+        if period and PERIOD_COL in df_grouped.columns:
+             final_cols_order = [PERIOD_COL] + final_cols_order
+        if by_source and SOURCE_COL in df_grouped.columns:
+             final_cols_order = [SOURCE_COL] + final_cols_order
 
         # Select and reorder, adding missing columns as NA
         final_df = pd.DataFrame() # Start with an empty df for safety
 
-        # Add columns that are in the order list and the grouped df
+        # Add columns that are in the order list and the grouped df (a lazy selection under Copy-on-Write)
         cols_to_select_present = [col for col in final_cols_order if col in df_grouped.columns]
-        final_df = df_grouped[cols_to_select_present].copy()
+        final_df = df_grouped[cols_to_select_present]
 
         # Add columns that are in the order list but NOT in the grouped df, filling with NA
         # This ensures the structure is correct even if some columns are missing (e.g., all debit/credit are 0)
         for col in final_cols_order:
              if col not in final_df.columns:
-                 # Decide what default value makes sense. NA is often good, 0 might be better for numeric columns.
-                 # Let's use 0 for the MontoBruto/Descuento/Iva columns if they were expected but missing after grouping.
-                 if col in ['MontoBruto', 'MontoBruto Positivo', 'MontoBruto Negativo', 'Descuento', 'Iva']:
+                 # The spec's amounts default to 0, every other column to NA
+                 if col in spec['measures']:
                       final_df[col] = 0.0
                  else:
                      final_df[col] = pd.NA
 
 
         # Ensure final order
-        final_df = final_df[final_cols_order].copy()
+        final_df = final_df[final_cols_order]
 
         # Ensure numeric columns have float type for consistency, even if they were added as 0
-        numeric_cols_final = ['MontoBruto', 'MontoBruto Positivo', 'MontoBruto Negativo', 'Descuento', 'Iva']
-        for col in numeric_cols_final:
+        for col in spec['measures']:
              if col in final_df.columns:
                   final_df[col] = pd.to_numeric(final_df[col], errors='coerce').fillna(0.0)
 
@@ -269,6 +265,54 @@ def process_data_internal_sync(df_combined, mode):
     print(f"[Proceso Datos] Procesamiento interno SÍNCRONO para '{mode}' finalizado exitosamente.")
     return final_df
 
+def chunk_processor(mode, resolve_identities=False, by_source=False, period=None):
+    """
+    Devuelve (process_chunk, keys) para agregar bloques o muestras con
+    process_data_internal_sync: la función que procesa un bloque y las claves
+    con que se combinan sus parciales (las de la GUI: cliente e identificación).
+    """
+    def process_chunk(chunk):
+        part = process_data_internal_sync(chunk, mode, resolve_identities=resolve_identities, by_source=by_source,
+                                          period=period)
+        if 'ProcessingError' in part.columns:
+            raise ValueError("Un bloque no pudo procesarse; verifique las columnas requeridas.")
+        return part
+
+    keys = ([SOURCE_COL] if by_source else []) + ([PERIOD_COL] if period else []) + ['NOMBRECLIENTE', 'IDENTIFICACION']
+    return process_chunk, keys
+
+def process_files_in_chunks(files, mode, plan, resolve_identities=False, by_source=False, controls_out=None,
+                            period=None):
+    """
+    Procesa los archivos por bloques (planes 'streaming' o 'disco') aplicando
+    process_data_internal_sync a cada bloque y combinando los parciales, sin
+    construir nunca el DataFrame combinado completo. controls_out (lista) recibe
+    los totales de control de cada bloque.
+    """
+    process_chunk, keys = chunk_processor(mode, resolve_identities, by_source, period)
+    return aggregate_in_chunks(files, mode, process_chunk, keys,
+                               spill=plan['strategy'] == 'disco', tag_source=by_source,
+                               controls_out=controls_out)
+
+# Columnas del reporte guardado por modo (las de process_data_internal_sync, en este orden)
+SAVE_COLUMNS = {mode: spec_for(mode)['columns'] for mode in ('debito', 'credito', 'split')}
+
+def frame_to_save(final_df, columns):
+    """
+    Reporte listo para guardar: las columnas indicadas en ese orden (las que
+    falten quedan vacías) y los montos numéricos, sin vacíos. La selección
+    comparte los datos de final_df (Copy-on-Write) y solo se reescriben los
+    montos que no son ya numéricos sin vacíos, así que final_df no cambia.
+    """
+    df_to_save = final_df.reindex(columns=columns)
+    if not final_df.empty:
+        for col in NUMERIC_FINAL_COLS:
+            if col in df_to_save.columns:
+                values = df_to_save[col]
+                if not pd.api.types.is_numeric_dtype(values) or values.hasnans:
+                    df_to_save[col] = pd.to_numeric(values, errors='coerce').fillna(0.0)
+    return df_to_save
+
 # --- Interfaz Gráfica (Flet Síncrona) ---
 # Resto del código de la interfaz gráfica (main, dialogs, handlers) permanece igual
 # porque ya maneja la posibilidad de que el DataFrame procesado tenga
@@ -277,8 +321,15 @@ def process_data_internal_sync(df_combined, mode):
 
 # Global state to pass info between dialog steps in synchronous flow
 processing_state = {}
+# Loaded and prepared dataset kept across report runs (survives processing_state.clear())
+workspace = {}
 license_dialog = None
 
+def files_signature(paths):
+    """Ruta (u hoja 'libro.xlsx[Hoja]'), tamaño y fecha de modificación de cada archivo, para detectar cambios."""
+    books = [split_sheet_ref(p)[0] for p in paths]
+    return tuple((p, os.path.getsize(b), os.path.getmtime(b)) for p, b in zip(paths, books))
+
 def open_license_dialog(e):
     """Abre el diálogo de licencia usando la página del evento."""
     dlg = license_dialog
@@ -404,147 +455,225 @@ def main(page: ft.Page):
 
     # --- Synchronous Step-by-Step Handlers ---
 
-    # Step 1: Start the process by asking for the number of files
+    # Step 1: Start the process by asking for the files
     def on_report_button_click(e, mode_type):
         print(f"[Flow] Botón de reporte '{mode_type}' clickeado")
         update_status(f"Preparando reporte de {mode_display_names.get(mode_type, 'Desconocido')}...", ft.colors.BLUE_ACCENT_700)
         disable_buttons()
         processing_state['mode'] = mode_type # Store mode for later steps
-        print('[Flow] Llamando a show_num_files_dialog')
-        show_num_files_dialog(page, mode_type)
-
-
-    # Step 2: Show dialog to ask for the number of files
-    def show_num_files_dialog(page, mode_type):
-        print('[Flow] show_num_files_dialog iniciado')
-        num_input = ft.TextField(
-            label="Número de archivos",
-            value="1",
-            keyboard_type=ft.KeyboardType.NUMBER,
-             # CORRECT InputFilter syntax based on previous errors and 0.27.6 indications
-            input_filter=ft.NumbersOnlyInputFilter(), # This form caused 'missing regex_string' earlier
-                                                  # If *this exact line* causes an error on 0.27.6,
-                                                  # the syntax might be `ft.InputFilter(True, r"[0-9]")`
-                                                  # or ft.InputFilter(allow="0123456789"), but based on the *last*
-                                                  # InputFilter error you reported, `ft.InputFilter(r"[0-9]")` was needed.
-            width=150
-        )
-        # Store num_input in state to access its value later
-        processing_state['num_input_control'] = num_input
+        if workspace.get('df') is not None:
+             print('[Flow] Hay archivos cargados en memoria. Llamando a show_reuse_workspace_dialog')
+             show_reuse_workspace_dialog(page)
+             return
+        print('[Flow] Llamando a show_file_source_dialog')
+        show_file_source_dialog(page)
 
+
+    # Step 1b: Offer to reuse the files already loaded in this session
+    def show_reuse_workspace_dialog(page):
+        print('[Flow] show_reuse_workspace_dialog iniciado')
+        files = workspace['files']
+        names = "\n".join(os.path.basename(f) for f in files[:5]) + ("\n..." if len(files) > 5 else "")
         dialog = ft.AlertDialog(
             modal=True,
-            title=ft.Text("Cantidad de Archivos"),
-            content=ft.Column([ft.Text("¿Cuántos archivos desea procesar?"), num_input], tight=True, spacing=15),
+            title=ft.Text("Archivos Cargados"),
+            content=ft.Text(f"Ya hay {len(files)} archivo(s) cargados ({len(workspace['df'])} filas):\n{names}\n\n¿Desea reutilizarlos?"),
             actions=[
-                # Partial is used to pass arguments to the handler function
-                ft.TextButton("Cancelar", on_click=lambda e: handle_num_files_response(page, e, True)),
-                ft.TextButton("Aceptar",  on_click=lambda e: handle_num_files_response(page, e, False)),
+                ft.TextButton("Cargar otros", on_click=lambda e: handle_reuse_workspace_response(page, e, False)),
+                ft.TextButton("Reutilizar", on_click=lambda e: handle_reuse_workspace_response(page, e, True)),
             ],
             actions_alignment=ft.MainAxisAlignment.END,
-            # on_dismiss fires if the user clicks outside the modal area
         )
-        print('[Flow] Diálogo de cantidad de archivos creado. Mostrando...')
-        page.dialog = dialog # Assign the dialog
-        page.open(dialog)    # Tell Flet to open it
-        page.update()         # Request UI update to show the dialog
-        print('[Flow] Llamada a page.update() después de abrir diálogo.')
-
-
-    # Step 3: Handle the response from the number of files dialog
-    def handle_num_files_response(page,e, canceled):
-        print('[Flow] handle_num_files_response iniciado')
-        # Check if dialog is the one we expect before closing
-        if page.dialog and isinstance(page.dialog.content, ft.Column) and isinstance(page.dialog.content.controls[1], ft.TextField) and page.dialog.content.controls[1] == processing_state.get('num_input_control'):
-             close_dialog(page.dialog) # Close the dialog first
-        else:
-             print("[Flow] Advertencia: Dialogo inesperado cerrado.")
-             close_dialog(page.dialog) # Close anyway to clear it
+        page.dialog = dialog
+        page.open(dialog)
+        page.update()
 
 
-        if canceled:
-            print('[Flow] Selección de número de archivos cancelada.')
-            update_status(f"Selección de archivo cancelada.", ft.colors.RED_ACCENT_700)
-            enable_buttons()
-            processing_state.clear() # Clean up state
-            return
+    def handle_reuse_workspace_response(page, e, reuse):
+        print(f'[Flow] handle_reuse_workspace_response iniciado. Reutilizar: {reuse}')
+        close_dialog(page.dialog)
+        mode_type = processing_state['mode']
 
-        num_input_control = processing_state.get('num_input_control')
-        if not num_input_control:
-             print("[Flow] Error: Control de número de archivos no encontrado en estado.")
-             update_status("Error interno: Control de número de archivos no encontrado.", ft.colors.RED_ACCENT_700)
-             enable_buttons()
-             processing_state.clear()
+        if not reuse:
+             workspace.clear()
+             show_file_source_dialog(page)
              return
 
-        raw_num = num_input_control.value
-        print(f"[Flow] Valor ingresado para número de archivos: '{raw_num}'")
         try:
-            num_files = int(raw_num)
-            if num_files <= 0:
-                print(f"[Flow] Error: Número de archivos '{num_files}' no es positivo.")
-                update_status("Error: El número de archivos debe ser un entero positivo.", ft.colors.RED_ACCENT_700)
-                enable_buttons()
-                processing_state.clear()
-                return
-        except ValueError:
-            print(f"[Flow] Error: Valor ingresado '{raw_num}' no es un número entero.")
-            update_status("Error: Entrada inválida para el número de archivos. Por favor, ingrese un número entero.", ft.colors.RED_ACCENT_700)
-            enable_buttons()
-            processing_state.clear()
-            return
+             changed = files_signature(workspace['files']) != workspace['signature']
+        except OSError:
+             changed = True
+        if changed:
+             print("[Flow] Los archivos cargados cambiaron en disco. Se volverán a leer.")
+             update_status("Los archivos cambiaron desde la última carga; se volverán a leer...", ft.colors.BLUE_ACCENT_700)
+             processing_state['selected_files_list'] = list(workspace['files'])
+             workspace.clear()
+             combine_and_process_files(page)
+             return
 
-        print(f"[Flow] Número de archivos validado: {num_files}. Iniciando secuencia de selección.")
-        processing_state['num_files_total'] = num_files
-        processing_state['selected_files_list'] = []
-        # Start the file selection sequence with the first file (index 0)
-        select_file_sequence(page, 0)
+        processing_state['controls'] = workspace.get('controls', [])
+        # processing_state was cleared after the last run: the report metadata needs the file list again
+        processing_state['selected_files_list'] = list(workspace['files'])
+        print(f"[Flow] Reutilizando {len(workspace['files'])} archivo(s) cargados. Llamando a process_combined_data")
+        process_combined_data(page, workspace['df'])
 
 
-    # Step 4: Sequence for selecting multiple files
-    def select_file_sequence(page, file_index):
-        num_files_total = processing_state['num_files_total']
+    # Step 2: Ask where the files come from (several files at once or a whole folder)
+    def show_file_source_dialog(page):
+        print('[Flow] show_file_source_dialog iniciado')
+        dialog = ft.AlertDialog(
+            modal=True,
+            title=ft.Text("Seleccionar Archivos"),
+            content=ft.Text("Puede elegir varios archivos .xlsx a la vez o una carpeta completa\n(se incluyen sus subcarpetas)."),
+            actions=[
+                ft.TextButton("Cancelar", on_click=lambda e: handle_file_source_response(page, e, None)),
+                ft.TextButton("Carpeta", on_click=lambda e: handle_file_source_response(page, e, 'carpeta')),
+                ft.TextButton("Archivos", on_click=lambda e: handle_file_source_response(page, e, 'archivos')),
+            ],
+            actions_alignment=ft.MainAxisAlignment.END,
+        )
+        page.dialog = dialog
+        page.open(dialog)
+        page.update()
+
+
+    # Step 3: Run the file or folder dialog and collect the workbooks
+    def handle_file_source_response(page, e, source):
+        print(f'[Flow] handle_file_source_response iniciado. Origen: {source}')
+        close_dialog(page.dialog)
         mode_type = processing_state['mode']
         mode_display_name = mode_display_names.get(mode_type, 'Desconocido')
 
-        print(f"[Flow] Iniciando selección de archivo {file_index+1} de {num_files_total}")
-        update_status(f"Seleccionando archivo {file_index+1} de {num_files_total} para reporte de {mode_display_name}...", ft.colors.BLUE_ACCENT_700)
+        if source is None:
+            print('[Flow] Selección de archivos cancelada.')
+            update_status("Selección de archivo cancelada.", ft.colors.RED_ACCENT_700)
+            enable_buttons()
+            processing_state.clear()
+            return
 
-        # This filedialog call WILL block the UI until user selects a file or cancels
-        print("[Flow] Llamando a filedialog.askopenfilename (esto bloqueará la UI)")
-        input_file = filedialog.askopenfilename(
-             title=f"Seleccionar Archivo {file_index+1} de {num_files_total} ({mode_display_name})",
-             filetypes=[("Excel files", "*.xlsx")],
-             parent=root
-        )
-        print(f"[Flow] filedialog.askopenfilename retornó: {input_file}")
+        # These filedialog calls WILL block the UI until the user picks or cancels
+        if source == 'carpeta':
+            folder = filedialog.askdirectory(title=f"Seleccionar Carpeta con Archivos ({mode_display_name})", parent=root)
+            print(f"[Flow] filedialog.askdirectory retornó: {folder}")
+            files = find_workbooks(folder) if folder else []
+            if folder and not files:
+                update_status(f"No se encontraron archivos .xlsx en:\n{folder}", ft.colors.RED_ACCENT_700)
+                enable_buttons()
+                processing_state.clear()
+                return
+        else:
+            files = [f for f in filedialog.askopenfilenames(
+                title=f"Seleccionar Archivos ({mode_display_name})",
+                filetypes=[("Excel files", "*.xlsx")],
+                parent=root
+            )]
+            print(f"[Flow] filedialog.askopenfilenames retornó {len(files)} archivo(s)")
+            not_xlsx = [os.path.basename(f) for f in files if not f.lower().endswith('.xlsx')]
+            if not_xlsx:
+                update_status(f"Error: Estos archivos no son .xlsx válidos: {', '.join(not_xlsx)}. Proceso detenido.", ft.colors.RED_ACCENT_700)
+                enable_buttons()
+                processing_state.clear()
+                return
 
-        if not input_file:
-            print(f"[Flow] Selección de archivo {file_index+1} cancelada por el usuario.")
-            update_status(f"Selección de archivo {file_index+1} cancelada. Proceso detenido.", ft.colors.RED_ACCENT_700)
+        if not files:
+            print('[Flow] No se seleccionaron archivos.')
+            update_status("Selección de archivo cancelada. Proceso detenido.", ft.colors.RED_ACCENT_700)
             enable_buttons()
             processing_state.clear()
             return
 
-        if not input_file.lower().endswith('.xlsx'):
-            print(f"[Flow] Error: Archivo seleccionado '{os.path.basename(input_file)}' no es XLSX.")
-            update_status(f"Error: El archivo seleccionado '{os.path.basename(input_file)}' no es un archivo .xlsx válido. Proceso detenido.", ft.colors.RED_ACCENT_700)
+        # Every sheet with the required headers becomes its own unit of work ('libro.xlsx[Hoja]')
+        if chk_all_sheets.value:
+            period = dd_period.value if dd_period.value in PERIODS else None
+            files, skipped = find_sheets(files, required=REQUIRED_COLS + ([DATE_COL] if period else []))
+            for ref, msg in skipped.items():
+                print(f"[Flow] Hoja omitida '{os.path.basename(ref)}': {msg}")
+            if not files:
+                update_status("Ninguna hoja de los archivos seleccionados tiene las columnas requeridas.", ft.colors.RED_ACCENT_700)
+                enable_buttons()
+                processing_state.clear()
+                return
+            print(f"[Flow] {len(files)} hoja(s) a procesar, {len(skipped)} omitida(s).")
+
+        processing_state['selected_files_list'] = files
+        show_run_summary_dialog(page, files)
+
+
+    # Step 4: Pre-run summary (size, rows and estimated read time) before reading anything
+    def show_run_summary_dialog(page, files):
+        print('[Flow] show_run_summary_dialog iniciado')
+        workers = os.cpu_count() or 1
+        books, unreadable = [], []
+        for f in files:
+            try:
+                books.append(inspect_workbook(f))
+            except Exception as ex:
+                # Header validation reports these properly in the next step
+                print(f"[Flow] No se pudo inspeccionar '{os.path.basename(f)}': {ex}")
+                unreadable.append(f)
+        processing_state['books'] = books if not unreadable else None
+        summary = describe_batch([b['path'] for b in books], books, workers) if books else "Sin datos de tamaño."
+        largest = sorted(books, key=lambda b: -b['rows'] * b['cols'])[:5]
+        lines = "\n".join(f"  {os.path.basename(b['path'])}: ~{b['rows']:,} filas" for b in largest)
+        extra = f"\n{len(unreadable)} archivo(s) no se pudieron inspeccionar." if unreadable else ""
+        print(f"[Flow] {summary}")
+        dialog = ft.AlertDialog(
+            modal=True,
+            title=ft.Text("Resumen de la Corrida"),
+            content=ft.Text(f"{summary}\n\nMás grandes (se leen primero):\n{lines}{extra}"),
+            actions=[
+                ft.TextButton("Cancelar", on_click=lambda e: handle_run_summary_response(page, e, False)),
+                ft.TextButton("Muestra rápida", on_click=lambda e: show_sample_preview(page)),
+                ft.TextButton("Procesar", on_click=lambda e: handle_run_summary_response(page, e, True)),
+            ],
+            actions_alignment=ft.MainAxisAlignment.END,
+        )
+        page.dialog = dialog
+        page.open(dialog)
+        page.update()
+
+
+    def handle_run_summary_response(page, e, proceed):
+        print(f'[Flow] handle_run_summary_response iniciado. Procesar: {proceed}')
+        close_dialog(page.dialog)
+        if not proceed:
+            update_status("Proceso cancelado.", ft.colors.RED_ACCENT_700)
             enable_buttons()
             processing_state.clear()
             return
+        combine_and_process_files(page)
 
-        print(f"[Flow] Archivo {file_index+1} seleccionado y validado: {input_file}")
-        processing_state['selected_files_list'].append(input_file)
 
-        # Check if more files need to be selected
-        if file_index + 1 < num_files_total:
-             print(f"[Flow] Quedan {num_files_total - (file_index + 1)} archivos por seleccionar. Continuando...")
-             # Continue to the next file
-             select_file_sequence(page, file_index + 1)
-        else:
-             print("[Flow] Todos los archivos seleccionados. Combinando y procesando.")
-             # All files selected, proceed to combining and processing
-             combine_and_process_files(page)
+    # Optional: approximate report from a stratified sample of each workbook, before the full read
+    def show_sample_preview(page):
+        print('[Flow] show_sample_preview iniciado')
+        close_dialog(page.dialog)
+        files = processing_state['selected_files_list']
+        mode_type = processing_state['mode']
+        period = dd_period.value if dd_period.value in PERIODS else None
+        update_status(f"Leyendo una muestra de {len(files)} archivo(s)...", ft.colors.BLUE_ACCENT_700)
+        try:
+            t0 = time.perf_counter()
+            # Same processing and grouping keys as the full run (process_data_internal_sync), per file if requested
+            process_chunk, keys = chunk_processor(mode_type, chk_identities.value, chk_by_source.value, period)
+            preview, strata = preview_report(files, mode_type, workers=os.cpu_count() or 1, by_source=chk_by_source.value,
+                                             process_chunk=process_chunk, keys=keys)
+            elapsed = time.perf_counter() - t0
+        except Exception as ex:
+            print(f"[Flow] Error al generar la muestra: {ex}")
+            update_status(f"No se pudo generar la muestra:\n{ex}", ft.colors.RED_ACCENT_700)
+            enable_buttons()
+            processing_state.clear()
+            return
+        totals = ", ".join(f"{c}: {preview[c].sum():,.2f}" for c in NUMERIC_FINAL_COLS if c in preview.columns)
+        note = (f"Aproximado: {strata['FILAS MUESTRA'].sum():,} de ~{strata['FILAS ESTIMADAS'].sum():,} filas leídas "
+                f"en {elapsed:.1f} s; montos escalados a las filas estimadas de cada archivo, sin restar descuento"
+                f"{'; una fila por archivo y cliente' if chk_by_source.value else ''}.\n"
+                f"Totales estimados: {totals}")
+        print(f"[Flow] {note}")
+        update_status("Muestra lista. Revise el resultado aproximado.", ft.colors.BLUE_ACCENT_700)
+        show_preview_dialog(page, preview, title="Muestra Rápida (resultado aproximado)", note=note,
+                            next_step=lambda: combine_and_process_files(page))
 
 
     # Step 5: Combine and process the selected files
@@ -554,19 +683,76 @@ def main(page: ft.Page):
         mode_type = processing_state['mode']
         mode_display_name = mode_display_names.get(mode_type, 'Desconocido')
 
-        update_status(f"Leyendo y combinando {len(selected_files)} archivo(s)...", ft.colors.BLUE_ACCENT_700)
+        # Header-only validation of every file before the expensive read
+        update_status(f"Validando encabezados de {len(selected_files)} archivo(s)...", ft.colors.BLUE_ACCENT_700)
+        period = dd_period.value if dd_period.value in PERIODS else None
+        problems = validate_headers(selected_files, required=REQUIRED_COLS + ([DATE_COL] if period else []))
+        if problems:
+            details = "\n".join(f"{os.path.basename(f)}: {msg}" for f, msg in problems.items())
+            print(f"[Flow] Validación de encabezados fallida:\n{details}")
+            update_status(f"Archivos con problemas (no se procesó nada):\n{details}", ft.colors.RED_ACCENT_700)
+            enable_buttons()
+            processing_state.clear()
+            return
+
+        # Estimate size from workbook metadata before reading (DOCUFLOW_PLAN forces a strategy)
+        try:
+            plan = plan_execution(selected_files, os.environ.get('DOCUFLOW_PLAN'))
+            plan_msg = describe_plan(plan)
+        except Exception as e:
+            print(f"[Flow] No se pudo planificar la ejecución, se usará memoria: {e}")
+            plan, plan_msg = None, ""
+        print(f"[Flow] {plan_msg}")
+        processing_state['plan'] = plan
+
+        if plan and plan['strategy'] != 'memoria':
+            update_status(f"Procesando {len(selected_files)} archivo(s) por bloques...\n{plan_msg}", ft.colors.BLUE_ACCENT_700)
+            workspace.clear() # Too large to keep in memory between reports
+            process_combined_data(page, None)
+            return
+
+        update_status(f"Leyendo y combinando {len(selected_files)} archivo(s)...\n{plan_msg}", ft.colors.BLUE_ACCENT_700)
         print(f"[Flow] Leyendo {len(selected_files)} archivos...")
 
         dataframes_list = []
+        labels = source_labels(selected_files)
+        processing_state['checkpoints'] = []
+        processing_state['controls'] = []
         try:
-            for i, file_path in enumerate(selected_files):
-                 print(f"[Flow] Leyendo archivo {i+1}/{len(selected_files)}: {os.path.basename(file_path)}")
-                 update_status(f"Leyendo archivo {i+1} de {len(selected_files)}:\n{os.path.basename(file_path)}...", ft.colors.BLUE_ACCENT_700)
-                 # This read_excel call can block
-                 df_single = pd.read_excel(file_path, engine='openpyxl')
+            # Parsed files are checkpointed so an interrupted batch does not re-read them
+            keys = [checkpoint_key(f, 'filas') if chk_checkpoints.value else None for f in selected_files]
+            frames = [load_checkpoint(CHECKPOINT_DIR, ck) if ck else None for ck in keys]
+            for file_path, df_single in zip(selected_files, frames):
+                 if df_single is not None:
+                      print(f"[Flow] '{os.path.basename(file_path)}' recuperado de un punto de control.")
+            pending = [i for i, df_single in enumerate(frames) if df_single is None]
+
+            def on_read(j, df_single, done, total):
+                 i = pending[j]
+                 frames[i] = df_single
+                 if keys[i]:
+                      save_checkpoint(CHECKPOINT_DIR, keys[i], df_single)
+                 print(f"[Flow] Archivo leído {done}/{total}: {os.path.basename(selected_files[i])}")
+                 update_status(f"Leídos {done} de {total} archivo(s):\n{os.path.basename(selected_files[i])}", ft.colors.BLUE_ACCENT_700)
+
+            # Remaining files are read in a process pool, largest first (read_workbooks keeps the input order)
+            books = processing_state.get('books')
+            read_workbooks([selected_files[i] for i in pending], workers=os.cpu_count() or 1,
+                           books=[books[i] for i in pending] if books else None, on_done=on_read)
+
+            for i, (file_path, df_single) in enumerate(zip(selected_files, frames)):
+                 if keys[i]:
+                      processing_state['checkpoints'].append(keys[i])
                  if df_single.empty:
                       print(f"[Flow] Advertencia: Archivo '{os.path.basename(file_path)}' está vacío. Se omitirá.")
                       continue
+                 # Control totals of the raw rows, reconciled against the report when saving
+                 processing_state['controls'].append(control_totals(df_single, labels[i]))
+                 # Source tag for per-file reports (categorical, so it costs one byte per row)
+                 df_single[SOURCE_COL] = pd.Categorical([labels[i]] * len(df_single), categories=labels)
+                 # Row provenance for the drill-down index (blank rows are dropped on read, the index keeps the Excel position)
+                 df_single[ROW_FILE_COL] = np.int32(i)
+                 df_single[ROW_POS_COL] = df_single.index.to_numpy(np.int64) + 2
                  dataframes_list.append(df_single)
 
             if not dataframes_list:
@@ -598,6 +784,17 @@ def main(page: ft.Page):
             processing_state.clear()
             return
 
+        # Mode-independent cleaning happens once; later reports reuse the workspace
+        update_status(f"Preparando {len(combined_df)} filas...", ft.colors.BLUE_ACCENT_700)
+        try:
+            combined_df = prepare_dataset(combined_df)
+            workspace.update(files=list(selected_files), signature=files_signature(selected_files), df=combined_df,
+                             controls=processing_state['controls'])
+        except Exception as e:
+            # Missing columns etc. are reported by process_data_internal_sync
+            print(f"[Flow] No se pudo preparar el espacio de trabajo: {e}")
+            workspace.clear()
+
         # Proceed to internal data processing
         print("[Flow] Llamando a process_combined_data")
         process_combined_data(page, combined_df)
@@ -612,11 +809,47 @@ def main(page: ft.Page):
         update_status(f"Procesando datos combinados para reporte de {mode_display_name}...", ft.colors.BLUE_ACCENT_700)
         print(f"[Flow] Llamando a process_data_internal_sync para modo '{mode_type}'. Esto puede bloquear.")
 
+        period = dd_period.value if dd_period.value in PERIODS else None
+        if period and combined_df is not None and DATE_COL not in combined_df.columns:
+             print(f"[Flow] Falta la columna de fecha '{DATE_COL}' para agrupar por periodo.")
+             update_status(f"Error: los archivos no tienen la columna de fecha '{DATE_COL}' necesaria para agrupar por periodo.", ft.colors.RED_ACCENT_700)
+             enable_buttons()
+             processing_state.clear()
+             return
+        processing_state['period'] = period
+
         try:
             # This call contains the heavy Pandas processing and can block
-            processed_df = process_data_internal_sync(combined_df.copy(), mode_type)
+            # parallel_groupby vuelve a un solo proceso si hay pocas filas
+            processing_state['index'] = None
+            processing_state['source_files'] = processing_state.get('selected_files_list') or workspace.get('files') or []
+            if combined_df is None:
+                 # Streaming / disk plan: aggregate block by block from the files
+                 processing_state['controls'] = []
+                 processed_df = process_files_in_chunks(processing_state['selected_files_list'], mode_type,
+                                                        processing_state['plan'], resolve_identities=chk_identities.value,
+                                                        by_source=chk_by_source.value,
+                                                        controls_out=processing_state['controls'], period=period)
+            else:
+                 processing_state['index'] = {} if chk_index.value else None
+                 # No defensive copy: processing never writes to the (prepared) workspace frame.
+                 # Single process by default: starting a pool costs more than a workspace rerun takes
+                 workers = (os.cpu_count() or 1) if chk_parallel.value else 1
+                 processed_df = process_data_internal_sync(combined_df, mode_type, workers=workers,
+                                                           resolve_identities=chk_identities.value,
+                                                           by_source=chk_by_source.value,
+                                                           index_out=processing_state['index'], period=period)
+
+            # Consolidated report + one per source file, from the same (source, client) aggregation
+            processing_state['per_source'] = {}
+            if chk_by_source.value and SOURCE_COL in processed_df.columns:
+                 processed_df, processing_state['per_source'] = split_by_source(
+                     processed_df, mode_type, keys=([PERIOD_COL] if period else []) + ['NOMBRECLIENTE', 'IDENTIFICACION'])
+                 print(f"[Flow] Reportes por archivo: {list(processing_state['per_source'])}")
 
             processing_state['processed_df'] = processed_df # Store the result
+            # The run got through processing: its checkpoints are no longer needed
+            clear_checkpoints(CHECKPOINT_DIR, processing_state.get('checkpoints', []))
             print(f"[Flow] process_data_internal_sync finalizado. processed_df es vacío: {processed_df.empty}")
 
 
@@ -644,8 +877,12 @@ def main(page: ft.Page):
                  print("[Flow] processed_df contiene datos. Procediendo a preguntar sobre descuento.")
                  # The split logic is now inside process_data_internal_sync *before* grouping for 'split' mode.
                  # So we just need to ask about discount and then save.
-                 print("[Flow] Llamando a show_subtract_discount_dialog")
-                 show_subtract_discount_dialog(page)
+                 if chk_preview.value:
+                      print("[Flow] Llamando a show_preview_dialog")
+                      show_preview_dialog(page, processed_df)
+                 else:
+                      print("[Flow] Llamando a show_subtract_discount_dialog")
+                      show_subtract_discount_dialog(page)
 
 
         except ValueError as ve: # Catch ValueErrors specifically from process_data_internal_sync
@@ -662,6 +899,93 @@ def main(page: ft.Page):
             processing_state.clear()
 
 
+    # Step 6b: Paged preview of the result; only the visible page is turned into controls
+    def show_preview_dialog(page, processed_df, title="Vista Previa del Resultado", note=None, next_step=None):
+        print(f'[Flow] show_preview_dialog iniciado ({len(processed_df)} filas)')
+        view = ReportView(processed_df, page_size=50)
+        columns = list(processed_df.columns)
+        # Only amounts get thousands separators and decimals (also 'MontoBruto 2024-01' in the wide period format); IDs stay as-is
+        numeric = {c for c in columns if (c in NUMERIC_FINAL_COLS or str(c).rsplit(' ', 1)[0] in NUMERIC_FINAL_COLS)
+                   and pd.api.types.is_numeric_dtype(processed_df[c])}
+        current = {'page': 0}
+
+        page_label = ft.Text("")
+        search_input = ft.TextField(label="Buscar NOMBRECLIENTE o IDENTIFICACION", width=380)
+        table = ft.DataTable(
+            columns=[ft.DataColumn(ft.Text(str(c)), numeric=c in numeric,
+                                   on_sort=lambda e: on_sort(e.column_index, e.ascending))
+                     for c in columns],
+            rows=[],
+            column_spacing=20,
+        )
+
+        def render():
+            rows = view.page(current['page'])
+            table.rows = [
+                ft.DataRow(cells=[ft.DataCell(ft.Text(f"{v:,.2f}" if c in numeric and pd.notna(v) else ("" if pd.isna(v) else str(v))))
+                                  for c, v in zip(columns, r)])
+                for r in rows.itertuples(index=False)
+            ]
+            page_label.value = f"Página {current['page'] + 1} de {view.pages} — {len(view):,} de {len(processed_df):,} filas"
+            page.update()
+
+        def on_sort(column_index, ascending):
+            view.sort(columns[column_index], descending=not ascending)
+            table.sort_column_index, table.sort_ascending = column_index, ascending
+            current['page'] = 0
+            render()
+
+        def on_search(e):
+            view.search(search_input.value)
+            current['page'] = 0
+            render()
+
+        def go(delta):
+            current['page'] = min(max(current['page'] + delta, 0), view.pages - 1)
+            render()
+
+        def on_continue(e):
+            close_dialog(page.dialog)
+            if next_step:
+                 print("[Flow] Vista previa cerrada. Continuando con la corrida completa")
+                 next_step()
+                 return
+            print("[Flow] Vista previa cerrada. Llamando a show_subtract_discount_dialog")
+            show_subtract_discount_dialog(page)
+
+        def on_cancel(e):
+            close_dialog(page.dialog)
+            print("[Flow] Proceso cancelado desde la vista previa.")
+            update_status("Proceso cancelado desde la vista previa.", ft.colors.RED_ACCENT_700)
+            enable_buttons()
+            processing_state.clear()
+
+        search_input.on_submit = on_search
+        dialog = ft.AlertDialog(
+            modal=True,
+            title=ft.Text(title),
+            content=ft.Column(([ft.Text(note, size=12)] if note else []) + [
+                ft.Row([search_input, ft.ElevatedButton("Buscar", on_click=on_search)]),
+                ft.Column([ft.Row([table], scroll=ft.ScrollMode.AUTO)], scroll=ft.ScrollMode.AUTO, height=420, width=900),
+                ft.Row([
+                    ft.IconButton(icon=ft.icons.FIRST_PAGE, on_click=lambda e: go(-view.pages)),
+                    ft.IconButton(icon=ft.icons.CHEVRON_LEFT, on_click=lambda e: go(-1)),
+                    page_label,
+                    ft.IconButton(icon=ft.icons.CHEVRON_RIGHT, on_click=lambda e: go(1)),
+                    ft.IconButton(icon=ft.icons.LAST_PAGE, on_click=lambda e: go(view.pages)),
+                ], alignment=ft.MainAxisAlignment.CENTER),
+            ], tight=True),
+            actions=[
+                ft.TextButton("Cancelar", on_click=on_cancel),
+                ft.TextButton("Continuar", on_click=on_continue),
+            ],
+            actions_alignment=ft.MainAxisAlignment.END,
+        )
+        page.dialog = dialog
+        page.open(dialog)
+        render()
+
+
     # Step 7: Show dialog asking about subtracting discount
     def show_subtract_discount_dialog(page):
          print('[Flow] show_subtract_discount_dialog iniciado')
@@ -704,6 +1028,7 @@ def main(page: ft.Page):
 
         processed_df = processing_state.get('processed_df')
         mode_type = processing_state.get('mode')
+        processing_state['subtract'] = subtract
 
         if processed_df is None or mode_type is None:
              print("[Flow] Error interno: processed_df o mode_type no disponibles en estado.")
@@ -754,6 +1079,12 @@ def main(page: ft.Page):
         else:
              print("[Flow] No se aplicará la resta de Descuento (usuario seleccionó No).")
 
+        # Same treatment for the per-source reports
+        for source_df in processing_state.get('per_source', {}).values():
+             source_df['Descuento'] = pd.to_numeric(source_df['Descuento'], errors='coerce').fillna(0).abs()
+             if subtract is True:
+                  apply_discount(source_df, mode_type)
+
 
         # Proceed to saving the results
         print("[Flow] Llamando a save_results")
@@ -776,24 +1107,27 @@ def main(page: ft.Page):
             return # Stop here if it's a fatal processing error structure
 
         # Define expected final columns based on mode BEFORE saving
-        if mode_type in ['debito', 'credito']:
-             expected_final_columns = [
-                 'TIPO DE DOCUMENTO', 'IDENTIFICACION', 'NOMBRECLIENTE', 'PRIMER_APELLIDO',
-                 'SEGUNDO_APELLIDO', 'PRIMER_NOMBRE', 'OTROS_NOMBRES', 'MontoBruto',
-                 'Descuento', 'Iva'
-             ]
-        elif mode_type == 'split':
-             expected_final_columns = [
-                 'TIPO DE DOCUMENTO', 'IDENTIFICACION', 'NOMBRECLIENTE', 'PRIMER_APELLIDO',
-                 'SEGUNDO_APELLIDO', 'PRIMER_NOMBRE', 'OTROS_NOMBRES',
-                 'MontoBruto Positivo', 'MontoBruto Negativo', # Use the actual column names from processing
-                 'Descuento', 'Iva'
-             ]
+        if mode_type in SAVE_COLUMNS:
+             expected_final_columns = list(SAVE_COLUMNS[mode_type])
         else:
              # Should not happen, but fallback to actual columns if available, otherwise empty list
              print(f"[Flow] save_results: Modo desconocido '{mode_type}'. Usando columnas actuales.")
              expected_final_columns = final_df.columns.tolist() if not final_df.empty else []
 
+        # The query store always keeps the long format, before any period pivot
+        store_df, store_per_source = final_df, processing_state.get('per_source') or {}
+
+        # Period rollups: PERIODO leads (long format) or one column per amount and period follows (wide)
+        if PERIOD_COL in final_df.columns:
+             if chk_period_wide.value:
+                  client_keys = ['NOMBRECLIENTE', 'IDENTIFICACION']
+                  final_df = pivot_periods(final_df, mode_type, keys=client_keys)
+                  processing_state['per_source'] = {k: pivot_periods(v, mode_type, keys=client_keys)
+                                                    for k, v in (processing_state.get('per_source') or {}).items()}
+                  expected_final_columns = final_df.columns.tolist()
+             else:
+                  expected_final_columns = [PERIOD_COL] + expected_final_columns
+
 
         update_status(f"Seleccione la carpeta de exportación para el reporte de {mode_display_name}...", ft.colors.ORANGE_ACCENT_700 if final_df.empty else ft.colors.GREEN_ACCENT_700)
         print("[Flow] Llamando a filedialog.askdirectory (esto bloqueará la UI)")
@@ -829,39 +1163,64 @@ def main(page: ft.Page):
 
             # Select and reorder columns for the final output
             # Use expected_final_columns for structure, even if df is empty
-            df_to_save = pd.DataFrame(columns=expected_final_columns)
-
-            if not final_df.empty:
-                 # Copy data for columns that are in both the expected list and the processed df
-                 for col in expected_final_columns:
-                     if col in final_df.columns:
-                         df_to_save[col] = final_df[col]
-                     # If col is in expected but not in final_df, it was created as 0.0 or pd.NA
-                     # by process_data_internal_sync, so it's already in final_df structure
-                     # unless final_df was an error DF. The error DF case is handled.
-
-                 # Ensure numeric columns are indeed numeric before saving
-                 numeric_cols_save = ['MontoBruto', 'MontoBruto Positivo', 'MontoBruto Negativo', 'Descuento', 'Iva']
-                 for col in numeric_cols_save:
-                     if col in df_to_save.columns:
-                          df_to_save[col] = pd.to_numeric(df_to_save[col], errors='coerce').fillna(0.0)
+            df_to_save = frame_to_save(final_df, expected_final_columns)
 
 
             print(f"[Flow] DataFrame para guardar preparado. Columnas finales: {df_to_save.columns.tolist()}. Está vacío: {df_to_save.empty}")
 
 
-            with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
-                 # Pass df_to_save. It will have the correct structure based on expected_final_columns
-                 df_to_save.to_excel(writer, index=False, sheet_name='Reporte')
+            # Reports above the Excel limit go to several sheets, or several files if the checkbox is ticked
+            split_into = 'files' if chk_split_files.value else 'sheets'
+            if len(df_to_save) > EXCEL_MAX_ROWS - 1:
+                 target = "varios archivos" if split_into == 'files' else "varias hojas"
+                 print(f"[Flow] {len(df_to_save)} filas superan el límite de Excel. Repartiendo en {target}.")
+                 update_status(f"El reporte tiene {len(df_to_save)} filas; se repartirá en {target}...", ft.colors.BLUE_GREY_400)
+
+            # Pass df_to_save. It will have the correct structure based on expected_final_columns
+            per_source = processing_state.get('per_source') or {}
+            if per_source:
+                 # Consolidated + per-source reports written concurrently
+                 reports = {output_path: df_to_save}
+                 for source, path in source_report_paths(output_path, per_source).items():
+                      reports[path] = per_source[source]
+                 print(f"[Flow] Guardando {len(reports)} reportes en paralelo.")
+                 save_reports_parallel(reports, mode_type, split_into=split_into)
+            else:
+                 save_report(df_to_save, output_path, mode_type, sheet_name='Reporte', split_into=split_into)
             print("[Flow] Archivo Excel guardado exitosamente.")
 
+            if processing_state.get('index'):
+                 index_path = save_drilldown_index(index_path_for(output_path), processing_state['index'],
+                                                   processing_state['source_files'])
+                 print(f"[Flow] Índice de detalle guardado en: {index_path}")
+
+            # Reconcile the report against the control totals taken while reading
+            reconciliation_msg = ""
+            if processing_state.get('controls'):
+                 # The GUI always stores |Descuento|, so only the amounts are compared
+                 summary = reconciliation_report(processing_state['controls'], mode_type, df_to_save,
+                                                 processing_state.get('subtract', False), per_source,
+                                                 compare_discount=False)
+                 print_reconciliation(summary)
+                 print(f"[Flow] Conciliación guardada en: {save_reconciliation(summary, output_path)}")
+                 if summary['ok']:
+                      reconciliation_msg = "\nConciliación: los totales cuadran con los archivos de entrada."
+                 else:
+                      reconciliation_msg = "\nATENCIÓN: los totales no cuadran con los archivos de entrada (ver .conciliacion.json)."
+
+            if chk_store.value:
+                 run = store_report(store_df, mode_type, processing_state['source_files'],
+                                    processing_state.get('subtract', False), store_per_source)
+                 print(f"[Flow] Corrida {run} guardada en el almacén: {STORE_PATH}")
+
 
             # Check if the resulting dataframe to be saved was empty
             if df_to_save.empty:
                  update_status(f"¡Reporte de {mode_display_name} (vacío con encabezados) guardado exitosamente en\n{output_path}!", ft.colors.GREEN_700)
                  print("[Flow] Mensaje final: Guardado vacío.")
             else:
-                 update_status(f"¡Reporte de {mode_display_name} generado y guardado exitosamente en\n{output_path}!", ft.colors.GREEN_700)
+                 update_status(f"¡Reporte de {mode_display_name} generado y guardado exitosamente en\n{output_path}!{reconciliation_msg}",
+                               ft.colors.GREEN_700 if not reconciliation_msg.startswith("\nATENCIÓN") else ft.colors.ORANGE_700)
                  print("[Flow] Mensaje final: Guardado exitoso.")
 
 
@@ -877,6 +1236,114 @@ def main(page: ft.Page):
             processing_state.clear() # Clean up state after finishing
 
 
+    # --- Drill-down: explain a client from a saved index ---
+    def on_explain_button_click(e):
+        print("[Flow] Botón 'Explicar cliente' clickeado")
+        index_file = filedialog.askopenfilename(
+             title="Seleccionar índice de detalle",
+             filetypes=[("Índice de detalle", f"*{INDEX_SUFFIX}")],
+             parent=root
+        )
+        if not index_file:
+            update_status("Selección de índice cancelada.", ft.colors.RED_ACCENT_700)
+            return
+
+        query_input = ft.TextField(label="NOMBRECLIENTE o IDENTIFICACION", width=400, autofocus=True)
+        results_column = ft.Column([], scroll=ft.ScrollMode.AUTO, height=350, width=800)
+
+        def run_query(ev):
+            try:
+                rows = explain_client(index_file, query_input.value, max_rows=500)
+            except Exception as ex:
+                print(f"[Flow] Error al consultar el índice: {ex}")
+                results_column.controls = [ft.Text(f"Error al consultar el índice: {ex}", color=ft.colors.RED_ACCENT_700)]
+                page.update()
+                return
+            if rows.empty:
+                results_column.controls = [ft.Text(f"Cliente '{query_input.value}' no encontrado.")]
+            else:
+                table = ft.DataTable(
+                    columns=[ft.DataColumn(ft.Text(str(c))) for c in rows.columns],
+                    rows=[ft.DataRow(cells=[ft.DataCell(ft.Text("" if pd.isna(v) else str(v))) for v in r])
+                          for r in rows.itertuples(index=False)]
+                )
+                results_column.controls = [ft.Text(f"{len(rows)} fila(s) de origen (máx. 500)"),
+                                           ft.Row([table], scroll=ft.ScrollMode.AUTO)]
+            page.update()
+
+        query_input.on_submit = run_query
+        dialog = ft.AlertDialog(
+            modal=True,
+            title=ft.Text(f"Explicar cliente — {os.path.basename(index_file)}"),
+            content=ft.Column([ft.Row([query_input, ft.ElevatedButton("Buscar", on_click=run_query)]), results_column],
+                              tight=True),
+            actions=[ft.TextButton("Cerrar", on_click=lambda ev: close_dialog(page.dialog))],
+            actions_alignment=ft.MainAxisAlignment.END,
+        )
+        page.dialog = dialog
+        page.open(dialog)
+        page.update()
+
+
+    # --- Query store: ad-hoc lookups across saved runs ---
+    def on_query_button_click(e):
+        print("[Flow] Botón 'Consultar almacén' clickeado")
+        dd_query_mode = ft.Dropdown(label="Modo", width=180, value="todos",
+                                    options=[ft.dropdown.Option(key="todos", text="Todos")] +
+                                            [ft.dropdown.Option(key=k, text=v) for k, v in mode_display_names.items()])
+        dd_measure = ft.Dropdown(label="Monto", width=200, value="MontoBruto",
+                                 options=[ft.dropdown.Option(key="ninguno", text="(sin orden)")] +
+                                         [ft.dropdown.Option(c) for c in NUMERIC_FINAL_COLS])
+        min_input = ft.TextField(label="Mínimo", width=120)
+        top_input = ft.TextField(label="Primeros N", width=110, value="50")
+        client_input = ft.TextField(label="Cliente (nombre o identificación)", width=300, autofocus=True)
+        chk_all_runs = ft.Checkbox(label="Todas las corridas", value=False)
+        results_column = ft.Column([], scroll=ft.ScrollMode.AUTO, height=350, width=900)
+
+        def run_query(ev):
+            measure = dd_measure.value if dd_measure.value in NUMERIC_FINAL_COLS else None
+            try:
+                t0 = time.perf_counter()
+                rows = query_store(mode=dd_query_mode.value if dd_query_mode.value in mode_display_names else None,
+                                   measure=measure,
+                                   minimum=float(min_input.value) if measure and (min_input.value or "").strip() else None,
+                                   client=(client_input.value or "").strip() or None,
+                                   run='todas' if chk_all_runs.value else 'ultima',
+                                   top=int(top_input.value) if (top_input.value or "").strip() else 500)
+                elapsed = time.perf_counter() - t0
+            except Exception as ex:
+                print(f"[Flow] Error al consultar el almacén: {ex}")
+                results_column.controls = [ft.Text(f"Error al consultar el almacén: {ex}", color=ft.colors.RED_ACCENT_700)]
+                page.update()
+                return
+            if rows.empty:
+                results_column.controls = [ft.Text("Sin resultados.")]
+            else:
+                rows = rows.head(500)
+                table = ft.DataTable(
+                    columns=[ft.DataColumn(ft.Text(str(c))) for c in rows.columns],
+                    rows=[ft.DataRow(cells=[ft.DataCell(ft.Text("" if pd.isna(v) else str(v))) for v in r])
+                          for r in rows.itertuples(index=False)]
+                )
+                results_column.controls = [ft.Text(f"{len(rows)} fila(s) en {elapsed*1000:.0f} ms (máx. 500)"),
+                                           ft.Row([table], scroll=ft.ScrollMode.AUTO)]
+            page.update()
+
+        client_input.on_submit = run_query
+        dialog = ft.AlertDialog(
+            modal=True,
+            title=ft.Text("Consultar almacén de reportes"),
+            content=ft.Column([ft.Row([dd_query_mode, dd_measure, min_input, top_input]),
+                               ft.Row([client_input, chk_all_runs, ft.ElevatedButton("Buscar", on_click=run_query)]),
+                               results_column], tight=True),
+            actions=[ft.TextButton("Cerrar", on_click=lambda ev: close_dialog(page.dialog))],
+            actions_alignment=ft.MainAxisAlignment.END,
+        )
+        page.dialog = dialog
+        page.open(dialog)
+        page.update()
+
+
     # Mapping for display names
     mode_display_names = {
         'debito': 'Débito',
@@ -910,6 +1377,77 @@ def main(page: ft.Page):
     )
 
 
+    chk_identities = ft.Checkbox(
+        label="Unificar nombres duplicados de un mismo cliente",
+        value=False
+    )
+
+    chk_by_source = ft.Checkbox(
+        label="Generar también un reporte por cada archivo",
+        value=False
+    )
+
+    chk_all_sheets = ft.Checkbox(
+        label="Leer todas las hojas con las columnas requeridas",
+        value=False
+    )
+
+    dd_period = ft.Dropdown(
+        label=f"Agrupar por periodo (columna {DATE_COL})",
+        width=320,
+        value="ninguno",
+        options=[ft.dropdown.Option(key="ninguno", text="Sin periodo")] +
+                [ft.dropdown.Option(key=k, text=k.capitalize()) for k in PERIODS]
+    )
+
+    chk_period_wide = ft.Checkbox(
+        label="Periodos en columnas (formato ancho)",
+        value=False
+    )
+
+    chk_preview = ft.Checkbox(
+        label="Vista previa del resultado antes de guardar",
+        value=True
+    )
+
+    chk_checkpoints = ft.Checkbox(
+        label="Puntos de control por archivo (reanudar si se interrumpe)",
+        value=False
+    )
+
+    chk_index = ft.Checkbox(
+        label="Guardar índice de detalle por cliente",
+        value=False
+    )
+
+    chk_store = ft.Checkbox(
+        label="Guardar en el almacén de consultas",
+        value=False
+    )
+
+    chk_parallel = ft.Checkbox(
+        label="Agrupar en varios procesos (lotes de millones de filas)",
+        value=False
+    )
+
+    chk_split_files = ft.Checkbox(
+        label="Reportes de más de 1.048.575 filas: dividir en archivos (no en hojas)",
+        value=False
+    )
+
+    btn_query = ft.TextButton(
+        "Consultar almacén (corridas anteriores)",
+        on_click=on_query_button_click,
+        icon=ft.icons.QUERY_STATS
+    )
+
+    btn_explain = ft.TextButton(
+        "Explicar cliente (desde un índice)",
+        on_click=on_explain_button_click,
+        icon=ft.icons.MANAGE_SEARCH
+    )
+
+
     # --- Add Controls to Page Layout ---
     page.add(
         ft.Container(
@@ -921,6 +1459,19 @@ def main(page: ft.Page):
                      btn_debito,
                      btn_credito,
                      btn_split,
+                     chk_identities,
+                     chk_by_source,
+                     chk_all_sheets,
+                     dd_period,
+                     chk_period_wide,
+                     chk_preview,
+                     chk_checkpoints,
+                     chk_index,
+                     chk_store,
+                     chk_parallel,
+                     chk_split_files,
+                     btn_explain,
+                     btn_query,
                      ft.Container(height=30),
                      status_container,
                  ],
@@ -1,130 +1,2354 @@
 import pandas as pd
+import numpy as np
 import sys
 import re
 import os
+import time
+import json
+import shutil
+import hashlib
+import argparse
+import unicodedata
+import zipfile
+import html
+import pickle
+import sqlite3
+import gc
+import tracemalloc
+import tempfile
+import fnmatch
+import multiprocessing
+import xml.etree.ElementTree as ET
+import openpyxl
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# Copy-on-Write: filtros y selecciones de columnas son vistas que se copian solo al
+# escribirlas, así que el proceso no necesita .copy() defensivos (siempre activo en pandas >= 3)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
+# Por debajo de este número de filas el groupby de pandas en un solo proceso es más rápido
+PARALLEL_MIN_ROWS = 200000
+
+# Subir cuando cambien las reglas de consolidación de nombres (invalida la caché de resultados)
+CONSOLIDATION_RULES_VERSION = 1
+
+# Caché de reportes ya generados
+CACHE_DIR = os.environ.get('DOCUFLOW_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.docuflow_cache'))
+CACHE_MAX_BYTES = 2 * 1024**3
+
+# Tabla de identidades resueltas (nombre, identificación -> nombre canónico) reutilizada entre corridas
+IDENTITY_MAP_PATH = os.path.join(CACHE_DIR, 'identidades.csv')
+# Bloques por identificación más grandes que esto solo se unen por nombre normalizado exacto
+IDENTITY_MAX_BLOCK = 50
+IDENTITY_MIN_JACCARD = 0.75
+
+# Planificador: tamaño estimado de una celda en un DataFrame y copias simultáneas en pandas
+BYTES_PER_CELL = 64
+PANDAS_PEAK_FACTOR = 4
+# Fracción de la memoria disponible que se permite usar
+MEMORY_SAFETY = 0.7
+STREAM_CHUNK_ROWS = 100000
+SPILL_BUCKETS = 16
+STRATEGIES = ('memoria','streaming','disco')
+NUMERIC_FINAL_COLS = ['MontoBruto','MontoBruto Positivo','MontoBruto Negativo','Descuento','Iva']
+
+# Pico de memoria permitido en process_data (comando 'memoria'), en múltiplos de los buffers de la
+# entrada (memory_usage(deep=False): los textos no se copian, solo sus punteros). Una copia
+# defensiva de más suma 1.0, así que estos límites la detectan
+MEMORY_MAX_FACTOR = {'debito': 1.4, 'credito': 1.4, 'split': 1.9}
+
+# Excel admite 1.048.576 filas por hoja (incluido el encabezado)
+EXCEL_MAX_ROWS = 1048576
+
+FINAL_COLS = {
+    'debito': ['TIPO DE DOCUMENTO','IDENTIFICACION','NOMBRECLIENTE','PRIMER_APELLIDO',
+               'SEGUNDO_APELLIDO','PRIMER_NOMBRE','OTROS_NOMBRES','MontoBruto','Descuento','Iva'],
+    'credito': ['TIPO DE DOCUMENTO','IDENTIFICACION','NOMBRECLIENTE','PRIMER_APELLIDO',
+                'SEGUNDO_APELLIDO','PRIMER_NOMBRE','OTROS_NOMBRES','MontoBruto','Descuento','Iva'],
+    'split': ['TIPO DE DOCUMENTO','IDENTIFICACION','NOMBRECLIENTE','PRIMER_APELLIDO',
+              'SEGUNDO_APELLIDO','PRIMER_NOMBRE','OTROS_NOMBRES',
+              'MontoBruto Positivo','MontoBruto Negativo','Descuento','Iva'],
+}
+
+REQUIRED_COLS = ['UNIDADES','NOMBRECLIENTE','TIPO_DE_DOCUMENTO','IDENTIFICACION',
+                 'PRIMER_APELLIDO','SEGUNDO_APELLIDO','PRIMER_NOMBRE','OTROS_NOMBRES',
+                 'MontoBruto','Descuento','IVA']
+
+# Columna con el archivo de origen de cada fila (reportes por archivo)
+SOURCE_COL = 'ARCHIVO_ORIGEN'
+
+# Procedencia de cada fila para el índice de detalle: posición del archivo y fila de Excel
+ROW_FILE_COL = '_ARCHIVO'
+ROW_POS_COL = '_FILA'
+INDEX_SUFFIX = '.indice.npz'
+
+# Puntos de control de corridas por lotes (--puntos-control / --reanudar)
+CHECKPOINT_DIR = os.path.join(CACHE_DIR, 'puntos_control')
+# Carpeta de puntos de control de la última corrida, para '--reanudar' sin carpeta
+LAST_CHECKPOINT_PATH = os.path.join(CACHE_DIR, 'ultimo_punto_control.txt')
+
+# Dimensión de periodo opcional (--periodo): columna de fecha y frecuencias de pandas
+DATE_COL = os.environ.get('DOCUFLOW_COLUMNA_FECHA', 'FECHA')
+PERIOD_COL = 'PERIODO'
+PERIODS = {'dia': 'D', 'semana': 'W', 'mes': 'M', 'trimestre': 'Q'}
+NO_DATE = 'SIN FECHA'
+
+# Libros con varias hojas (--hojas): cada hoja se lee como 'libro.xlsx[Hoja]'.
+# Excel no admite corchetes en nombres de hoja, así que la referencia no es ambigua.
+SHEET_REF = '{path}[{sheet}]'
+
+# Vista previa por muestreo (--muestra): filas por libro, repartidas en ventanas a lo largo de la hoja
+SAMPLE_ROWS = 5000
+SAMPLE_WINDOWS = 10
+
+# Celdas por segundo que pd.read_excel (openpyxl) procesa en un núcleo; solo para estimar tiempos
+READ_CELLS_PER_SEC = 100000
+
+# Totales de control calculados al leer, para conciliar contra el reporte
+CONTROL_MEASURES = ['UNIDADES','MontoBruto','Descuento','IVA']
+CONTROL_SIGNS = ['positivo','negativo','cero','no numérico']
+RECONCILIATION_SUFFIX = '.conciliacion.json'
+
+# Estados del comando diff, en el orden en que se listan
+DIFF_STATES = ('nuevo','eliminado','cambiado')
+
+# Almacén consultable de reportes (--almacen / consultar): SQLite con un índice por monto
+STORE_PATH = os.environ.get('DOCUFLOW_ALMACEN', os.path.join(CACHE_DIR, 'reportes.sqlite'))
+CLIENT_COLS = ['NOMBRECLIENTE', 'IDENTIFICACION']
+STORE_KEYS = [SOURCE_COL, PERIOD_COL] + CLIENT_COLS
+
+OUTPUT_NAMES = {
+    'debito':'reporte_debito.xlsx',
+    'credito':'reporte_credito.xlsx',
+    'split':'reporte_negativos_positivos.xlsx'
+}
 
 def clean_tipo_documento(tipo_doc_series):
     return tipo_doc_series.astype(str).str.replace(r'^\d+\s*', '', regex=True)
 
-def process_data(df, mode, subtract_discount=False):
-    required_cols = ['UNIDADES','NOMBRECLIENTE','TIPO_DE_DOCUMENTO','IDENTIFICACION',
-                     'PRIMER_APELLIDO','SEGUNDO_APELLIDO','PRIMER_NOMBRE','OTROS_NOMBRES',
-                     'MontoBruto','Descuento','IVA']
-    missing = [c for c in required_cols if c not in df.columns]
+def normalize_client_name(name):
+    """Mayúsculas sin tildes ni signos, espacios colapsados y tokens ordenados."""
+    name = unicodedata.normalize('NFKD', str(name))
+    name = ''.join(ch for ch in name if not unicodedata.combining(ch)).upper()
+    return ' '.join(sorted(re.sub(r'[^A-Z0-9Ñ ]+', ' ', name).split()))
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def _union(parent, a, b):
+    ra, rb = _find(parent, a), _find(parent, b)
+    if ra != rb:
+        parent[max(ra, rb)] = min(ra, rb)
+
+def _names_match(a, b):
+    ta, tb = set(a.split()), set(b.split())
+    small = min(len(ta), len(tb))
+    return (small >= 2 and (ta <= tb or tb <= ta)) or len(ta & tb) / len(ta | tb) >= IDENTITY_MIN_JACCARD
+
+def resolve_client_identities(df, mapping_path=IDENTITY_MAP_PATH):
+    """
+    Reemplaza NOMBRECLIENTE por un nombre canónico por identidad. Dos pares
+    (nombre, identificación) son la misma identidad si tienen el mismo nombre
+    normalizado (tildes, espacios y orden de tokens) y la misma identificación,
+    o si dentro del bloque de una identificación sus tokens se contienen o son
+    casi iguales. Solo se comparan candidatos del mismo bloque, así el costo es
+    casi lineal. La tabla se guarda en mapping_path: los pares ya conocidos
+    reutilizan su nombre canónico y solo los nuevos se resuelven, contra los
+    nombres canónicos existentes de su identificación, y se agregan al final
+    del archivo. Modifica y devuelve df.
+    """
+    names = df['NOMBRECLIENTE'].astype(str)
+    ids = df['IDENTIFICACION'].astype(str)
+    pairs = pd.DataFrame({'NOMBRECLIENTE': names, 'IDENTIFICACION': ids})
+    key = ['NOMBRECLIENTE','IDENTIFICACION']
+
+    known = pd.DataFrame(columns=key + ['CANONICO'])
+    if mapping_path and os.path.isfile(mapping_path):
+        known = pd.read_csv(mapping_path, dtype=str, keep_default_na=False)
+        # solo interesan las identificaciones de esta corrida
+        known = known[known['IDENTIFICACION'].isin(ids.unique())].drop_duplicates(key)
+
+    counts = pairs.value_counts(sort=False).reset_index(name='n')
+    is_new = ~pd.MultiIndex.from_frame(counts[key]).isin(pd.MultiIndex.from_frame(known[key]))
+    new = counts[is_new].reset_index(drop=True)
+    if new.empty:
+        print("[Identidades] Tabla de identidades en caché reutilizada.")
+    else:
+        # candidatos: los pares nuevos y un representante por nombre canónico ya usado en su identificación
+        existing = known.loc[known['IDENTIFICACION'].isin(new['IDENTIFICACION']), ['CANONICO','IDENTIFICACION']] \
+                        .drop_duplicates().rename(columns={'CANONICO': 'NOMBRECLIENTE'})
+        cand = pd.concat([new.assign(PREVIO=False), existing.assign(n=0, PREVIO=True)], ignore_index=True)
+        cand['NORM'] = cand['NOMBRECLIENTE'].map(normalize_client_name)
+
+        # bloque exacto: misma identificación y mismo nombre normalizado; cada fila apunta a la primera de su bloque
+        first = cand.index.to_series().groupby([cand['IDENTIFICACION'], cand['NORM']], sort=False).transform('min')
+        parent = first.tolist()
+        # bloque por identificación: solo las identificaciones con más de un nombre normalizado distinto
+        reps = cand[first.to_numpy() == cand.index.to_numpy()]
+        names_per_id = reps.groupby('IDENTIFICACION', sort=False)['NORM'].transform('size')
+        multi = reps[(names_per_id > 1) & (names_per_id <= IDENTITY_MAX_BLOCK)]
+        rows, norms_all = multi.index.to_numpy(), multi['NORM'].to_numpy()
+        for members in multi.groupby('IDENTIFICACION', sort=False).indices.values():
+            idx, norms = rows[members].tolist(), norms_all[members].tolist()
+            for a in range(len(idx)):
+                for b in range(a + 1, len(idx)):
+                    if _names_match(norms[a], norms[b]):
+                        _union(parent, idx[a], idx[b])
+
+        cand['ROOT'] = [_find(parent, i) for i in range(len(cand))]
+        # nombre canónico: el ya usado en corridas anteriores, si no el más frecuente
+        ranked = cand.sort_values(['PREVIO', 'n'], ascending=[False, False], kind='stable')
+        cand['CANONICO'] = cand['ROOT'].map(ranked.drop_duplicates('ROOT').set_index('ROOT')['NOMBRECLIENTE'])
+        added = cand.loc[~cand['PREVIO'], key + ['CANONICO']]
+        merged = int((added['CANONICO'] != added['NOMBRECLIENTE']).sum())
+        print(f"[Identidades] {len(added)} pares nombre/identificación nuevos, {merged} unificados con otro nombre.")
+        if mapping_path:
+            os.makedirs(os.path.dirname(mapping_path) or '.', exist_ok=True)
+            added.to_csv(mapping_path, mode='a', index=False, header=not os.path.isfile(mapping_path))
+        known = pd.concat([known[key + ['CANONICO']], added], ignore_index=True)
+
+    df['NOMBRECLIENTE'] = pairs.merge(known[key + ['CANONICO']], on=key, how='left')['CANONICO'].to_numpy()
+    return df
+
+# --- Especificaciones de reporte ---
+# Un reporte se describe con datos: filtros, claves, atributos (primer valor),
+# montos sumados, montos separados por signo, ajustes posteriores (descuento) y
+# orden de columnas. compile_spec lo convierte una sola vez en un plan que
+# process_data ejecuta con un único groupby; los modos integrados son specs más.
+
+_DOC_ATTRS = {'TIPO DE DOCUMENTO':'TIPO_DE_DOCUMENTO','IDENTIFICACION':'IDENTIFICACION',
+              'PRIMER_APELLIDO':'PRIMER_APELLIDO','SEGUNDO_APELLIDO':'SEGUNDO_APELLIDO',
+              'PRIMER_NOMBRE':'PRIMER_NOMBRE','OTROS_NOMBRES':'OTROS_NOMBRES'}
+
+BUILTIN_SPECS = {
+    'debito': {
+        'filtros': [{'columna':'UNIDADES','op':'>','valor':0}],
+        'claves': ['NOMBRECLIENTE'], 'primero': _DOC_ATTRS,
+        'sumas': {'MontoBruto':'MontoBruto','Descuento':'Descuento','Iva':'IVA'},
+        'ajustes': [{'restar':'Descuento','de':['MontoBruto']}],
+        'columnas': FINAL_COLS['debito'], 'archivo': OUTPUT_NAMES['debito'],
+    },
+    'credito': {
+        'filtros': [{'columna':'UNIDADES','op':'<','valor':0}],
+        'claves': ['NOMBRECLIENTE'], 'primero': _DOC_ATTRS,
+        'sumas': {'MontoBruto':'MontoBruto','Descuento':'Descuento','Iva':'IVA'},
+        'ajustes': [{'restar':'Descuento','de':['MontoBruto']}],
+        'columnas': FINAL_COLS['credito'], 'archivo': OUTPUT_NAMES['credito'],
+    },
+    'split': {
+        'claves': ['NOMBRECLIENTE'], 'primero': _DOC_ATTRS,
+        'por_signo': {'MontoBruto Positivo': ['MontoBruto','+'], 'MontoBruto Negativo': ['MontoBruto','-']},
+        'sumas': {'Descuento':'Descuento','Iva':'IVA'},
+        'ajustes': [{'restar':'Descuento','de':['MontoBruto Positivo','MontoBruto Negativo']}],
+        'columnas': FINAL_COLS['split'], 'archivo': OUTPUT_NAMES['split'],
+    },
+}
+
+_FILTER_OPS = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal,
+               '==': np.equal, '!=': np.not_equal}
+SPECS = {}
+
+def compile_spec(spec, name=None):
+    """
+    Valida una especificación y precalcula lo que process_data necesita: columnas
+    de entrada requeridas, diccionario de agregación, renombres, montos (para
+    combinar parciales y restar descuentos) y orden final de columnas.
+    """
+    name = name or spec.get('nombre')
+    if not name:
+        raise ValueError("La especificación necesita un 'nombre'.")
+    keys = list(spec.get('claves') or [])
+    if not keys:
+        raise ValueError(f"[{name}] 'claves' no puede estar vacío.")
+    first = dict(spec.get('primero') or {})
+    sums = dict(spec.get('sumas') or {})
+    by_sign = {out: tuple(v) for out, v in (spec.get('por_signo') or {}).items()}
+    filters = []
+    for f in spec.get('filtros') or []:
+        op = f.get('op', '==')
+        if op not in _FILTER_OPS and op not in ('en', 'no_en'):
+            raise ValueError(f"[{name}] Operador de filtro inválido: {op}")
+        filters.append((f['columna'], op, f.get('valor')))
+    for out, (src, sign) in by_sign.items():
+        if sign not in ('+', '-'):
+            raise ValueError(f"[{name}] Signo inválido para '{out}': {sign}")
+
+    outputs = list(first) + list(sums) + list(by_sign)
+    dupes = {c for c in outputs + keys if (outputs + keys).count(c) > 1}
+    if dupes:
+        raise ValueError(f"[{name}] Columnas de salida repetidas: {sorted(dupes)}")
+    # cada columna de entrada se agrega una sola vez (el diccionario de agg va por columna)
+    sources = list(first.values()) + list(sums.values())
+    reused = {c for c in sources if sources.count(c) > 1 or c in keys or c in by_sign}
+    if reused:
+        raise ValueError(f"[{name}] Columnas de entrada usadas más de una vez: {sorted(reused)}")
+
+    measures = list(sums) + list(by_sign)
+    adjustments = []
+    for a in spec.get('ajustes') or []:
+        targets = list(a.get('de') or [])
+        if a.get('restar') not in measures or any(t not in measures for t in targets):
+            raise ValueError(f"[{name}] Los ajustes solo pueden usar montos del reporte: {a}")
+        adjustments.append((a['restar'], targets))
+
+    columns = list(spec.get('columnas') or ([k for k in keys if k not in outputs] + outputs))
+    unknown = [c for c in columns if c not in outputs and c not in keys]
+    if unknown:
+        raise ValueError(f"[{name}] 'columnas' incluye columnas que el reporte no genera: {unknown}")
+
+    # el índice de detalle rotula cada grupo (filas de entrada) con el nombre, o la primera clave, y la
+    # columna de entrada IDENTIFICACION si el reporte la usa;
+    # el almacén solo admite reportes de una fila por cliente con ambas columnas
+    label_col = 'NOMBRECLIENTE' if 'NOMBRECLIENTE' in keys else keys[0]
+    id_col = 'IDENTIFICACION' if 'IDENTIFICACION' in keys or 'IDENTIFICACION' in first.values() else None
+    by_client = set(keys) <= set(CLIENT_COLS) and all(c in keys or c in first for c in CLIENT_COLS)
+
+    agg = {src: 'first' for src in first.values()}
+    agg.update({src: 'sum' for src in sums.values()})
+    agg.update({out: 'sum' for out in by_sign})
+    required = list(dict.fromkeys([c for c, _, _ in filters] + keys + sources + [s for s, _ in by_sign.values()]))
+    return {
+        'name': name, 'filters': filters, 'keys': keys, 'agg': agg, 'by_sign': by_sign,
+        'rename': {src: out for out, src in list(first.items()) + list(sums.items()) if src != out},
+        'measures': measures, 'adjustments': adjustments, 'columns': columns, 'required': required,
+        'label_col': label_col, 'id_col': id_col, 'by_client': by_client,
+        'consolidate_names': bool(spec.get('consolidar_nombres', True)),
+        'clean_doc_type': bool(spec.get('limpiar_tipo_documento', True)),
+        'output_name': spec.get('archivo') or f'reporte_{name}.xlsx',
+        'source': spec,
+    }
+
+def register_spec(spec, name=None):
+    """Compila y registra una especificación; su nombre pasa a funcionar como modo."""
+    compiled = compile_spec(spec, name)
+    SPECS[compiled['name']] = compiled
+    FINAL_COLS[compiled['name']] = compiled['columns']
+    OUTPUT_NAMES[compiled['name']] = compiled['output_name']
+    return compiled['name']
+
+def load_spec(path):
+    """Lee una especificación JSON y la registra (nombre por defecto: el del archivo)."""
+    with open(path, encoding='utf-8') as f:
+        spec = json.load(f)
+    return register_spec(spec, spec.get('nombre') or os.path.splitext(os.path.basename(path))[0])
+
+def spec_for(mode):
+    try:
+        return SPECS[mode]
+    except KeyError:
+        raise ValueError(f"Modo inválido: {mode}") from None
+
+for _name, _spec in BUILTIN_SPECS.items():
+    register_spec(_spec, _name)
+
+def require_client_report(mode):
+    """ValueError si el modo no produce una fila por cliente (lo que guarda el almacén)."""
+    spec = spec_for(mode)
+    if not spec['by_client']:
+        raise ValueError(f"El almacén guarda una fila por cliente ({' + '.join(CLIENT_COLS)}); "
+                         f"'{spec['name']}' agrupa por {spec['keys']}. Quite --almacen o use esas claves.")
+
+def _filter_mask(df, filters):
+    mask = np.ones(len(df), dtype=bool)
+    for col, op, value in filters:
+        values = df[col]
+        if op == 'en':
+            mask &= values.isin(value).to_numpy()
+        elif op == 'no_en':
+            mask &= ~values.isin(value).to_numpy()
+        else:
+            mask &= np.asarray(_FILTER_OPS[op](values, value), dtype=bool)
+    return mask
+
+def filter_rows(df, spec):
+    """
+    Filas de df que pasan los filtros de la especificación, todas las condiciones
+    en una sola máscara. Con Copy-on-Write las columnas que se reemplacen después
+    no tocan las de df, así que no hace falta copiar.
+    """
+    return df[_filter_mask(df, spec['filters'])] if spec['filters'] else df.copy(deep=False)
+
+def process_data(df, mode, subtract_discount=False, workers=1, resolve_identities=False, extra_keys=(),
+                 index_out=None):
+    """
+    Filtra, consolida y agrega las filas de df según la especificación del modo
+    (ver compile_spec). Si index_out es un dict y df trae ROW_FILE_COL/ROW_POS_COL
+    (load_files con track_rows), se llena con el índice de detalle de cada cliente
+    (ver build_drilldown_index).
+    """
+    spec = spec_for(mode)
+    missing = [c for c in spec['required'] if c not in df.columns]
     if missing:
         raise ValueError(f"Faltan columnas requeridas: {missing}")
 
-    # filter
-    if mode == 'debito':
-        df_proc = df[df['UNIDADES']>0].copy()
-        final_cols = ['TIPO DE DOCUMENTO','IDENTIFICACION','NOMBRECLIENTE','PRIMER_APELLIDO',
-                      'SEGUNDO_APELLIDO','PRIMER_NOMBRE','OTROS_NOMBRES','MontoBruto','Descuento','Iva']
-    elif mode == 'credito':
-        df_proc = df[df['UNIDADES']<0].copy()
-        final_cols = ['TIPO DE DOCUMENTO','IDENTIFICACION','NOMBRECLIENTE','PRIMER_APELLIDO',
-                      'SEGUNDO_APELLIDO','PRIMER_NOMBRE','OTROS_NOMBRES','MontoBruto','Descuento','Iva']
-    elif mode == 'split':
-        df_proc = df.copy()
-        df_proc['MontoBruto'] = pd.to_numeric(df_proc['MontoBruto'], errors='coerce').fillna(0)
-        df_proc['MontoBruto Positivo'] = df_proc['MontoBruto'].apply(lambda x: x if x>0 else 0)
-        df_proc['MontoBruto Negativo'] = df_proc['MontoBruto'].apply(lambda x: x if x<0 else 0)
-        final_cols = ['TIPO DE DOCUMENTO','IDENTIFICACION','NOMBRECLIENTE','PRIMER_APELLIDO',
-                      'SEGUNDO_APELLIDO','PRIMER_NOMBRE','OTROS_NOMBRES',
-                      'MontoBruto Positivo','MontoBruto Negativo','Descuento','Iva']
-    else:
-        raise ValueError(f"Modo inválido: {mode}")
+    df_proc = filter_rows(df, spec)
+    for out, (src, sign) in spec['by_sign'].items():
+        df_proc[src] = pd.to_numeric(df_proc[src], errors='coerce').fillna(0)
+        df_proc[out] = df_proc[src].clip(lower=0) if sign == '+' else df_proc[src].clip(upper=0)
+    # extra_keys (p. ej. SOURCE_COL) se agregan como claves de agrupación delante del cliente
+    final_cols = list(extra_keys) + spec['columns']
+    keys = list(extra_keys) + spec['keys']
 
     if df_proc.empty:
         return pd.DataFrame(columns=final_cols)
 
     # consolidate names
-    regex = re.compile(r'(?i)(cliente|consumidor).*finall?')
-    df_proc['NOMBRECLIENTE'] = df_proc['NOMBRECLIENTE'].astype(str)
-    mask = df_proc['NOMBRECLIENTE'].str.upper().isin([
-        'CLIENTE CLIENTE','CLIENTE UNO','CLIENTES VARIOS CLIENTES VARIOS','CONSUMIDOR FINAL'
-    ]) | df_proc['NOMBRECLIENTE'].str.contains(regex)
-    df_proc.loc[mask,'NOMBRECLIENTE']='CONSUMIDOR FINAL'
+    if spec['consolidate_names'] and 'NOMBRECLIENTE' in df_proc.columns:
+        regex = re.compile(r'(?i)(cliente|consumidor).*finall?')
+        df_proc['NOMBRECLIENTE'] = df_proc['NOMBRECLIENTE'].astype(str)
+        mask = df_proc['NOMBRECLIENTE'].str.upper().isin([
+            'CLIENTE CLIENTE','CLIENTE UNO','CLIENTES VARIOS CLIENTES VARIOS','CONSUMIDOR FINAL'
+        ]) | df_proc['NOMBRECLIENTE'].str.contains(regex)
+        df_proc.loc[mask,'NOMBRECLIENTE']='CONSUMIDOR FINAL'
+    if resolve_identities:
+        df_proc = resolve_client_identities(df_proc)
 
     # clean doc type
-    df_proc['TIPO_DE_DOCUMENTO_CLEANED'] = clean_tipo_documento(df_proc['TIPO_DE_DOCUMENTO'])
+    if spec['clean_doc_type'] and 'TIPO_DE_DOCUMENTO' in df_proc.columns:
+        df_proc['TIPO_DE_DOCUMENTO'] = clean_tipo_documento(df_proc['TIPO_DE_DOCUMENTO'])
+
+    if index_out is not None and ROW_POS_COL in df_proc.columns:
+        index_out.update(build_drilldown_index(df_proc,spec['keys'],spec['label_col'],spec['id_col']))
 
     # aggregate
-    agg = {}
-    if mode in ['debito','credito']:
-        agg = {
-            'TIPO_DE_DOCUMENTO_CLEANED':'first','IDENTIFICACION':'first',
-            'PRIMER_APELLIDO':'first','SEGUNDO_APELLIDO':'first',
-            'PRIMER_NOMBRE':'first','OTROS_NOMBRES':'first',
-            'MontoBruto':'sum','Descuento':'sum','IVA':'sum'
-        }
+    if workers > 1:
+        df_grp = parallel_groupby(df_proc,keys,spec['agg'],workers=workers)
     else:
-        agg = {
-            'TIPO_DE_DOCUMENTO_CLEANED':'first','IDENTIFICACION':'first',
-            'PRIMER_APELLIDO':'first','SEGUNDO_APELLIDO':'first',
-            'PRIMER_NOMBRE':'first','OTROS_NOMBRES':'first',
-            'MontoBruto Positivo':'sum','MontoBruto Negativo':'sum',
-            'Descuento':'sum','IVA':'sum'
-        }
-    df_grp = df_proc.groupby('NOMBRECLIENTE',as_index=False).agg(agg)
-    df_grp = df_grp.rename(columns={
-        'TIPO_DE_DOCUMENTO_CLEANED':'TIPO DE DOCUMENTO','IVA':'Iva'
-    })
+        df_grp = df_proc.groupby(keys,as_index=False,observed=True).agg(spec['agg'])
+    df_grp = df_grp.rename(columns=spec['rename'])
 
     # subtract discount
     if subtract_discount:
-        df_grp['Descuento'] = pd.to_numeric(df_grp['Descuento'],errors='coerce').fillna(0).abs()
-        if mode in ['debito','credito']:
-            df_grp['MontoBruto'] = df_grp['MontoBruto'] - df_grp['Descuento']
-        else:
-            df_grp['MontoBruto Positivo'] = df_grp['MontoBruto Positivo'] - df_grp['Descuento']
-            df_grp['MontoBruto Negativo'] = df_grp['MontoBruto Negativo'] - df_grp['Descuento']
+        df_grp = apply_discount(df_grp,mode)
 
     # select final
     return df_grp[final_cols]
 
-if __name__=='__main__':
+def apply_discount(df_grp, mode):
+    """Aplica los ajustes de la especificación: resta el valor absoluto de Descuento de los montos."""
+    for col, targets in spec_for(mode)['adjustments']:
+        df_grp[col] = pd.to_numeric(df_grp[col],errors='coerce').fillna(0).abs()
+        for t in targets:
+            df_grp[t] = df_grp[t] - df_grp[col]
+    return df_grp
+
+def _pack_strings(values):
+    encoded = [str(v).encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def _unpack_strings(blob, offsets):
+    data = blob.tobytes()
+    return [data[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+def _pack_column(values):
+    """
+    Columna de filas de origen en forma guardable con np.savez (sin pickle):
+    numérica, booleana o de fecha tal cual; el resto como códigos int32 más
+    los valores distintos en un bloque UTF-8 (código -1 = vacío).
+    """
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biufM':
+        return {'values': values.to_numpy()}
+    codes, uniques = pd.factorize(values)
+    blob, off = _pack_strings(uniques)
+    return {'codes': codes.astype(np.int32), 'blob': blob, 'off': off}
+
+def _unpack_column(arrays, positions):
+    if 'values' in arrays:
+        return arrays['values'][positions]
+    uniques = np.array(_unpack_strings(arrays['blob'], arrays['off']) + [None], dtype=object)
+    return uniques[arrays['codes'][positions]]  # -1 toma el None final
+
+def build_drilldown_index(rows, keys, label_col='NOMBRECLIENTE', id_col='IDENTIFICACION'):
+    """
+    Índice columnar cliente -> filas de origen, a partir de las filas ya
+    filtradas y consolidadas: las filas de cada grupo quedan contiguas en
+    file_idx/rows y offsets[g]:offsets[g+1] delimita el grupo g. Cada grupo se
+    rotula con su label_col e id_col (las de la especificación; sin id_col, vacío),
+    guardados como un bloque UTF-8 más sus offsets. También
+    se guardan las filas mismas, columna por columna y en el mismo orden, para
+    que explain_client no tenga que volver a leer los libros.
+    """
+    codes = rows.groupby(keys, sort=True, observed=True).ngroup().to_numpy(np.int64)
+    valid = np.flatnonzero(codes >= 0)
+    order = valid[np.argsort(codes[valid], kind='stable')]
+    sorted_codes = codes[order]
+    n_groups = int(sorted_codes[-1]) + 1 if len(order) else 0
+    offsets = np.searchsorted(sorted_codes, np.arange(n_groups + 1)).astype(np.int64)
+    first = order[offsets[:-1]]
+    names_blob, names_off = _pack_strings(rows[label_col].to_numpy()[first])
+    ids_blob, ids_off = _pack_strings(rows[id_col].to_numpy()[first] if id_col else [''] * n_groups)
+    columns = [c for c in rows.columns if c not in (ROW_FILE_COL, ROW_POS_COL, SOURCE_COL)]
+    columns_blob, columns_off = _pack_strings(columns)
+    index = {
+        'offsets': offsets,
+        'file_idx': rows[ROW_FILE_COL].to_numpy(np.int32)[order],
+        'rows': rows[ROW_POS_COL].to_numpy(np.int64)[order],
+        'names_blob': names_blob, 'names_off': names_off,
+        'ids_blob': ids_blob, 'ids_off': ids_off,
+        'columns_blob': columns_blob, 'columns_off': columns_off,
+    }
+    for i, c in enumerate(columns):
+        for part, arr in _pack_column(rows[c].iloc[order]).items():
+            index[f'col{i}_{part}'] = arr
+    return index
+
+def index_path_for(report_path):
+    return os.path.splitext(report_path)[0] + INDEX_SUFFIX
+
+def save_drilldown_index(path, index, files):
+    """Guarda el índice junto a las rutas absolutas de los archivos de origen."""
+    files_blob, files_off = _pack_strings([os.path.abspath(f) for f in files])
+    np.savez(path, files_blob=files_blob, files_off=files_off, **index)
+    return path
+
+def explain_client(index_path, query, max_rows=None):
+    """
+    Filas de origen del cliente cuyo NOMBRECLIENTE (sin importar mayúsculas) o
+    IDENTIFICACION coincide con query, tal como entraron a la agregación; en una
+    especificación sin NOMBRECLIENTE entre las claves, su primera clave. Se leen
+    del propio índice (solo las posiciones del cliente), sin abrir los libros.
+    max_rows limita las filas por archivo.
+    """
+    with np.load(index_path) as z:
+        if 'columns_blob' not in z.files:
+            raise ValueError(f"El índice '{index_path}' no guarda las filas de origen (versión anterior); "
+                             "vuelva a generar el reporte con --indice")
+        names = _unpack_strings(z['names_blob'], z['names_off'])
+        ids = _unpack_strings(z['ids_blob'], z['ids_off'])
+        q = str(query).strip()
+        groups = [g for g in range(len(names)) if names[g].upper() == q.upper() or (ids[g] and ids[g] == q)]
+        if not groups:
+            return pd.DataFrame()
+        offsets = z['offsets']
+        positions = np.concatenate([np.arange(offsets[g], offsets[g+1]) for g in groups])
+        file_idx, excel_rows = z['file_idx'][positions], z['rows'][positions]
+        # por archivo y fila de Excel, como aparecen en los libros
+        order = np.lexsort((excel_rows, file_idx))
+        positions, file_idx, excel_rows = positions[order], file_idx[order], excel_rows[order]
+        if max_rows:
+            keep = np.concatenate([np.flatnonzero(file_idx == f)[:max_rows] for f in np.unique(file_idx)])
+            positions, file_idx, excel_rows = positions[keep], file_idx[keep], excel_rows[keep]
+        files = _unpack_strings(z['files_blob'], z['files_off'])
+        result = pd.DataFrame({'ARCHIVO': [os.path.basename(files[f]) for f in file_idx], 'FILA': excel_rows})
+        for i, c in enumerate(_unpack_strings(z['columns_blob'], z['columns_off'])):
+            prefix = f'col{i}_'
+            arrays = {k[len(prefix):]: z[k] for k in z.files if k.startswith(prefix)}
+            result[c] = _unpack_column(arrays, positions)
+    return result
+
+class ReportView:
+    """
+    Vista paginada de un reporte ya agregado para mostrarlo sin renderizar todas
+    las filas. El orden y la búsqueda se calculan una vez (posiciones numpy) y
+    cada página es solo un iloc sobre ellas, así que pedir otra página no vuelve
+    a ordenar ni a filtrar.
+    """
+    SEARCH_COLS = ('NOMBRECLIENTE', 'IDENTIFICACION')
+
+    def __init__(self, df, page_size=50):
+        self.df = df
+        self.page_size = page_size
+        self.sort_column = None
+        self.descending = False
+        self.query = ''
+        self._order = np.arange(len(df))
+        self._haystack = None
+        self._rows = self._order
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def pages(self):
+        return max(1, -(-len(self._rows) // self.page_size))
+
+    def sort(self, column, descending=False):
+        """Ordena por column (estable, vacíos al final); None vuelve al orden original."""
+        self.sort_column, self.descending = column, descending
+        if column is None:
+            self._order = np.arange(len(self.df))
+        else:
+            values = pd.Series(self.df[column].to_numpy())
+            try:
+                self._order = values.sort_values(ascending=not descending, kind='stable',
+                                                 na_position='last').index.to_numpy()
+            except TypeError:
+                # columna object con tipos mezclados (p. ej. identificaciones str e int): se ordena como texto
+                values = values.astype(str).where(values.notna())
+                self._order = values.sort_values(ascending=not descending, kind='stable',
+                                                 na_position='last').index.to_numpy()
+        self._apply()
+
+    def search(self, text):
+        """Filtra por texto contenido en NOMBRECLIENTE o IDENTIFICACION (sin distinguir mayúsculas)."""
+        self.query = str(text or '').strip().upper()
+        self._apply()
+
+    def _apply(self):
+        if not self.query:
+            self._rows = self._order
+            return
+        if self._haystack is None:
+            # columnas de búsqueda en mayúsculas, calculadas una sola vez
+            self._haystack = [self.df[c].astype(str).str.upper().to_numpy()
+                              for c in self.SEARCH_COLS if c in self.df.columns]
+        mask = np.zeros(len(self.df), dtype=bool)
+        for col in self._haystack:
+            mask |= pd.Series(col).str.contains(self.query, regex=False).to_numpy()
+        self._rows = self._order[mask[self._order]]
+
+    def page(self, number):
+        """Filas de la página number (desde 0), limitada al rango válido."""
+        number = min(max(number, 0), self.pages - 1)
+        start = number * self.page_size
+        return self.df.iloc[self._rows[start:start + self.page_size]]
+
+def read_report(path):
+    """
+    Carga un reporte para compararlo: .xlsx (todas las hojas, por si se repartió
+    por límite de filas) o un agregado guardado como .pkl / .csv.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.pkl','.pickle'):
+        return pd.read_pickle(path)
+    if ext == '.csv':
+        return pd.read_csv(path, dtype={'IDENTIFICACION': str})
+    sheets = pd.read_excel(path, sheet_name=None, engine='openpyxl')
+    return pd.concat(sheets.values(), ignore_index=True)
+
+def diff_reports(old, new, keys=None, tolerance=0.005):
+    """
+    Compara dos reportes cruzándolos por la clave del cliente (merge por hash).
+    Devuelve una fila por cliente nuevo, eliminado o con algún monto distinto en
+    más de tolerance, con las columnas '<monto> anterior', '<monto> actual' y
+    '<monto> delta'. Sin keys se usa NOMBRECLIENTE, y NOMBRECLIENTE +
+    IDENTIFICACION si el nombre se repite (reportes de la interfaz).
+    """
+    if keys is None:
+        keys = ['NOMBRECLIENTE']
+        if all('IDENTIFICACION' in df.columns for df in (old, new)) and \
+                any(df.duplicated(keys).any() for df in (old, new)):
+            keys = ['NOMBRECLIENTE','IDENTIFICACION']
+    keys = list(keys)
+    for df in (old, new):
+        missing = [k for k in keys if k not in df.columns]
+        if missing:
+            raise ValueError(f"Faltan columnas de la clave: {missing}")
+    measures = [c for c in NUMERIC_FINAL_COLS if c in old.columns and c in new.columns]
+    if not measures:
+        raise ValueError("Los reportes no tienen columnas de montos en común (¿modos distintos?)")
+
+    def prepare(df):
+        out = pd.DataFrame({k: df[k].astype(str).str.strip() for k in keys})
+        for c in measures:
+            out[c] = pd.to_numeric(df[c], errors='coerce').fillna(0)
+        if out.duplicated(keys).any():
+            out = out.groupby(keys, as_index=False, sort=False).sum()
+        return out
+
+    merged = prepare(old).merge(prepare(new), on=keys, how='outer',
+                                suffixes=(' anterior',' actual'), indicator=True)
+    cols = []
+    for c in measures:
+        before, after = f'{c} anterior', f'{c} actual'
+        merged[f'{c} delta'] = merged[after].fillna(0) - merged[before].fillna(0)
+        cols += [before, after, f'{c} delta']
+    changed = (merged[[f'{c} delta' for c in measures]].abs() > tolerance).any(axis=1)
+    state = np.select([merged['_merge'] == 'right_only', merged['_merge'] == 'left_only', changed],
+                      list(DIFF_STATES), default='')
+    merged.insert(0, 'ESTADO', state)
+    result = merged.loc[merged['ESTADO'] != '', ['ESTADO'] + keys + cols]
+    order = pd.Categorical(result['ESTADO'], categories=DIFF_STATES)
+    return result.assign(ESTADO=order).sort_values(['ESTADO'] + keys, ignore_index=True)
+
+def save_diff(diff, path):
+    """Guarda las diferencias: .csv en un solo archivo, .xlsx con una hoja por estado."""
+    if path.lower().endswith('.csv'):
+        diff.to_csv(path, index=False)
+        return path
+    with pd.ExcelWriter(path, engine='xlsxwriter') as w:
+        for state in DIFF_STATES:
+            part = diff[diff['ESTADO'] == state].drop(columns='ESTADO')
+            for i in range(0, max(len(part), 1), EXCEL_MAX_ROWS-1):
+                suffix = f"_{i//(EXCEL_MAX_ROWS-1)+1}" if len(part) > EXCEL_MAX_ROWS-1 else ''
+                part.iloc[i:i+EXCEL_MAX_ROWS-1].to_excel(w, index=False, sheet_name=f"{state}{suffix}")
+    return path
+
+def _sql_name(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def open_store(path=STORE_PATH):
+    """
+    Abre (o crea) el almacén de reportes. Cada fila de 'reportes' es un cliente
+    de una corrida; los montos son columnas REAL que se agregan al guardar el
+    primer reporte que las usa, cada una con índices (modo, monto) y
+    (modo, corrida, monto) para filtrar y ordenar sin recorrer la tabla.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    con = sqlite3.connect(path)
+    keys = ', '.join(f'{_sql_name(k)} TEXT' for k in STORE_KEYS)
+    con.executescript(f"""
+        CREATE TABLE IF NOT EXISTS corridas (
+            corrida INTEGER PRIMARY KEY, fecha TEXT, modo TEXT, archivos TEXT, descuento INTEGER, filas INTEGER);
+        CREATE TABLE IF NOT EXISTS reportes (corrida INTEGER, modo TEXT, {keys});
+        CREATE INDEX IF NOT EXISTS reportes_cliente
+            ON reportes (modo, corrida, NOMBRECLIENTE, IDENTIFICACION);
+        CREATE INDEX IF NOT EXISTS reportes_identificacion ON reportes (IDENTIFICACION);
+    """)
+    return con
+
+def _store_measures(con):
+    return [r[1] for r in con.execute('PRAGMA table_info(reportes)')
+            if r[1] not in ['corrida', 'modo'] + STORE_KEYS]
+
+def _store_key(value):
+    """
+    Texto con que se guarda una clave: las identificaciones leídas como float
+    (columna con alguna celda vacía) se guardan sin '.0', igual que las enteras.
+    """
+    if pd.isna(value):
+        return None
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+def store_report(df, mode, files=(), subtract_discount=False, per_source=None, path=STORE_PATH):
+    """
+    Guarda el reporte agregado (formato largo) como una corrida nueva del
+    almacén; los reportes por origen van con SOURCE_COL y el consolidado sin él.
+    Devuelve el número de corrida; ValueError si el modo no es por cliente
+    (ver require_client_report).
+    """
+    require_client_report(mode)
+    measures = [c for c in spec_for(mode)['measures'] if c in df.columns]
+    frames = [df] + [part.assign(**{SOURCE_COL: source}) for source, part in (per_source or {}).items()]
+    con = open_store(path)
+    try:
+        with con:
+            existing = _store_measures(con)
+            for m in measures:
+                if m not in existing:
+                    con.execute(f'ALTER TABLE reportes ADD COLUMN {_sql_name(m)} REAL')
+                con.execute(f'CREATE INDEX IF NOT EXISTS {_sql_name("reportes_" + m)} '
+                            f'ON reportes (modo, {_sql_name(m)})')
+                con.execute(f'CREATE INDEX IF NOT EXISTS {_sql_name("reportes_corrida_" + m)} '
+                            f'ON reportes (modo, corrida, {_sql_name(m)})')
+            run = con.execute('INSERT INTO corridas (fecha, modo, archivos, descuento, filas) VALUES (?,?,?,?,?)',
+                              (time.strftime('%Y-%m-%d %H:%M:%S'), mode,
+                               json.dumps([os.path.basename(f) for f in files], ensure_ascii=False),
+                               int(bool(subtract_discount)), len(df))).lastrowid
+            cols = STORE_KEYS + measures
+            sql = (f"INSERT INTO reportes (corrida, modo, {', '.join(_sql_name(c) for c in cols)}) "
+                   f"VALUES (?, ?, {', '.join('?' * len(cols))})")
+            for frame in frames:
+                rows = frame.reindex(columns=cols)
+                rows[STORE_KEYS] = rows[STORE_KEYS].map(_store_key)
+                con.executemany(sql, ((run, mode) + r for r in rows.itertuples(index=False, name=None)))
+    finally:
+        con.close()
+    return run
+
+def list_runs(path=STORE_PATH):
+    """Corridas guardadas en el almacén, la más reciente primero."""
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=['corrida', 'fecha', 'modo', 'archivos', 'descuento', 'filas'])
+    con = sqlite3.connect(path)
+    try:
+        return pd.read_sql_query('SELECT * FROM corridas ORDER BY corrida DESC', con)
+    finally:
+        con.close()
+
+def query_store(mode=None, measure=None, minimum=None, maximum=None, client=None, run='ultima',
+                top=None, ascending=False, source=None, path=STORE_PATH):
+    """
+    Consulta el almacén: clientes de la última corrida (run='ultima', del modo si
+    se indica), de una corrida concreta (número) o de todas ('todas'). measure
+    filtra por [minimum, maximum] y ordena (de mayor a menor salvo ascending);
+    client busca por parte del nombre o por identificación exacta. Sin source se
+    consultan los consolidados; con source, el reporte de ese origen.
+    """
+    if not os.path.exists(path):
+        raise ValueError(f"No hay almacén de reportes en '{path}' (use --almacen al generar un reporte)")
+    con = sqlite3.connect(path)
+    try:
+        measures = _store_measures(con)
+        if measure is not None and measure not in measures:
+            raise ValueError(f"Monto desconocido: {measure}. Disponibles: {measures}")
+        where, params = [], []
+        if mode:
+            where.append('r.modo = ?')
+            params.append(mode)
+        if run == 'ultima':
+            where.append('r.corrida = (SELECT MAX(corrida) FROM corridas' + (' WHERE modo = ?)' if mode else ')'))
+            params += [mode] if mode else []
+        elif run not in (None, 'todas'):
+            where.append('r.corrida = ?')
+            params.append(int(run))
+        if source is None:
+            where.append(f'r.{_sql_name(SOURCE_COL)} IS NULL')
+        else:
+            where.append(f'r.{_sql_name(SOURCE_COL)} = ?')
+            params.append(source)
+        if client:
+            where.append('(r.NOMBRECLIENTE LIKE ? OR r.IDENTIFICACION = ?)')
+            params += [f'%{client}%', _store_key(client)]
+        if measure is not None and minimum is not None:
+            where.append(f'r.{_sql_name(measure)} >= ?')
+            params.append(minimum)
+        if measure is not None and maximum is not None:
+            where.append(f'r.{_sql_name(measure)} <= ?')
+            params.append(maximum)
+        order = (f"r.{_sql_name(measure)} {'ASC' if ascending else 'DESC'}" if measure is not None
+                 else 'r.corrida DESC, r.NOMBRECLIENTE')
+        cols = ', '.join(f'r.{_sql_name(c)}' for c in STORE_KEYS + measures)
+        sql = (f"SELECT r.corrida AS CORRIDA, c.fecha AS FECHA, r.modo AS MODO, {cols} "
+               f"FROM reportes r JOIN corridas c ON c.corrida = r.corrida "
+               f"WHERE {' AND '.join(where)} ORDER BY {order}" + (' LIMIT ?' if top else ''))
+        result = pd.read_sql_query(sql, con, params=params + ([int(top)] if top else []))
+    finally:
+        con.close()
+    return result.dropna(axis=1, how='all') if not result.empty else result
+
+# Filas y fragmentos de parallel_groupby que heredan los procesos creados con fork
+_SHARDS = None
+
+def _groupby_shard(part, keys, agg):
+    if isinstance(part, int):
+        frame, order, bounds = _SHARDS
+        part = frame.iloc[order[bounds[part]:bounds[part + 1]]]
+    return part.groupby(keys, as_index=False, sort=False, observed=True).agg(agg)
+
+def parallel_groupby(df, keys, agg, workers=None):
+    """
+    Equivalente a df.groupby(keys, as_index=False, observed=True).agg(agg),
+    repartido en varios procesos. Las filas se reparten por un hash de los
+    valores crudos de la clave (sin factorizar antes: esa era la parte serial),
+    así cada grupo queda entero en un fragmento; cada proceso agrupa su fragmento
+    y los resultados se concatenan y ordenan por la clave como lo haría groupby.
+    En Linux los procesos se crean con fork y leen las filas heredadas, sin
+    serializarlas; en otros sistemas cada fragmento se envía al proceso.
+    Con pocos datos o un solo proceso usa el groupby normal de pandas.
+    """
+    global _SHARDS
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(df) < PARALLEL_MIN_ROWS:
+        return df.groupby(keys, as_index=False, observed=True).agg(agg)
+
+    frame = df[list(dict.fromkeys(list(keys) + list(agg)))]
+    shard = pd.util.hash_pandas_object(df[keys], index=False).to_numpy() % np.uint64(workers)
+    # orden estable dentro de cada fragmento: 'first' ve las filas en el orden original
+    order = np.argsort(shard, kind='stable')
+    bounds = np.searchsorted(shard[order], np.arange(workers + 1, dtype=np.uint64))
+    shards = [i for i in range(workers) if bounds[i + 1] > bounds[i]]
+    fork = sys.platform.startswith('linux') and 'fork' in multiprocessing.get_all_start_methods()
+    if fork:
+        _SHARDS, parts = (frame, order, bounds), shards
+    else:
+        parts = [frame.iloc[order[bounds[i]:bounds[i + 1]]] for i in shards]
+    try:
+        with ProcessPoolExecutor(max_workers=len(parts),
+                                 mp_context=multiprocessing.get_context('fork') if fork else None) as ex:
+            results = list(ex.map(_groupby_shard, parts, [keys] * len(parts), [agg] * len(parts)))
+    finally:
+        _SHARDS = None
+    out = pd.concat(results, ignore_index=True)
+    return out.sort_values(list(keys), kind='stable', ignore_index=True)
+
+def _write_partition(path, part, sheet_name):
+    with pd.ExcelWriter(path,engine='xlsxwriter') as w:
+        part.to_excel(w,index=False,sheet_name=sheet_name)
+    return path
+
+def save_report(df, out_path, mode, sheet_name=None, split_into='sheets', max_rows=EXCEL_MAX_ROWS-1):
+    """
+    Guarda el reporte en Excel. Si supera el límite de filas por hoja lo reparte
+    en varias hojas del mismo libro (split_into='sheets') o en varios archivos
+    escritos en paralelo (split_into='files'). Todas las particiones llevan los
+    encabezados de FINAL_COLS del modo. Devuelve la lista de rutas escritas.
+    """
+    if split_into not in ('sheets','files'):
+        raise ValueError(f"Tipo de partición inválido: {split_into}")
+    cols = FINAL_COLS.get(mode, list(df.columns))
+    # PERIOD_COL va delante y las columnas por periodo (formato ancho) al final
+    extra = [c for c in df.columns if c not in cols and c not in (SOURCE_COL, ROW_FILE_COL, ROW_POS_COL)]
+    cols = [c for c in extra if c == PERIOD_COL] + cols + [c for c in extra if c != PERIOD_COL]
+    if list(df.columns) != cols:
+        df = df.reindex(columns=cols)
+    sheet_name = sheet_name or mode
+    n_parts = max(1, -(-len(df)//max_rows))
+    if n_parts == 1:
+        return [_write_partition(out_path, df, sheet_name)]
+
+    parts = [df.iloc[i*max_rows:(i+1)*max_rows] for i in range(n_parts)]
+    if split_into == 'sheets':
+        # xlsxwriter escribe un libro de forma secuencial: hojas una tras otra
+        with pd.ExcelWriter(out_path,engine='xlsxwriter') as w:
+            for i, part in enumerate(parts):
+                part.to_excel(w,index=False,sheet_name=f"{sheet_name}_{i+1}")
+        return [out_path]
+
+    base, ext = os.path.splitext(out_path)
+    paths = [f"{base}_parte{i+1}{ext}" for i in range(n_parts)]
+    workers = min(n_parts, os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(_write_partition, paths, parts, [sheet_name]*n_parts))
+
+def _col_index(letters):
+    n = 0
+    for ch in letters:
+        n = n*26 + ord(ch) - 64
+    return n
+
+def sheet_ref(path, sheet):
+    return SHEET_REF.format(path=path, sheet=sheet)
+
+def split_sheet_ref(ref):
+    """'libro.xlsx[Hoja]' -> ('libro.xlsx', 'Hoja'); una ruta simple -> (ruta, None), es decir la primera hoja."""
+    if ref.endswith(']') and '[' in ref:
+        path, sheet = ref[:-1].rsplit('[', 1)
+        return path, sheet
+    return ref, None
+
+def _sheet_members(zf):
+    """[(nombre de hoja, ruta dentro del zip)] en el orden del libro."""
+    ns = {'m': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+          'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'}
+    try:
+        targets = {rel.get('Id'): rel.get('Target').lstrip('/')
+                   for rel in ET.fromstring(zf.read('xl/_rels/workbook.xml.rels'))}
+        members = []
+        for sheet in ET.fromstring(zf.read('xl/workbook.xml')).findall('m:sheets/m:sheet', ns):
+            target = targets[sheet.get(f"{{{ns['r']}}}id")]
+            members.append((sheet.get('name'), target if target.startswith('xl/') else 'xl/' + target))
+        if members:
+            return members
+    except (KeyError, AttributeError, ET.ParseError):
+        pass
+    return [(None, 'xl/worksheets/sheet1.xml')]
+
+def _sheet_member(zf, sheet=None):
+    """Ruta dentro del zip de la hoja indicada, o de la primera (la que lee pd.read_excel)."""
+    members = _sheet_members(zf)
+    if sheet is None:
+        return members[0][1]
+    for name, member in members:
+        if name == sheet:
+            return member
+    raise KeyError(f"El libro no tiene la hoja '{sheet}'")
+
+def list_sheets(path):
+    """Nombres de las hojas del libro, en orden."""
+    with zipfile.ZipFile(path) as zf:
+        return [name for name, _ in _sheet_members(zf)]
+
+def inspect_workbook(path):
+    """
+    Filas y columnas de la primera hoja (o de la hoja de una referencia
+    'libro.xlsx[Hoja]') según su etiqueta <dimension>, más los tamaños
+    comprimido y descomprimido de la hoja, sin leer los datos.
+    Si el libro no trae dimensión las filas se estiman por el tamaño del XML.
+    """
+    book, sheet = split_sheet_ref(path)
+    with zipfile.ZipFile(book) as zf:
+        info = zf.getinfo(_sheet_member(zf, sheet))
+        with zf.open(info) as f:
+            head = f.read(64*1024)
+    m = re.search(rb'<(?:\w+:)?dimension[^>]*ref="([A-Z]+)(\d+):([A-Z]+)(\d+)"', head)
+    if m:
+        rows = max(int(m.group(4)) - int(m.group(2)), 0)  # sin encabezado
+        cols = _col_index(m.group(3).decode()) - _col_index(m.group(1).decode()) + 1
+    else:
+        cols = 11
+        rows = info.file_size // (cols*40)
+    return {'path': path, 'rows': rows, 'cols': cols, 'exact': bool(m),
+            'compressed': info.compress_size, 'xml_size': info.file_size}
+
+_CELL_RE = re.compile(rb'<(?:\w+:)?c\b([^>]*?)(?:/>|>(.*?)</(?:\w+:)?c>)', re.S)
+_VALUE_RE = re.compile(rb'<(?:\w+:)?(?:v|t)(?:\s[^>]*)?>(.*?)</(?:\w+:)?(?:v|t)>', re.S)
+_ATTR_RE = re.compile(rb'\b(r|t|s)="([^"]*)"')
+_ROW_RE = re.compile(rb'<(?:\w+:)?row\b[^>]*?(?:/>|>(.*?)</(?:\w+:)?row>)', re.S)
+_ROW_END_RE = re.compile(rb'</(?:\w+:)?row>')
+# numFmtId integrados de Excel que son fechas
+_DATE_FORMAT_IDS = set(range(14, 23)) | set(range(45, 48))
+
+def _shared_strings(zf, needed):
+    """Textos de sharedStrings.xml hasta el mayor índice necesario, sin leer el resto."""
+    ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+    out = {}
+    if not needed or 'xl/sharedStrings.xml' not in zf.namelist():
+        return out
+    last = max(needed)
+    with zf.open('xl/sharedStrings.xml') as f:
+        i = 0
+        for _, el in ET.iterparse(f):
+            if el.tag == ns + 'si':
+                if i in needed:
+                    out[i] = ''.join(t.text or '' for t in el.iter(ns + 't'))
+                el.clear()
+                i += 1
+                if i > last:
+                    break
+    return out
+
+def read_header(path):
+    """Nombres de columna de la primera fila de la hoja, leyendo solo el inicio del XML."""
+    book, sheet = split_sheet_ref(path)
+    with zipfile.ZipFile(book) as zf:
+        head = b''
+        with zf.open(_sheet_member(zf, sheet)) as f:
+            while True:
+                block = f.read(64*1024)
+                head += block
+                if not block or re.search(rb'</(?:\w+:)?row>', head):
+                    break
+        m = re.search(rb'<(?:\w+:)?row\b[^>]*?(?:/>|>(.*?)</(?:\w+:)?row>)', head, re.S)
+        if not m or not m.group(1):
+            return []
+        cells = []
+        for attrs, inner in _CELL_RE.findall(m.group(1)):
+            a = dict(_ATTR_RE.findall(attrs))
+            col = _col_index(re.match(rb'[A-Z]+', a.get(b'r', b'A')).group().decode())
+            texts = _VALUE_RE.findall(inner or b'')
+            value = ''.join(t.decode('utf-8') for t in texts)
+            cells.append((col, a.get(b't'), value))
+        shared = _shared_strings(zf, {int(v) for _, t, v in cells if t == b's' and v})
+    header = []
+    for col, t, value in cells:
+        header.extend([None] * (col - 1 - len(header)))
+        if t == b's' and value:
+            value = shared.get(int(value), value)
+        header.append(html.unescape(value))
+    return header
+
+def validate_headers(files, required=REQUIRED_COLS, workers=None):
+    """
+    Revisa en paralelo el encabezado de cada libro contra las columnas requeridas.
+    Devuelve {archivo: problema} solo para los archivos con problemas.
+    """
+    def check(path):
+        try:
+            header = read_header(path)
+        except (zipfile.BadZipFile, KeyError, ET.ParseError, OSError) as e:
+            return f"No se pudo leer el encabezado: {e}"
+        missing = [c for c in required if c not in header]
+        return f"Faltan columnas requeridas: {missing}" if missing else None
+
+    with ThreadPoolExecutor(max_workers=workers or min(len(files), 8) or 1) as ex:
+        results = list(ex.map(check, files))
+    return {f: r for f, r in zip(files, results) if r}
+
+def find_sheets(files, required=REQUIRED_COLS, pattern=None, workers=None):
+    """
+    Expande cada libro a sus hojas con las columnas requeridas (y cuyo nombre
+    coincide con pattern, p. ej. 'Caja*', sin distinguir mayúsculas). Cada hoja
+    queda como una referencia 'libro.xlsx[Hoja]' que se lee como un archivo más;
+    los libros de una sola hoja siguen como ruta simple. Los encabezados se
+    revisan en paralelo. Devuelve (referencias, {referencia: motivo} de las descartadas).
+    """
+    candidates = []
+    for f in files:
+        try:
+            names = list_sheets(f)
+        except (zipfile.BadZipFile, KeyError, ET.ParseError, OSError):
+            candidates.append(f)  # validate_headers informa el problema
+            continue
+        if names == [None]:
+            candidates.append(f)  # sin workbook.xml legible: solo la primera hoja
+            continue
+        if len(names) == 1 and (not pattern or fnmatch.fnmatch(names[0].lower(), pattern.lower())):
+            candidates.append(f)
+        else:
+            candidates += [sheet_ref(f, n) for n in names
+                           if not pattern or fnmatch.fnmatch(n.lower(), pattern.lower())]
+    problems = validate_headers(candidates, required=required, workers=workers) if candidates else {}
+    return [c for c in candidates if c not in problems], problems
+
+def _date_styles(zf):
+    """Índices de estilo de celda (atributo s) cuyo formato numérico es una fecha."""
+    ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+    try:
+        root = ET.fromstring(zf.read('xl/styles.xml'))
+    except (KeyError, ET.ParseError):
+        return set()
+    # formatos propios con d o y fuera de literales ("...") y de [colores]/[condiciones]
+    formats = _DATE_FORMAT_IDS | {int(f.get('numFmtId')) for f in root.iter(ns + 'numFmt')
+                                  if re.search(r'[dy]', re.sub(r'"[^"]*"|\[[^\]]*\]', '',
+                                                               f.get('formatCode', '').lower()))}
+    xfs = root.find(ns + 'cellXfs')
+    return {i for i, xf in enumerate(xfs.findall(ns + 'xf') if xfs is not None else [])
+            if int(xf.get('numFmtId', 0)) in formats}
+
+def _sample_row_xml(f, size, windows, per_window, block=1024*1024):
+    """
+    XML de per_window filas desde cada una de 'windows' posiciones repartidas
+    por tamaño a lo largo de la hoja, sin el encabezado. Se descomprime todo el
+    XML (barato) pero solo se interpretan las filas elegidas. Devuelve
+    (filas, bytes de XML por fila en la muestra).
+    """
+    targets = [size * i // windows for i in range(windows)]
+    rows, row_bytes, pending, base, w, taken, header = [], 0, b'', 0, 0, 0, True
+    while w < windows:
+        data = f.read(block)
+        pending += data
+        if data:
+            # solo se interpretan filas completas; el resto espera al siguiente bloque
+            ends = [m.end() for m in _ROW_END_RE.finditer(pending, max(len(pending) - len(data) - 16, 0))]
+            if not ends:
+                continue
+            cut = ends[-1]
+        else:
+            cut = len(pending)
+        chunk, pending = pending[:cut], pending[cut:]
+        pos = 0
+        while w < windows and targets[w] - base < len(chunk):
+            for m in _ROW_RE.finditer(chunk, max(targets[w] - base, pos)):
+                pos = m.end()
+                if header:
+                    header = False
+                    continue
+                rows.append(m.group(1) or b'')
+                row_bytes += m.end() - m.start()
+                taken += 1
+                if taken == per_window:
+                    w, taken = w + 1, 0
+                    break
+            else:
+                break  # la ventana sigue en el próximo bloque
+        base += len(chunk)
+        if not data:
+            break
+    return rows, (row_bytes / len(rows) if rows else 0)
+
+def _cell_value(t, style, value, shared, date_styles):
+    """Valor de una celda como lo entrega openpyxl: texto, número, booleano o fecha."""
+    if t == b's':
+        return shared.get(int(value)) if value else None
+    if t in (b'inlineStr', b'str'):
+        return html.unescape(value)
+    if not value or t == b'e':
+        return None
+    if t == b'b':
+        return value == '1'
+    number = float(value) if re.search(r'[.eE]', value) else int(value)
+    if style in date_styles:
+        return pd.Timestamp('1899-12-30') + pd.to_timedelta(number, unit='D')
+    return number
+
+def sample_workbook(path, rows=SAMPLE_ROWS, windows=SAMPLE_WINDOWS):
+    """
+    Muestra estratificada de la hoja (o de 'libro.xlsx[Hoja]'): hasta rows filas
+    tomadas en 'windows' ventanas repartidas a lo largo del XML, para que un libro
+    ordenado por fecha o por cliente no quede representado solo por su inicio.
+    Devuelve (DataFrame con las columnas del encabezado, filas estimadas de la hoja).
+    """
+    book, sheet = split_sheet_ref(path)
+    header = [str(h) if h is not None else f'Unnamed: {i}' for i, h in enumerate(read_header(path))]
+    info = inspect_workbook(path)
+    with zipfile.ZipFile(book) as zf:
+        member = _sheet_member(zf, sheet)
+        with zf.open(member) as f:
+            xml_rows, row_bytes = _sample_row_xml(f, zf.getinfo(member).file_size, windows,
+                                                  max(rows // windows, 1))
+        cells = []
+        for inner in xml_rows:
+            row, col = [], 0
+            for attrs, content in _CELL_RE.findall(inner):
+                a = dict(_ATTR_RE.findall(attrs))
+                ref = re.match(rb'[A-Z]+', a[b'r']) if b'r' in a else None
+                col = _col_index(ref.group().decode()) if ref else col + 1
+                value = ''.join(t.decode('utf-8') for t in _VALUE_RE.findall(content or b''))
+                row.append((col, a.get(b't'), int(a.get(b's', 0)), value))
+            cells.append(row)
+        shared = _shared_strings(zf, {int(v) for row in cells for _, t, _, v in row if t == b's' and v})
+        date_styles = _date_styles(zf)
+    data = []
+    for row in cells:
+        values = [None] * len(header)
+        for col, t, style, value in row:
+            if col <= len(header):
+                values[col - 1] = _cell_value(t, style, value, shared, date_styles)
+        if any(v is not None for v in values):
+            data.append(values)
+    # sin <dimension> se estima con el tamaño medio de las filas de la muestra
+    total = info['rows'] if info['exact'] or not row_bytes else int(info['xml_size'] / row_bytes)
+    return pd.DataFrame(data, columns=header), max(total, len(data))
+
+def available_memory():
+    """Memoria disponible en bytes (MemAvailable en Linux; si no, la mitad de la RAM o 4 GB)."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024**3
+
+def plan_execution(files, strategy=None, memory=None):
+    """
+    Elige cómo procesar el lote antes de leerlo:
+      memoria   -> pd.read_excel + pd.concat + groupby (lo más rápido si cabe)
+      streaming -> lectura por bloques y agregación parcial; en memoria solo los parciales
+      disco     -> como streaming, pero los parciales se reparten por hash en archivos temporales
+    strategy fuerza una estrategia concreta.
+    """
+    if strategy not in (None,'auto') + STRATEGIES:
+        raise ValueError(f"Estrategia inválida: {strategy}")
+    books = [inspect_workbook(f) for f in files]
+    rows = sum(b['rows'] for b in books)
+    frame_bytes = sum(b['rows']*b['cols'] for b in books) * BYTES_PER_CELL
+    peak = frame_bytes * PANDAS_PEAK_FACTOR
+    memory = memory or available_memory()
+    budget = memory * MEMORY_SAFETY
+    if strategy in STRATEGIES:
+        chosen = strategy
+    elif peak <= budget:
+        chosen = 'memoria'
+    elif frame_bytes <= budget:
+        # en el peor caso hay un parcial por fila, con una sola copia a la vez
+        chosen = 'streaming'
+    else:
+        chosen = 'disco'
+    return {'strategy': chosen, 'forced': strategy in STRATEGIES, 'rows': rows,
+            'frame_bytes': frame_bytes, 'peak_bytes': peak, 'memory': memory,
+            'exact': all(b['exact'] for b in books), 'books': books}
+
+def describe_plan(plan):
+    gb = 1024**3
+    return (f"Plan: {plan['strategy']}{' (forzado)' if plan['forced'] else ''} — "
+            f"{'' if plan['exact'] else '~'}{plan['rows']} filas, "
+            f"~{plan['frame_bytes']/gb:.2f} GB de datos, pico en memoria ~{plan['peak_bytes']/gb:.2f} GB, "
+            f"disponibles {plan['memory']/gb:.2f} GB")
+
+def iter_workbook_chunks(path, chunk_rows=STREAM_CHUNK_ROWS):
+    """Lee la primera hoja (o la de 'libro.xlsx[Hoja]') en modo read_only y la entrega en DataFrames de chunk_rows filas."""
+    book, sheet = split_sheet_ref(path)
+    wb = openpyxl.load_workbook(book, read_only=True, data_only=True)
+    try:
+        rows = (wb[sheet] if sheet else wb.worksheets[0]).iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(h) if h is not None else f'Unnamed: {i}' for i, h in enumerate(header)]
+        width = len(header)
+        buf = []
+        for r in rows:
+            if not any(v is not None for v in r):
+                continue
+            buf.append((tuple(r) + (None,)*width)[:width])
+            if len(buf) >= chunk_rows:
+                yield pd.DataFrame(buf, columns=header)
+                buf = []
+        if buf:
+            yield pd.DataFrame(buf, columns=header)
+    finally:
+        wb.close()
+
+def combine_partials(partials, mode, keys):
+    """Reagrupa resultados parciales (ya en columnas finales): suma montos y toma el primer valor del resto."""
+    cols = [k for k in keys if k not in FINAL_COLS[mode]] + FINAL_COLS[mode]
+    measures = spec_for(mode)['measures']
+    agg = {c: ('sum' if c in measures else 'first') for c in cols if c not in keys}
+    df = pd.concat(partials, ignore_index=True)
+    return df.groupby(keys, as_index=False, sort=True, observed=True).agg(agg)[cols]
+
+def aggregate_in_chunks(files, mode, process_chunk, keys, spill=False,
+                        chunk_rows=STREAM_CHUNK_ROWS, buckets=SPILL_BUCKETS, tag_source=False, controls_out=None):
+    """
+    Agregación por bloques: process_chunk convierte cada bloque leído en un
+    resultado parcial con las columnas finales del modo, y los parciales se
+    combinan con combine_partials. Con spill=True los parciales se reparten por
+    hash de la clave en archivos temporales y cada cubeta se combina por separado,
+    así nunca están todos en memoria a la vez. Con tag_source cada bloque lleva
+    la columna SOURCE_COL de su archivo. controls_out (lista) recibe los totales
+    de control de cada bloque.
+    """
+    empty = pd.DataFrame(columns=[k for k in keys if k not in FINAL_COLS[mode]] + FINAL_COLS[mode])
+
+    def chunks():
+        labels = source_labels(files)
+        for f, label in zip(files, labels):
+            for chunk in iter_workbook_chunks(f, chunk_rows):
+                if controls_out is not None:
+                    controls_out.append(control_totals(chunk, label))
+                if tag_source:
+                    chunk[SOURCE_COL] = pd.Categorical([label]*len(chunk), categories=labels)
+                yield chunk
+
+    if not spill:
+        partials = []
+        for chunk in chunks():
+            partials.append(process_chunk(chunk))
+            # compactar para que la memoria dependa de los clientes, no de las filas
+            if len(partials) >= 8:
+                partials = [combine_partials(partials, mode, keys)]
+        return combine_partials(partials, mode, keys) if partials else empty
+
+    with tempfile.TemporaryDirectory(prefix='docuflow_spill_') as tmp:
+        paths = [os.path.join(tmp, f'cubeta_{i:03d}.pkl') for i in range(buckets)]
+        handles = [open(p, 'wb') for p in paths]
+        try:
+            for chunk in chunks():
+                part = process_chunk(chunk)
+                bucket = pd.util.hash_pandas_object(part[keys], index=False).to_numpy() % buckets
+                for i, grp in part.groupby(bucket, sort=False):
+                    pickle.dump(grp, handles[i], protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            for h in handles:
+                h.close()
+        results = []
+        for p in paths:
+            partials = []
+            with open(p, 'rb') as h:
+                while True:
+                    try:
+                        partials.append(pickle.load(h))
+                    except EOFError:
+                        break
+            if partials:
+                results.append(combine_partials(partials, mode, keys))
+    if not results:
+        return empty
+    return pd.concat(results, ignore_index=True).sort_values(keys, kind='stable', ignore_index=True)
+
+def process_files(files, mode, subtract_discount=False, workers=1, resolve_identities=False, plan=None,
+                  by_source=False, index_out=None, checkpoint_dir=None, resume=False, controls_out=None,
+                  period=None, date_col=DATE_COL):
+    """
+    Procesa los archivos con la estrategia del plan (por defecto la elegida por
+    plan_execution). Con by_source agrupa por (SOURCE_COL, cliente) y el
+    resultado incluye esa columna; el descuento se aplica después con split_by_source.
+    Con period agrupa además por PERIOD_COL (ver add_period_column), en la misma pasada.
+    index_out (solo con el plan 'memoria') recibe el índice de detalle.
+    Con checkpoint_dir se procesa archivo por archivo (ver process_files_checkpointed).
+    controls_out (lista) recibe los totales de control leídos (ver control_totals).
+    """
+    extra_keys = ([SOURCE_COL] if by_source else []) + ([PERIOD_COL] if period else [])
+    with_period = (lambda df: add_period_column(df,period,date_col)) if period else (lambda df: df)
+    if by_source:
+        subtract_discount = False
+    if checkpoint_dir:
+        if index_out is not None:
+            print("Aviso: el índice de detalle no se genera en corridas con puntos de control.")
+        return process_files_checkpointed(files,mode,checkpoint_dir,subtract_discount=subtract_discount,
+                                          workers=workers,resolve_identities=resolve_identities,
+                                          strategy=plan['strategy'] if plan and plan.get('forced') else None,
+                                          by_source=by_source,resume=resume,controls_out=controls_out,
+                                          period=period,date_col=date_col)
+    plan = plan or plan_execution(files)
+    if plan['strategy'] == 'memoria':
+        df = with_period(load_files(files,tag_source=by_source,track_rows=index_out is not None,
+                                    controls_out=controls_out,workers=workers))
+        return process_data(df,mode,subtract_discount=subtract_discount,workers=workers,
+                            resolve_identities=resolve_identities,extra_keys=extra_keys,index_out=index_out)
+    if index_out is not None:
+        print("Aviso: el índice de detalle solo se genera con el plan 'memoria'.")
+    process_chunk = lambda chunk: process_data(with_period(chunk),mode,resolve_identities=resolve_identities,
+                                               extra_keys=extra_keys)
+    result = aggregate_in_chunks(files,mode,process_chunk,extra_keys+spec_for(mode)['keys'],
+                                 spill=plan['strategy']=='disco',tag_source=by_source,controls_out=controls_out)
+    if subtract_discount:
+        result = apply_discount(result,mode)
+    return result
+
+def _sample_job(path, rows):
+    return sample_workbook(path, rows)
+
+def preview_report(files, mode, subtract_discount=False, rows=SAMPLE_ROWS, workers=1,
+                   resolve_identities=False, period=None, date_col=DATE_COL, by_source=False,
+                   process_chunk=None, keys=None):
+    """
+    Reporte aproximado para revisar modo, reglas y descuento antes de una corrida
+    larga. Cada libro es un estrato: de cada uno se toma una muestra (ver
+    sample_workbook), se procesa y sus montos se multiplican por filas estimadas /
+    filas de la muestra; los parciales escalados se combinan por keys como en la
+    agregación por bloques. Por defecto cada muestra se procesa con process_data;
+    process_chunk y keys permiten usar otro procesamiento (la GUI usa el suyo),
+    como en aggregate_in_chunks. Con by_source cada muestra lleva SOURCE_COL y el
+    resultado queda por (origen, cliente). Devuelve (reporte, resumen por libro).
+    """
+    extra_keys = ([SOURCE_COL] if by_source else []) + ([PERIOD_COL] if period else [])
+    if keys is None:
+        keys = ([SOURCE_COL] if by_source else []) + report_keys(mode, period)
+    if process_chunk is None:
+        def process_chunk(sample):
+            if period:
+                add_period_column(sample, period, date_col)
+            return process_data(sample, mode, resolve_identities=resolve_identities, extra_keys=extra_keys)
+    if workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(files))) as ex:
+            samples = list(ex.map(_sample_job, files, [rows]*len(files)))
+    else:
+        samples = [sample_workbook(f, rows) for f in files]
+    labels = source_labels(files)
+    partials, summary = [], []
+    for label, (sample, total) in zip(labels, samples):
+        factor = total / len(sample) if len(sample) else 0.0
+        if by_source:
+            sample[SOURCE_COL] = pd.Categorical([label]*len(sample), categories=labels)
+        part = process_chunk(sample)
+        measures = [c for c in spec_for(mode)['measures'] if c in part.columns]
+        part[measures] = part[measures].astype(float) * factor
+        partials.append(part)
+        summary.append({'ARCHIVO': label, 'FILAS ESTIMADAS': total, 'FILAS MUESTRA': len(sample),
+                        'FACTOR': round(factor, 2)})
+    if partials:
+        result = combine_partials(partials, mode, keys)
+    else:
+        result = pd.DataFrame(columns=[k for k in keys if k not in FINAL_COLS[mode]] + FINAL_COLS[mode])
+    if subtract_discount:
+        result = apply_discount(result, mode)
+    return result, pd.DataFrame(summary)
+
+def add_period_column(df, period, date_col=DATE_COL):
+    """
+    Agrega PERIOD_COL con el periodo de cada fila ('2024-03-05', '2024-03-04/2024-03-10',
+    '2024-03', '2024Q1') según su fecha; las filas sin fecha válida quedan en NO_DATE.
+    El periodo se calcula una vez por fecha distinta, no por fila.
+    """
+    if period not in PERIODS:
+        raise ValueError(f"Periodo inválido: {period}")
+    if date_col not in df.columns:
+        raise ValueError(f"Falta la columna de fecha '{date_col}'")
+    dates = pd.to_datetime(df[date_col], errors='coerce', dayfirst=True)
+    codes, uniques = pd.factorize(dates)
+    names = pd.Series(uniques).dt.to_period(PERIODS[period]).astype(str).to_numpy()
+    labels = np.full(len(df), NO_DATE, dtype=object)
+    labels[codes >= 0] = names[codes[codes >= 0]]
+    df[PERIOD_COL] = labels
+    return df
+
+def report_keys(mode, period=None):
+    """Claves del reporte final (sin SOURCE_COL): el periodo, si lo hay, y las claves del modo."""
+    return ([PERIOD_COL] if period else []) + spec_for(mode)['keys']
+
+def pivot_periods(df, mode, keys=None):
+    """
+    Formato ancho del resultado por periodo: una fila por cliente con los totales
+    del modo y, por cada monto, una columna por periodo ('MontoBruto 2024-01', ...).
+    """
+    keys = list(keys or spec_for(mode)['keys'])
+    measures = [c for c in spec_for(mode)['measures'] if c in df.columns]
+    total = combine_partials([df.drop(columns=PERIOD_COL)], mode, keys)
+    if df.empty:
+        return total
+    wide = df.pivot_table(index=keys, columns=PERIOD_COL, values=measures, aggfunc='sum',
+                          fill_value=0, observed=True)
+    periods = sorted(df[PERIOD_COL].unique())
+    wide = wide[[(m, p) for m in measures for p in periods]]
+    wide.columns = [f'{m} {p}' for m, p in wide.columns]
+    return total.merge(wide.reset_index(), on=keys, how='left')
+
+def control_totals(df, source):
+    """
+    Totales de control de un bloque de filas crudas: cantidad de filas y sumas de
+    CONTROL_MEASURES según el signo de UNIDADES, más MontoBruto positivo y negativo
+    (lo que suma el modo split). Es un solo groupby sobre una columna de signo.
+    """
+    units = pd.to_numeric(df['UNIDADES'], errors='coerce') if 'UNIDADES' in df.columns else pd.Series(np.nan, index=df.index)
+    sign = np.select([units > 0, units < 0, units == 0], CONTROL_SIGNS[:3], default=CONTROL_SIGNS[3])
+    values = {c: pd.to_numeric(df[c], errors='coerce').fillna(0) if c in df.columns else 0.0 for c in CONTROL_MEASURES}
+    values['UNIDADES'] = units.fillna(0)
+    values['MontoBruto Positivo'] = values['MontoBruto'].clip(lower=0)
+    values['MontoBruto Negativo'] = values['MontoBruto'].clip(upper=0)
+    frame = pd.DataFrame(values, index=df.index)
+    frame['FILAS'] = 1
+    totals = frame.groupby(pd.Categorical(sign, categories=CONTROL_SIGNS), observed=False).sum()
+    totals.insert(0, 'SIGNO', totals.index.astype(str))
+    totals.insert(0, 'ARCHIVO', source)
+    return totals.reset_index(drop=True)
+
+def reconcile(controls, report, mode, subtract_discount=False, tolerance=0.01, compare_discount=None):
+    """
+    Compara los totales de control con los del reporte del modo. Con descuento
+    restado se vuelve a sumar el Descuento del reporte antes de comparar montos.
+    Las filas que el modo descarta (UNIDADES = 0 o no numéricas en débito/crédito)
+    se informan aparte; las que ningún modo toma (cero / no numéricas) se marcan
+    como AVISO si traen montos.
+    compare_discount=False omite la comparación de Descuento (reportes que guardan
+    su valor absoluto). Devuelve una lista de dicts CONCEPTO/ENTRADA/REPORTE/DIFERENCIA/ESTADO.
+    """
+    if compare_discount is None:
+        compare_discount = not subtract_discount
+    by_sign = controls.groupby('SIGNO', sort=False).sum(numeric_only=True).reindex(CONTROL_SIGNS, fill_value=0)
+    kept = {'debito': ['positivo'], 'credito': ['negativo'], 'split': CONTROL_SIGNS}.get(mode)
+    if kept is None:
+        # especificaciones personalizadas: sus filtros no se pueden traducir a los signos de control
+        return [{'CONCEPTO': 'Filas leídas', 'ENTRADA': float(controls['FILAS'].sum()), 'REPORTE': None,
+                 'DIFERENCIA': None, 'ESTADO': 'INFO'}]
+    dropped = [s for s in CONTROL_SIGNS if s not in kept]
+    raw = by_sign.loc[kept].sum()
+    out = lambda c: float(pd.to_numeric(report[c], errors='coerce').fillna(0).sum()) if c in report.columns else 0.0
+    discount = out('Descuento') if subtract_discount else 0.0
+
+    checks = [('Filas leídas', float(by_sign['FILAS'].sum()), None)]
+    checks.append(('Filas incluidas en el modo', float(raw['FILAS']), None))
+    if mode == 'split':
+        checks.append(('MontoBruto Positivo', float(raw['MontoBruto Positivo']), out('MontoBruto Positivo') + discount))
+        checks.append(('MontoBruto Negativo', float(raw['MontoBruto Negativo']), out('MontoBruto Negativo') + discount))
+    else:
+        checks.append(('MontoBruto', float(raw['MontoBruto']), out('MontoBruto') + discount))
+    if compare_discount:
+        # con descuento restado el reporte guarda |Descuento| por cliente, no comparable con la suma cruda
+        checks.append(('Descuento', float(raw['Descuento']), out('Descuento')))
+    checks.append(('Iva', float(raw['IVA']), out('Iva')))
+
+    rows = []
+    for concept, expected, got in checks:
+        if got is None:
+            rows.append({'CONCEPTO': concept, 'ENTRADA': expected, 'REPORTE': None, 'DIFERENCIA': None, 'ESTADO': 'INFO'})
+        else:
+            diff = round(got - expected, 6)
+            rows.append({'CONCEPTO': concept, 'ENTRADA': round(expected, 6), 'REPORTE': round(got, 6),
+                         'DIFERENCIA': diff, 'ESTADO': 'OK' if abs(diff) <= tolerance else 'DIFERENCIA'})
+    for s in dropped:
+        n, amount = int(by_sign.loc[s, 'FILAS']), float(by_sign.loc[s, 'MontoBruto'])
+        if n:
+            rows.append({'CONCEPTO': f'Filas excluidas (UNIDADES {s})', 'ENTRADA': n, 'REPORTE': 0,
+                         'DIFERENCIA': round(amount, 6),
+                         'ESTADO': 'AVISO' if s in CONTROL_SIGNS[2:] and abs(amount) > tolerance else 'INFO'})
+    return rows
+
+def reconciliation_report(controls, mode, total, subtract_discount=False, per_source=None, compare_discount=None):
+    """
+    Conciliación del consolidado y, si hay reportes por archivo, de cada uno
+    contra los totales de control de su archivo. 'ok' es False ante cualquier
+    DIFERENCIA (los AVISO no la invalidan).
+    """
+    controls = pd.concat(controls, ignore_index=True) if isinstance(controls, list) else controls
+    controls = controls.groupby(['ARCHIVO','SIGNO'], sort=False, as_index=False).sum()
+    summary = {'modo': mode, 'descuento_restado': bool(subtract_discount),
+               'total': reconcile(controls, total, mode, subtract_discount, compare_discount=compare_discount)}
+    if per_source:
+        summary['por_archivo'] = {str(src): reconcile(controls[controls['ARCHIVO'] == src], rep, mode,
+                                                      subtract_discount, compare_discount=compare_discount)
+                                  for src, rep in per_source.items()}
+    summary['controles'] = controls.to_dict(orient='records')
+    checks = summary['total'] + [r for rows in summary.get('por_archivo', {}).values() for r in rows]
+    summary['ok'] = all(r['ESTADO'] != 'DIFERENCIA' for r in checks)
+    return summary
+
+def save_reconciliation(summary, report_path):
+    path = os.path.splitext(report_path)[0] + RECONCILIATION_SUFFIX
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return path
+
+def print_reconciliation(summary):
+    print("Conciliación contra los archivos de entrada:")
+    for r in summary['total']:
+        if r['ESTADO'] == 'INFO' and r['REPORTE'] is None:
+            print(f"  {r['CONCEPTO']}: {r['ENTRADA']:,.0f}")
+        elif r['CONCEPTO'].startswith('Filas excluidas'):
+            print(f"  [{r['ESTADO']}] {r['CONCEPTO']}: {r['ENTRADA']} filas, MontoBruto {r['DIFERENCIA']:,.2f}")
+        else:
+            print(f"  [{r['ESTADO']}] {r['CONCEPTO']}: entrada {r['ENTRADA']:,.2f} / reporte {r['REPORTE']:,.2f}")
+    for src, rows in summary.get('por_archivo', {}).items():
+        bad = [r['CONCEPTO'] for r in rows if r['ESTADO'] == 'DIFERENCIA']
+        if bad:
+            print(f"  [DIFERENCIA] {src}: {', '.join(bad)}")
+    if not summary['ok']:
+        print("ATENCIÓN: el reporte no cuadra con los archivos de entrada.")
+
+def checkpoint_key(path, *options):
+    """Identifica un archivo por ruta, tamaño y fecha de modificación más las opciones de la corrida."""
+    book, sheet = split_sheet_ref(path)
+    st = os.stat(book)
+    payload = [os.path.abspath(book), st.st_size, st.st_mtime_ns, CONSOLIDATION_RULES_VERSION] + list(options)
+    if sheet is not None:
+        payload.append(sheet)
+    return hashlib.sha256(json.dumps(payload, default=str).encode('utf-8')).hexdigest()[:32]
+
+def load_checkpoint(work_dir, key):
+    path = os.path.join(work_dir, f'{key}.pkl')
+    return pd.read_pickle(path) if os.path.exists(path) else None
+
+def save_checkpoint(work_dir, key, df):
+    """Escribe a un temporal y renombra: un corte a mitad de escritura no deja un punto de control roto."""
+    os.makedirs(work_dir, exist_ok=True)
+    path = os.path.join(work_dir, f'{key}.pkl')
+    df.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return path
+
+def clear_checkpoints(work_dir, keys):
+    for key in keys:
+        path = os.path.join(work_dir, f'{key}.pkl')
+        if os.path.exists(path):
+            os.remove(path)
+
+def last_checkpoint_dir():
+    """Carpeta de puntos de control de la última corrida que los usó (None si no hay registro)."""
+    try:
+        with open(LAST_CHECKPOINT_PATH, encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def resume_checkpoint_dir(checkpoint_dir=None, resume=False):
+    """
+    Carpeta de puntos de control a usar. Con resume y sin carpeta explícita se
+    toma la de la corrida interrumpida (last_checkpoint_dir), así una corrida
+    iniciada con --puntos-control CARPETA se reanuda con solo --reanudar.
+    """
+    if checkpoint_dir or not resume:
+        return checkpoint_dir
+    return last_checkpoint_dir() or CHECKPOINT_DIR
+
+def process_files_checkpointed(files, mode, work_dir, subtract_discount=False, workers=1,
+                               resolve_identities=False, strategy=None, by_source=False, resume=False,
+                               controls_out=None, period=None, date_col=DATE_COL):
+    """
+    Procesa cada archivo por separado y guarda su agregado parcial en work_dir
+    en cuanto termina. Con resume los archivos que ya tienen punto de control no
+    se vuelven a leer. Los parciales se combinan en orden de archivo, así que el
+    resultado es el mismo que el de una corrida completa. Al terminar bien se
+    borran los puntos de control de la corrida. work_dir queda registrada en
+    LAST_CHECKPOINT_PATH para poder reanudar sin volver a indicarla.
+    """
+    os.makedirs(os.path.dirname(LAST_CHECKPOINT_PATH), exist_ok=True)
+    with open(LAST_CHECKPOINT_PATH, 'w', encoding='utf-8') as f:
+        f.write(os.path.abspath(work_dir))
+    keys = ([SOURCE_COL] if by_source else []) + ([PERIOD_COL] if period else []) + spec_for(mode)['keys']
+    labels = source_labels(files)
+    partials, written = [], []
+    for i, (f, label) in enumerate(zip(files, labels)):
+        key = checkpoint_key(f, mode, resolve_identities, by_source, period, date_col if period else None)
+        part = load_checkpoint(work_dir, key) if resume else None
+        controls = load_checkpoint(work_dir, key + '_control') if resume else None
+        if part is not None and controls is not None:
+            print(f"[{i+1}/{len(files)}] {os.path.basename(f)}: ya procesado (punto de control)")
+        else:
+            print(f"[{i+1}/{len(files)}] {os.path.basename(f)}: procesando...")
+            plan = plan_execution([f], strategy)
+            file_controls = []
+            part = process_files([f],mode,workers=workers,resolve_identities=resolve_identities,plan=plan,
+                                 controls_out=file_controls,period=period,date_col=date_col)
+            if by_source:
+                part.insert(0, SOURCE_COL, pd.Categorical([label]*len(part), categories=labels))
+            controls = pd.concat(file_controls, ignore_index=True).assign(ARCHIVO=label)
+            save_checkpoint(work_dir, key + '_control', controls)
+            save_checkpoint(work_dir, key, part)
+        if controls_out is not None:
+            controls_out.append(controls)
+        written += [key, key + '_control']
+        partials.append(part)
+        if len(partials) >= 8:
+            partials = [combine_partials(partials, mode, keys)]
+    if partials:
+        result = combine_partials(partials, mode, keys)
+    else:
+        result = pd.DataFrame(columns=[k for k in keys if k not in FINAL_COLS[mode]] + FINAL_COLS[mode])
+    clear_checkpoints(work_dir, written)
+    if subtract_discount:
+        result = apply_discount(result, mode)
+    return result
+
+def split_by_source(per_source, mode, keys=None, subtract_discount=False):
+    """
+    A partir del agregado por (SOURCE_COL, cliente) devuelve el consolidado por
+    cliente y un diccionario {origen: reporte}. El consolidado se obtiene
+    reagrupando los parciales, sin volver a recorrer las filas originales.
+    """
+    keys = list(keys or spec_for(mode)['keys'])
+    total = combine_partials([per_source.drop(columns=SOURCE_COL)], mode, keys)
+    by_source = {}
+    for source, grp in per_source.groupby(SOURCE_COL, sort=True, observed=False):
+        by_source[source] = grp.drop(columns=SOURCE_COL).reset_index(drop=True)
+    if subtract_discount:
+        total = apply_discount(total, mode)
+        by_source = {k: apply_discount(v, mode) for k, v in by_source.items()}
+    return total, by_source
+
+def source_labels(files):
+    """Nombre de cada archivo; si se repite se antepone su posición."""
+    names = [os.path.basename(f) for f in files]
+    return [f"{i+1}_{n}" if names.count(n) > 1 else n for i, n in enumerate(names)]
+
+def _save_report_job(df, path, mode, split_into='sheets'):
+    return save_report(df, path, mode, split_into=split_into)
+
+def save_reports_parallel(reports, mode, workers=None, split_into='sheets'):
+    """
+    Escribe varios reportes {ruta: DataFrame} a la vez en un pool de procesos.
+    split_into se aplica a cada reporte que supere el límite de filas (ver save_report).
+    """
+    paths = list(reports)
+    with ProcessPoolExecutor(max_workers=workers or min(len(paths), os.cpu_count() or 1) or 1) as ex:
+        written = ex.map(_save_report_job, [reports[p] for p in paths], paths, [mode]*len(paths),
+                         [split_into]*len(paths))
+        return [p for group in written for p in group]
+
+def source_report_paths(out_path, sources):
+    """reporte_debito.xlsx -> reporte_debito_<origen>.xlsx (o _<libro>_<hoja>.xlsx) por cada origen."""
+    base, ext = os.path.splitext(out_path)
+    paths = {}
+    for s in sources:
+        book, sheet = split_sheet_ref(s)
+        stem = os.path.splitext(book)[0]
+        if sheet is not None:
+            stem += '_' + re.sub(r'[<>:"|?*]', '_', sheet)
+        paths[s] = f"{base}_{stem}{ext}"
+    return paths
+
+def find_workbooks(folder, recursive=True):
+    """Libros .xlsx de la carpeta (y subcarpetas), sin los temporales '~$' de Excel, ordenados por ruta."""
+    found = []
+    for root, dirs, names in os.walk(folder):
+        dirs.sort()
+        found += [os.path.join(root, n) for n in sorted(names)
+                  if n.lower().endswith('.xlsx') and not n.startswith('~$')]
+        if not recursive:
+            break
+    return found
+
+def describe_batch(files, books, workers=1):
+    """Resumen previo a la corrida: cantidad, tamaño total, filas estimadas y tiempo de lectura."""
+    paths = {split_sheet_ref(f)[0] for f in files}
+    size = sum(os.path.getsize(p) for p in paths)
+    rows = sum(b['rows'] for b in books)
+    secs = estimate_read_seconds(books, workers)
+    count = f"{len(files)} hoja(s) de {len(paths)} archivo(s)" if len(paths) < len(files) else f"{len(files)} archivo(s)"
+    return (f"{count}, {size/1024**2:.1f} MB, ~{rows:,} filas; "
+            f"lectura estimada ~{secs/60:.1f} min con {workers} proceso(s)")
+
+def _book_cells(book):
+    return book['rows'] * book['cols']
+
+def largest_first(files, books=None):
+    """Posiciones de files de mayor a menor cantidad de celdas (estimada con inspect_workbook)."""
+    books = books or [inspect_workbook(f) for f in files]
+    return sorted(range(len(files)), key=lambda i: -_book_cells(books[i]))
+
+def estimate_read_seconds(books, workers=1):
+    """
+    Tiempo estimado de lectura repartiendo los libros de mayor a menor entre
+    workers procesos (cada libro va al proceso que se libera primero).
+    """
+    loads = [0.0] * max(workers, 1)
+    for b in sorted(books, key=_book_cells, reverse=True):
+        i = loads.index(min(loads))
+        loads[i] += _book_cells(b) / READ_CELLS_PER_SEC
+    return max(loads)
+
+def _read_workbook(path):
+    """
+    Lee la hoja con pd.read_excel sin las filas en blanco, igual que
+    iter_workbook_chunks, para que todos los planes cuenten las mismas filas.
+    El índice conserva la posición original (fila de Excel = índice + 2).
+    """
+    book, sheet = split_sheet_ref(path)
+    return pd.read_excel(book,sheet_name=sheet if sheet is not None else 0,engine='openpyxl').dropna(how='all')
+
+def read_workbooks(files, workers=1, books=None, on_done=None):
+    """
+    Lee los libros en un pool de procesos enviando primero los más grandes, para
+    que ninguno grande quede solo al final. Cada hoja 'libro.xlsx[Hoja]' es una
+    unidad de trabajo aparte, así que las hojas de un mismo libro se leen a la vez. Devuelve los DataFrames en el orden
+    de files ('first' depende del orden). on_done(posición, DataFrame, leídos, total)
+    se llama al terminar cada libro.
+    """
+    workers = min(workers, len(files))
+    if workers <= 1:
+        frames = []
+        for n, f in enumerate(files, start=1):
+            frames.append(_read_workbook(f))
+            if on_done:
+                on_done(n - 1, frames[-1], n, len(files))
+        return frames
+    frames = [None] * len(files)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futures = {ex.submit(_read_workbook, files[i]): i for i in largest_first(files, books)}
+        for n, fut in enumerate(as_completed(futures), start=1):
+            i = futures[fut]
+            frames[i] = fut.result()
+            if on_done:
+                on_done(i, frames[i], n, len(files))
+    return frames
+
+def load_files(files, tag_source=False, track_rows=False, controls_out=None, workers=1):
+    """
+    Lee y concatena los libros indicados (en paralelo con workers > 1, ver
+    read_workbooks). Con tag_source añade SOURCE_COL; con track_rows añade
+    ROW_FILE_COL (posición del archivo) y ROW_POS_COL (fila de Excel).
+    Si controls_out es una lista se le agregan los totales de control de cada archivo.
+    """
+    dfs = read_workbooks(files,workers)
+    labels = source_labels(files)
+    for i, df in enumerate(dfs):
+        if controls_out is not None:
+            controls_out.append(control_totals(df,labels[i]))
+        if tag_source:
+            df[SOURCE_COL] = pd.Categorical([labels[i]]*len(df), categories=labels)
+        if track_rows:
+            df[ROW_FILE_COL] = np.int32(i)
+            df[ROW_POS_COL] = df.index.to_numpy(np.int64) + 2  # fila 1 = encabezado
+    return pd.concat(dfs,ignore_index=True)
+
+def run_report(files, mode, out_dir, subtract_discount=False, workers=1,
+               resolve_identities=False, split_into='sheets', strategy=None, by_source=False,
+               checkpoint_dir=None, resume=False, period=None, date_col=DATE_COL, period_format='largo',
+               sheets=None, store=False):
+    """
+    Lee, procesa y guarda un reporte sin interacción. Devuelve las rutas escritas.
+    Con sheets (patrón de nombre, '*' para todas) se leen todas las hojas con las
+    columnas requeridas, cada una con su propio origen (ver find_sheets).
+    Con store el resultado se guarda además en el almacén consultable (ver store_report).
+    """
+    required = spec_for(mode)['required'] + ([date_col] if period else [])
+    if sheets:
+        files, skipped = find_sheets(files,required=required,pattern=sheets)
+        for ref, msg in skipped.items():
+            print(f"Hoja omitida '{os.path.basename(ref)}': {msg}")
+        if not files:
+            raise ValueError(f"Ninguna hoja con el patrón '{sheets}' tiene las columnas requeridas")
+    problems = validate_headers(files,required=required)
+    if problems:
+        raise ValueError("; ".join(f"{os.path.basename(f)}: {msg}" for f, msg in problems.items()))
+    plan = plan_execution(files,strategy)
+    print(describe_plan(plan))
+    controls = []
+    result = process_files(files,mode,subtract_discount=subtract_discount,workers=workers,
+                           resolve_identities=resolve_identities,plan=plan,by_source=by_source,
+                           checkpoint_dir=checkpoint_dir,resume=resume,controls_out=controls,
+                           period=period,date_col=date_col)
+    os.makedirs(out_dir,exist_ok=True)
+    out_path = os.path.join(out_dir,OUTPUT_NAMES[mode])
+    per_source = {}
+    if by_source:
+        result, per_source = split_by_source(result,mode,keys=report_keys(mode,period),
+                                             subtract_discount=subtract_discount)
+    summary = reconciliation_report(controls,mode,result,subtract_discount,per_source)
+    print_reconciliation(summary)
+    save_reconciliation(summary,out_path)
+    if store:
+        print(f"Corrida {store_report(result,mode,files,subtract_discount,per_source)} guardada en el almacén.")
+    if period and period_format == 'ancho':
+        result = pivot_periods(result,mode)
+        per_source = {k: pivot_periods(v,mode) for k, v in per_source.items()}
+    if by_source:
+        reports = {out_path: result}
+        for source, path in source_report_paths(out_path,per_source).items():
+            reports[path] = per_source[source]
+        return save_reports_parallel(reports,mode,split_into=split_into)
+    return save_report(result,out_path,mode,split_into=split_into)
+
+def file_sha256(path, chunk_size=1024*1024):
+    h = hashlib.sha256()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cache_key(files, mode, subtract_discount, fmt='xlsx', resolve_identities=False, by_source=False, period=None,
+              split_into='sheets', identity_map=IDENTITY_MAP_PATH):
+    """
+    Clave del resultado: contenido de cada archivo (en orden, porque 'first'
+    depende de él), modo, descuento, versión de reglas y formato de salida
+    (incluida la división en hojas o archivos). Con resolve_identities incluye
+    también el contenido de la tabla de identidades, que cambia los nombres.
+    """
+    hashes = {}
+    for f in files:
+        book = split_sheet_ref(f)[0]
+        if book not in hashes:
+            hashes[book] = file_sha256(book)
+    payload = {
+        'files': [[hashes[b], s] if s is not None else hashes[b] for b, s in map(split_sheet_ref, files)],
+        'mode': mode,
+        'subtract_discount': bool(subtract_discount),
+        'rules': CONSOLIDATION_RULES_VERSION,
+        'identities': bool(resolve_identities),
+        'by_source': bool(by_source),
+        'format': fmt,
+    }
+    if mode not in BUILTIN_SPECS:
+        payload['spec'] = spec_for(mode)['source']
+    if period:
+        payload['period'] = list(period)
+    if resolve_identities:
+        payload['identity_map'] = file_sha256(identity_map) if identity_map and os.path.isfile(identity_map) else None
+    return split_cache_key(hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest(), split_into)
+
+def split_cache_key(key, split_into):
+    """
+    Clave de la variante de key dividida en hojas (la misma key) o en archivos,
+    sin volver a leer los archivos de entrada.
+    """
+    return key if split_into == 'sheets' else hashlib.sha256(f'{key}:{split_into}'.encode()).hexdigest()
+
+def _manifest_path(cache_dir):
+    return os.path.join(cache_dir,'manifest.json')
+
+def load_manifest(cache_dir=CACHE_DIR):
+    try:
+        with open(_manifest_path(cache_dir),encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _save_manifest(manifest, cache_dir):
+    os.makedirs(cache_dir,exist_ok=True)
+    tmp = _manifest_path(cache_dir) + '.tmp'
+    with open(tmp,'w',encoding='utf-8') as f:
+        json.dump(manifest,f,indent=2,ensure_ascii=False)
+    os.replace(tmp,_manifest_path(cache_dir))
+
+def cache_lookup(key, cache_dir=CACHE_DIR):
+    """Rutas de los reportes en caché para key, o None si no hay (o faltan archivos)."""
+    manifest = load_manifest(cache_dir)
+    entry = manifest.get(key)
+    if not entry:
+        return None
+    paths = [os.path.join(cache_dir,key,name) for name in entry['outputs']]
+    if not all(os.path.isfile(p) for p in paths):
+        manifest.pop(key)
+        _save_manifest(manifest,cache_dir)
+        return None
+    entry['last_used'] = time.time()
+    _save_manifest(manifest,cache_dir)
+    return paths
+
+def cached_report_rows(key, cache_dir=CACHE_DIR):
+    """Filas del reporte en caché para key (None si no hay o la entrada no las registró)."""
+    return load_manifest(cache_dir).get(key, {}).get('rows')
+
+def cache_store(key, paths, meta, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """Copia los reportes a la caché y expulsa los menos usados si se supera max_bytes."""
+    entry_dir = os.path.join(cache_dir,key)
+    os.makedirs(entry_dir,exist_ok=True)
+    for p in paths:
+        shutil.copy2(p,os.path.join(entry_dir,os.path.basename(p)))
+    manifest = load_manifest(cache_dir)
+    now = time.time()
+    manifest[key] = dict(meta,
+                         outputs=[os.path.basename(p) for p in paths],
+                         size=sum(os.path.getsize(p) for p in paths),
+                         created=now, last_used=now)
+    total = sum(e['size'] for e in manifest.values())
+    for old_key in sorted(manifest, key=lambda k: manifest[k]['last_used']):
+        if total <= max_bytes or old_key == key:
+            continue
+        total -= manifest.pop(old_key)['size']
+        shutil.rmtree(os.path.join(cache_dir,old_key),ignore_errors=True)
+    _save_manifest(manifest,cache_dir)
+
+def clear_cache(cache_dir=CACHE_DIR):
+    """
+    Borra los reportes en caché y el manifiesto. El resto de cache_dir (almacén,
+    tabla de identidades, puntos de control) no son resultados en caché y se
+    conserva. Devuelve la cantidad de entradas borradas.
+    """
+    keys = set(load_manifest(cache_dir))
+    if os.path.isdir(cache_dir):
+        # también las entradas huérfanas (carpetas con nombre de clave sin manifiesto)
+        keys |= {n for n in os.listdir(cache_dir) if re.fullmatch(r'[0-9a-f]{64}', n)}
+    for key in keys:
+        shutil.rmtree(os.path.join(cache_dir,key),ignore_errors=True)
+    for p in (_manifest_path(cache_dir), _manifest_path(cache_dir) + '.tmp'):
+        if os.path.exists(p):
+            os.remove(p)
+    return len(keys)
+
+def print_cache_manifest(cache_dir=CACHE_DIR):
+    manifest = load_manifest(cache_dir)
+    if not manifest:
+        print(f"La caché en {cache_dir} está vacía.")
+        return
+    total = 0
+    for key, e in sorted(manifest.items(), key=lambda kv: kv[1]['last_used'], reverse=True):
+        total += e['size']
+        used = time.strftime('%Y-%m-%d %H:%M', time.localtime(e['last_used']))
+        print(f"{key[:12]}  {e['mode']:<8} descuento={'s' if e['subtract_discount'] else 'n'}  "
+              f"{e['size']/1024**2:8.1f} MB  usado {used}  {', '.join(e['files'])}")
+    print(f"{len(manifest)} entrada(s), {total/1024**2:.1f} MB de {CACHE_MAX_BYTES/1024**2:.0f} MB en {cache_dir}")
+
+def _synthetic_sales(n_rows, n_clients, seed=0):
+    rng = np.random.default_rng(seed)
+    client = rng.integers(0, n_clients, n_rows)
+    return pd.DataFrame({
+        'UNIDADES': rng.integers(-3, 4, n_rows),
+        'NOMBRECLIENTE': pd.Series(client).map(lambda c: f"CLIENTE {c}"),
+        'TIPO_DE_DOCUMENTO': '13 CC',
+        'IDENTIFICACION': client,
+        'PRIMER_APELLIDO': 'A', 'SEGUNDO_APELLIDO': 'B', 'PRIMER_NOMBRE': 'C', 'OTROS_NOMBRES': 'D',
+        'MontoBruto': rng.normal(100, 50, n_rows).round(2),
+        'Descuento': rng.uniform(0, 5, n_rows).round(2),
+        'IVA': rng.uniform(0, 19, n_rows).round(2),
+    })
+
+def benchmark_groupby(n_rows=2000000, n_clients=200000, max_workers=None):
+    """Mide process_data en modo split con 1, 2, 4... hasta todos los núcleos."""
+    max_workers = max_workers or os.cpu_count() or 1
+    counts = sorted({w for w in (2**i for i in range(max_workers.bit_length())) if w <= max_workers} | {max_workers})
+    print(f"Generando {n_rows} filas sintéticas con {n_clients} clientes...")
+    df = _synthetic_sales(n_rows, n_clients)
+    base = None
+    print(f"{'procesos':>8} {'segundos':>9} {'aceleración':>11}")
+    for w in counts:
+        t0 = time.perf_counter()
+        process_data(df, 'split', workers=w)
+        elapsed = time.perf_counter() - t0
+        base = base or elapsed
+        print(f"{w:>8} {elapsed:>9.2f} {base/elapsed:>10.2f}x")
+
+def peak_memory(func, *args, **kwargs):
+    """Ejecuta func y devuelve (resultado, pico de memoria asignado en bytes según tracemalloc)."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure_memory(n_rows=500000, n_clients=50000, max_factor=None, modes=('debito','credito','split')):
+    """
+    Pico de memoria que asigna process_data en cada modo (tracemalloc, incluye los
+    arreglos de numpy) como múltiplo de los buffers del DataFrame de entrada
+    (memory_usage(deep=False)). Control de regresión para los .copy() evitados:
+    devuelve False si algún modo supera max_factor (por defecto MEMORY_MAX_FACTOR).
+    """
+    print(f"Generando {n_rows} filas sintéticas con {n_clients} clientes...")
+    df = _synthetic_sales(n_rows, n_clients)
+    size = df.memory_usage(deep=False).sum()
+    print(f"Entrada: {size/1024**2:.1f} MB sin contar los textos")
+    print(f"{'modo':>8} {'pico MB':>9} {'factor':>7} {'límite':>7}")
+    ok = True
+    for mode in modes:
+        limit = max_factor if max_factor is not None else MEMORY_MAX_FACTOR[mode]
+        factor = peak_memory(process_data, df, mode)[1] / size
+        ok = ok and factor <= limit
+        print(f"{mode:>8} {factor*size/1024**2:>9.1f} {factor:>6.2f}x {limit:>6.2f}x"
+              f"{'' if factor <= limit else '  EXCEDE EL LÍMITE'}")
+    return ok
+
+def ask_split_into(reason):
+    print(f"{reason}.")
+    ans = input("¿Dividir en varias hojas (h) o en varios archivos (a)? ").strip().lower()
+    return 'files' if ans=='a' else 'sheets'
+
+def run_interactive(workers=1, use_cache=True, resolve_identities=False, strategy=None, by_source=False,
+                    with_index=False, checkpoint_dir=None, resume=False, spec=None, folder=None,
+                    period=None, date_col=DATE_COL, period_format='largo', sheets=None, store=False,
+                    sample=None):
     print("== Reporte de Ventas Versión Consola ==")
-    # archivos
-    n = int(input("¿Cuántos archivos .xlsx desea procesar? "))
-    files = []
-    for i in range(n):
-        path = input(f"Ruta archivo {i+1}: ").strip()
-        if not os.path.isfile(path) or not path.lower().endswith('.xlsx'):
-            print(f"Error: '{path}' no es un archivo .xlsx válido.")
+    # archivos: todos los .xlsx de --carpeta, o uno por uno
+    if folder:
+        files = find_workbooks(folder)
+        if not files:
+            print(f"Error: no hay archivos .xlsx en '{folder}'.")
             sys.exit(1)
-        files.append(path)
+        print(describe_batch(files,[inspect_workbook(f) for f in files],workers))
+    else:
+        n = int(input("¿Cuántos archivos .xlsx desea procesar? "))
+        files = []
+        for i in range(n):
+            path = input(f"Ruta archivo {i+1}: ").strip()
+            if not os.path.isfile(path) or not path.lower().endswith('.xlsx'):
+                print(f"Error: '{path}' no es un archivo .xlsx válido.")
+                sys.exit(1)
+            files.append(path)
 
-    # leer y combinar
-    dfs = []
-    for f in files:
-        dfs.append(pd.read_excel(f,engine='openpyxl'))
-    df_all = pd.concat(dfs,ignore_index=True)
+    # validar encabezados antes de leer los datos
+    required = (spec_for(spec)['required'] if spec else REQUIRED_COLS) + ([date_col] if period else [])
+    if sheets:
+        # cada hoja con las columnas requeridas se procesa como un archivo más
+        files, skipped = find_sheets(files,required=required,pattern=sheets)
+        for ref, msg in skipped.items():
+            print(f"Hoja omitida '{os.path.basename(ref)}': {msg}")
+        if not files:
+            print(f"Error: ninguna hoja con el patrón '{sheets}' tiene las columnas requeridas.")
+            sys.exit(1)
+        print(f"Hojas a procesar: {len(files)}")
+    problems = validate_headers(files,required=required)
+    if problems:
+        for f, msg in problems.items():
+            print(f"Error en '{f}': {msg}")
+        sys.exit(1)
 
-    # modo
-    m = input("Elija modo (debito/credito/split): ").strip().lower()
+    # modo (una especificación cargada con --especificacion reemplaza la pregunta)
+    m = spec or input("Elija modo (debito/credito/split): ").strip().lower()
     sd = False
-    if m in ['debito','credito','split']:
-        ans = input("¿Restar descuento? (s/n): ").strip().lower()
-        sd = (ans=='s')
+    if m in SPECS:
+        if spec_for(m)['adjustments']:
+            ans = input("¿Restar descuento? (s/n): ").strip().lower()
+            sd = (ans=='s')
     else:
         print("Modo inválido.")
         sys.exit(1)
 
-    # procesar
-    result = process_data(df_all,m,subtract_discount=sd)
+    # vista previa por muestreo: confirmar modo, reglas y descuento antes de la corrida completa
+    if sample:
+        t0 = time.perf_counter()
+        preview, strata = preview_report(files,m,sd,rows=sample,workers=workers,resolve_identities=resolve_identities,
+                                         period=period,date_col=date_col,by_source=by_source)
+        print(f"Vista previa aproximada: {strata['FILAS MUESTRA'].sum():,} de ~{strata['FILAS ESTIMADAS'].sum():,} "
+              f"filas leídas en {time.perf_counter()-t0:.1f} s")
+        print(strata.to_string(index=False))
+        for c in spec_for(m)['measures']:
+            if c in preview.columns:
+                print(f"  {c} (estimado): {preview[c].sum():,.2f}")
+        with pd.option_context('display.max_columns', None, 'display.width', 200):
+            print(preview.head(20))
+        if input("¿Continuar con la corrida completa? (s/n): ").strip().lower() != 's':
+            print("Corrida cancelada.")
+            return
+
+    # caché: mismos archivos y opciones -> copiar el reporte ya generado
+    # el índice apunta a rutas de origen, así que esas corridas no usan la caché;
+    # tampoco las que se guardan en el almacén, que necesitan el resultado agregado
+    use_cache = use_cache and not with_index and not store
+    plan = plan_execution(files,strategy)
+    # la división en hojas o archivos solo cambia reportes de más de una hoja, así que se
+    # pregunta por el tamaño del reporte: el guardado en caché o, si no hay, el recién agregado
+    split_into = 'sheets'
+    asked = False
+    key_options = dict(resolve_identities=resolve_identities,by_source=by_source,
+                       period=(period,date_col,period_format) if period else None)
+    cached = None
+    if use_cache:
+        key = cache_key(files,m,sd,**key_options)
+        rows = cached_report_rows(key)
+        if rows is None:
+            rows = cached_report_rows(split_cache_key(key,'files'))
+        if rows is not None and rows > EXCEL_MAX_ROWS-1:
+            split_into = ask_split_into(f"El reporte tiene {rows} filas y supera el límite de Excel "
+                                        f"({EXCEL_MAX_ROWS-1} por hoja)")
+            asked = True
+        cached = cache_lookup(split_cache_key(key,split_into))
+    if cached:
+        print("Se encontró un reporte idéntico en caché; no es necesario volver a procesar.")
+        out_dir = input("Ruta carpeta de salida: ").strip()
+        os.makedirs(out_dir,exist_ok=True)
+        for p in cached:
+            dest = os.path.join(out_dir,os.path.basename(p))
+            shutil.copy2(p,dest)
+            print(f"Reporte guardado en: {dest}")
+        return
+
+    # leer y procesar
+    print(describe_plan(plan))
+    index = {} if with_index else None
+    controls = []
+    result = process_files(files,m,subtract_discount=sd,workers=workers,
+                           resolve_identities=resolve_identities,plan=plan,by_source=by_source,index_out=index,
+                           checkpoint_dir=checkpoint_dir,resume=resume,controls_out=controls,
+                           period=period,date_col=date_col)
+    per_source = {}
+    if by_source:
+        result, per_source = split_by_source(result,m,keys=report_keys(m,period),subtract_discount=sd)
+    reconciliation = reconciliation_report(controls,m,result,sd,per_source)
+    print_reconciliation(reconciliation)
+    if store:
+        print(f"Corrida {store_report(result,m,files,sd,per_source)} guardada en el almacén ({STORE_PATH}).")
+    if period and period_format == 'ancho':
+        # una fila por cliente, una columna por monto y periodo
+        result = pivot_periods(result,m)
+        per_source = {k: pivot_periods(v,m) for k, v in per_source.items()}
     if result.empty:
         print("No hay registros para el reporte. Se generará un archivo solo con encabezados.")
 
+    # particionar si excede el límite de Excel (salvo que ya se haya preguntado con la caché)
+    if len(result) > EXCEL_MAX_ROWS-1 and not asked:
+        split_into = ask_split_into(f"El reporte tiene {len(result)} filas y supera el límite de Excel "
+                                    f"({EXCEL_MAX_ROWS-1} por hoja)")
+
     # carpeta y guardar
     out_dir = input("Ruta carpeta de salida: ").strip()
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir,exist_ok=True)
-    out_name = {
-        'debito':'reporte_debito.xlsx',
-        'credito':'reporte_credito.xlsx',
-        'split':'reporte_negativos_positivos.xlsx'
-    }[m]
+    out_name = OUTPUT_NAMES[m]
     out_path = os.path.join(out_dir,out_name)
-    with pd.ExcelWriter(out_path,engine='xlsxwriter') as w:
-        result.to_excel(w,index=False,sheet_name=m)
-    print(f"Reporte guardado en: {out_path}")
\ No newline at end of file
+    if per_source:
+        # consolidado + un reporte por archivo, escritos a la vez
+        reports = {out_path: result}
+        for source, path in source_report_paths(out_path,per_source).items():
+            reports[path] = per_source[source]
+        saved = save_reports_parallel(reports,m,split_into=split_into)
+    else:
+        saved = save_report(result,out_path,m,split_into=split_into)
+    saved = saved + [save_reconciliation(reconciliation,out_path)]
+    for p in saved:
+        print(f"Reporte guardado en: {p}")
+    if index:
+        print(f"Índice de detalle guardado en: {save_drilldown_index(index_path_for(out_path),index,files)}")
+    if use_cache:
+        # la tabla de identidades pudo cambiar en esta corrida: se guarda con la clave de su estado final
+        key = cache_key(files,m,sd,split_into=split_into,**key_options)
+        cache_store(key,saved,{'files':[os.path.basename(f) for f in files],
+                               'mode':m,'subtract_discount':sd,'format':'xlsx','rows':len(result)})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reporte de Ventas Versión Consola")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Procesos para la agregación paralela (por defecto 1)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="No reutilizar ni guardar reportes en la caché")
+    parser.add_argument('--unificar-clientes', action='store_true',
+                        help="Unifica nombres duplicados de un mismo cliente (tildes, espacios, orden)")
+    parser.add_argument('--plan', choices=('auto',)+STRATEGIES, default='auto',
+                        help="Forzar estrategia de ejecución (por defecto se elige según el tamaño estimado)")
+    parser.add_argument('--por-archivo', action='store_true',
+                        help="Además del consolidado, genera un reporte por cada archivo de entrada")
+    parser.add_argument('--indice', action='store_true',
+                        help="Guarda junto al reporte un índice cliente -> filas de origen")
+    parser.add_argument('--puntos-control', metavar='CARPETA', default=None,
+                        help="Guarda el agregado de cada archivo al terminarlo, para poder reanudar")
+    parser.add_argument('--reanudar', '--resume', nargs='?', const='', default=None, metavar='CARPETA',
+                        help="Reutiliza los puntos de control de una corrida interrumpida "
+                             "(por defecto en la carpeta que usó esa corrida)")
+    parser.add_argument('--periodo', choices=list(PERIODS), default=None,
+                        help="Agrupa además por periodo según la columna de fecha (una sola pasada)")
+    parser.add_argument('--columna-fecha', default=DATE_COL,
+                        help=f"Columna con la fecha de la factura (por defecto {DATE_COL})")
+    parser.add_argument('--formato-periodo', choices=['largo','ancho'], default='largo',
+                        help="largo: una fila por cliente y periodo; ancho: una columna por monto y periodo")
+    parser.add_argument('--carpeta', default=None,
+                        help="Procesa todos los .xlsx de esta carpeta (y subcarpetas) en lugar de pedirlos uno a uno")
+    parser.add_argument('--hojas', nargs='?', const='*', default=None, metavar='PATRON',
+                        help="Lee todas las hojas con las columnas requeridas (o solo las que coincidan con "
+                             "PATRON, p. ej. 'Caja*'), cada una como un origen aparte")
+    parser.add_argument('--muestra', nargs='?', type=int, const=SAMPLE_ROWS, default=None, metavar='FILAS',
+                        help=f"Antes de la corrida muestra un reporte aproximado a partir de una muestra de cada "
+                             f"libro (por defecto {SAMPLE_ROWS} filas por libro) y pide confirmación")
+    parser.add_argument('--almacen', action='store_true',
+                        help="Guarda el reporte agregado en el almacén consultable (ver 'consultar')")
+    parser.add_argument('--especificacion', '--spec', metavar='JSON', default=None,
+                        help="Reporte personalizado descrito en un archivo JSON (filtros, claves, montos, columnas)")
+    sub = parser.add_subparsers(dest='command')
+    explain = sub.add_parser('explicar', help="Muestra las filas de origen de un cliente usando el índice")
+    explain.add_argument('indice', help=f"Archivo *{INDEX_SUFFIX} generado con --indice")
+    explain.add_argument('cliente', help="NOMBRECLIENTE o IDENTIFICACION")
+    explain.add_argument('--salida', help="Guardar las filas en este .xlsx en lugar de mostrarlas")
+    diff = sub.add_parser('diff', help="Compara dos reportes y lista clientes nuevos, eliminados y cambiados")
+    diff.add_argument('anterior', help="Reporte anterior (.xlsx, .pkl o .csv)")
+    diff.add_argument('actual', help="Reporte actual (.xlsx, .pkl o .csv)")
+    diff.add_argument('--clave', nargs='+', default=None,
+                      help="Columnas de la clave (por defecto NOMBRECLIENTE, más IDENTIFICACION si hay repetidos)")
+    diff.add_argument('--tolerancia', type=float, default=0.005,
+                      help="Diferencia mínima para considerar un monto cambiado")
+    diff.add_argument('--salida', help="Guardar las diferencias en este .xlsx (una hoja por estado) o .csv")
+    query = sub.add_parser('consultar', help="Consulta los reportes guardados con --almacen")
+    query.add_argument('--modo', default=None, help="debito, credito, split o una especificación")
+    query.add_argument('--monto', default=None, help="Columna de monto para filtrar y ordenar (MontoBruto, Iva, ...)")
+    query.add_argument('--min', type=float, default=None, help="Monto mínimo (requiere --monto)")
+    query.add_argument('--max', type=float, default=None, help="Monto máximo (requiere --monto)")
+    query.add_argument('--cliente', default=None, help="Parte del NOMBRECLIENTE o IDENTIFICACION exacta")
+    query.add_argument('--corrida', default='ultima', help="Número de corrida, 'ultima' (por defecto) o 'todas'")
+    query.add_argument('--origen', default=None, help="Reporte de un origen (archivo u hoja) en lugar del consolidado")
+    query.add_argument('--top', type=int, default=None, help="Solo las primeras N filas")
+    query.add_argument('--ascendente', action='store_true', help="Ordenar el monto de menor a mayor")
+    query.add_argument('--corridas', action='store_true', help="Lista las corridas guardadas")
+    query.add_argument('--salida', help="Guardar el resultado en este .xlsx o .csv")
+    bench = sub.add_parser('benchmark', help="Mide el escalado del groupby paralelo")
+    bench.add_argument('--filas', type=int, default=2000000)
+    bench.add_argument('--clientes', type=int, default=200000)
+    memory = sub.add_parser('memoria', help="Verifica que el pico de memoria de cada modo no supere un múltiplo de la entrada")
+    memory.add_argument('--filas', type=int, default=500000)
+    memory.add_argument('--clientes', type=int, default=50000)
+    memory.add_argument('--max-factor', type=float, default=None,
+                        help=f"Múltiplo máximo del tamaño de la entrada (por defecto por modo: {MEMORY_MAX_FACTOR})")
+    cache = sub.add_parser('cache', help="Inspecciona o vacía la caché de reportes")
+    cache.add_argument('accion', choices=['list','clear'])
+    args = parser.parse_args(argv)
+    spec = load_spec(args.especificacion) if args.especificacion else None
+    if spec and args.almacen:
+        try:
+            require_client_report(spec)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.command == 'benchmark':
+        benchmark_groupby(args.filas, args.clientes, max_workers=args.workers if args.workers > 1 else None)
+    elif args.command == 'memoria':
+        if not measure_memory(args.filas, args.clientes, args.max_factor):
+            sys.exit(1)
+    elif args.command == 'explicar':
+        t0 = time.perf_counter()
+        rows = explain_client(args.indice, args.cliente)
+        if rows.empty:
+            print(f"Cliente '{args.cliente}' no encontrado en el índice.")
+        elif args.salida:
+            rows.to_excel(args.salida, index=False)
+            print(f"{len(rows)} filas guardadas en: {args.salida}")
+        else:
+            with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+                print(rows)
+        print(f"({time.perf_counter()-t0:.3f} s)")
+    elif args.command == 'diff':
+        t0 = time.perf_counter()
+        old, new = read_report(args.anterior), read_report(args.actual)
+        t1 = time.perf_counter()
+        result = diff_reports(old, new, keys=args.clave, tolerance=args.tolerancia)
+        t2 = time.perf_counter()
+        counts = result['ESTADO'].value_counts()
+        print(f"Clientes: {len(old)} anterior, {len(new)} actual")
+        for state in DIFF_STATES:
+            print(f"  {state}: {counts.get(state, 0)}")
+        deltas = [c for c in result.columns if c.endswith(' delta')]
+        if deltas:
+            print("Variación total:")
+            for c in deltas:
+                print(f"  {c[:-len(' delta')]}: {result[c].sum():,.2f}")
+        if args.salida:
+            save_diff(result, args.salida)
+            print(f"Diferencias guardadas en: {args.salida}")
+        elif not result.empty:
+            with pd.option_context('display.max_columns', None, 'display.width', 200):
+                print(result.head(20))
+        print(f"(lectura {t1-t0:.2f} s, comparación {t2-t1:.2f} s)")
+    elif args.command == 'consultar':
+        t0 = time.perf_counter()
+        if args.corridas:
+            result = list_runs()
+        else:
+            if (args.min is not None or args.max is not None) and not args.monto:
+                parser.error("--min y --max requieren --monto")
+            try:
+                result = query_store(mode=args.modo, measure=args.monto, minimum=args.min, maximum=args.max,
+                                     client=args.cliente, run=args.corrida, top=args.top,
+                                     ascending=args.ascendente, source=args.origen)
+            except ValueError as e:
+                print(f"Error: {e}")
+                sys.exit(1)
+        elapsed = time.perf_counter() - t0
+        if args.salida:
+            if args.salida.lower().endswith('.csv'):
+                result.to_csv(args.salida, index=False)
+            else:
+                result.to_excel(args.salida, index=False)
+            print(f"{len(result)} filas guardadas en: {args.salida}")
+        elif result.empty:
+            print("Sin resultados.")
+        else:
+            with pd.option_context('display.max_rows', 200, 'display.max_columns', None, 'display.width', 200):
+                print(result)
+        print(f"({len(result)} filas, {elapsed*1000:.1f} ms)")
+    elif args.command == 'cache':
+        if args.accion == 'clear':
+            print(f"Caché de reportes eliminada: {clear_cache()} entrada(s) en {CACHE_DIR} "
+                  f"(se conservan el almacén, la tabla de identidades y los puntos de control)")
+        else:
+            print_cache_manifest()
+    else:
+        run_interactive(workers=args.workers, use_cache=not args.no_cache,
+                        resolve_identities=args.unificar_clientes, strategy=args.plan,
+                        by_source=args.por_archivo, with_index=args.indice,
+                        checkpoint_dir=resume_checkpoint_dir(args.puntos_control or args.reanudar,
+                                                             args.reanudar is not None),
+                        resume=args.reanudar is not None, spec=spec, folder=args.carpeta, period=args.periodo,
+                        date_col=args.columna_fecha, period_format=args.formato_periodo, sheets=args.hojas,
+                        store=args.almacen, sample=args.muestra)
+
+if __name__=='__main__':
+    main()
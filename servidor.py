@@ -0,0 +1,278 @@
+"""
+Modo servidor local: expone el procesamiento de programGem por una pequeña API
+HTTP para que varios usuarios de la misma máquina encolen sus reportes en lugar
+de competir por CPU y memoria.
+
+  POST /jobs               {"mode": "debito", "subtract_discount": false, "by_source": false,
+                            "sheets": "Caja*" (opcional, "*" = todas las hojas),
+                            "paths": ["C:/ventas/ene.xlsx", ...]}
+                           o bien "files": [{"name": "ene.xlsx", "data": "<base64>"}]
+  GET  /jobs               lista de trabajos
+  GET  /jobs/<id>          estado: queued / running / done / error
+  GET  /jobs/<id>/result   reporte .xlsx (?part=N para las demás partes o reportes por archivo)
+
+Los trabajos se ejecutan en un pool de procesos acotado. Cada uno reserva una
+estimación de memoria basada en el tamaño de sus archivos; si no cabe en el
+presupuesto espera en la cola (en orden de llegada) en vez de saturar la máquina.
+
+Uso: python servidor.py --puerto 8765 --procesos 2 --memoria-mb 4096
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit, parse_qs
+
+from programGem import run_report
+
+# Bytes de memoria estimados por byte de .xlsx comprimido (lectura + copias de pandas)
+MEMORY_FACTOR = 12
+MAX_BODY_BYTES = 1024**3
+MODES = ('debito', 'credito', 'split')
+
+
+def estimate_job_memory(paths):
+    return sum(os.path.getsize(p) for p in paths) * MEMORY_FACTOR
+
+
+def default_memory_budget():
+    """La mitad de la RAM física si se puede consultar, si no 4 GB."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024**3
+
+
+class JobServer:
+    """Cola de trabajos con límite de procesos y de memoria. dispatch() no depende de sockets."""
+
+    def __init__(self, work_dir=None, max_procs=2, memory_budget=None, executor=None):
+        self.work_dir = work_dir or tempfile.mkdtemp(prefix='docuflow_jobs_')
+        self.max_procs = max_procs
+        self.memory_budget = memory_budget or default_memory_budget()
+        self.executor = executor or ProcessPoolExecutor(max_workers=max_procs)
+        self.jobs = {}
+        self._queue = []
+        self._running = 0
+        self._memory_in_use = 0
+        self._cond = asyncio.Condition()
+        self._tasks = set()
+
+    # --- Trabajos ---
+
+    def submit(self, payload):
+        """Valida la solicitud, guarda los archivos subidos y encola el trabajo."""
+        if not isinstance(payload, dict):
+            raise ValueError("El cuerpo de la solicitud debe ser un objeto JSON.")
+        mode = payload.get('mode')
+        if mode not in MODES:
+            raise ValueError(f"Modo inválido: {mode}")
+        paths = payload.get('paths') or []
+        files = payload.get('files') or []
+        if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+            raise ValueError("'paths' debe ser una lista de rutas.")
+        if not isinstance(files, list) or not all(isinstance(f, dict) for f in files):
+            raise ValueError("'files' debe ser una lista de objetos {name, data}.")
+        job_id = uuid.uuid4().hex[:12]
+        job_dir = os.path.join(self.work_dir, job_id)
+        os.makedirs(job_dir)
+
+        paths = list(paths)
+        try:
+            for i, f in enumerate(files):
+                name = os.path.basename(f.get('name') or f'archivo{i+1}.xlsx')
+                path = os.path.join(job_dir, f'{i:03d}_{name}')
+                with open(path, 'wb') as out:
+                    out.write(base64.b64decode(f['data'], validate=True))
+                paths.append(path)
+        except (KeyError, TypeError, ValueError) as e:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise ValueError(f"Archivo subido inválido: {e!r}")
+        if not paths:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise ValueError("No se indicaron archivos.")
+        bad = [p for p in paths if not os.path.isfile(p) or not p.lower().endswith('.xlsx')]
+        if bad:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise ValueError(f"Archivos .xlsx no válidos: {bad}")
+
+        job = {
+            'id': job_id, 'mode': mode, 'state': 'queued',
+            'subtract_discount': bool(payload.get('subtract_discount')),
+            'by_source': bool(payload.get('by_source')),
+            'sheets': payload.get('sheets') or None,
+            'files': [os.path.basename(p) for p in paths], 'paths': paths,
+            'estimate': estimate_job_memory(paths), 'dir': job_dir,
+            'submitted': time.time(), 'started': None, 'finished': None,
+            'outputs': [], 'error': None,
+        }
+        self.jobs[job_id] = job
+        self._queue.append(job_id)
+        task = asyncio.get_running_loop().create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        print(f"[Servidor] Trabajo {job_id} encolado ({mode}, {len(paths)} archivo(s), ~{job['estimate']//1024**2} MB)")
+        return job
+
+    def _can_start(self, job):
+        if self._queue[0] != job['id'] or self._running >= self.max_procs:
+            return False
+        # un trabajo más grande que el presupuesto corre solo
+        return self._running == 0 or self._memory_in_use + job['estimate'] <= self.memory_budget
+
+    async def _run(self, job):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._can_start(job))
+            self._queue.pop(0)
+            self._running += 1
+            self._memory_in_use += job['estimate']
+            self._cond.notify_all()
+        job['state'], job['started'] = 'running', time.time()
+        print(f"[Servidor] Trabajo {job['id']} iniciado")
+        try:
+            loop = asyncio.get_running_loop()
+            job['outputs'] = await loop.run_in_executor(
+                self.executor, partial(run_report, job['paths'], job['mode'], os.path.join(job['dir'], 'salida'),
+                                       job['subtract_discount'], by_source=job['by_source'], sheets=job['sheets']))
+            job['state'] = 'done'
+        except Exception as e:
+            job['state'], job['error'] = 'error', str(e)
+            print(f"[Servidor] Trabajo {job['id']} falló: {e}")
+        finally:
+            job['finished'] = time.time()
+            async with self._cond:
+                self._running -= 1
+                self._memory_in_use -= job['estimate']
+                self._cond.notify_all()
+        print(f"[Servidor] Trabajo {job['id']} terminado: {job['state']}")
+
+    def status(self, job):
+        info = {k: job[k] for k in ('id', 'mode', 'subtract_discount', 'by_source', 'sheets', 'files', 'state',
+                                    'submitted', 'started', 'finished', 'error')}
+        info['estimate_mb'] = round(job['estimate'] / 1024**2, 1)
+        info['parts'] = [os.path.basename(p) for p in job['outputs']]
+        if job['state'] == 'queued':
+            info['queue_position'] = self._queue.index(job['id']) + 1
+        return info
+
+    # --- HTTP ---
+
+    async def dispatch(self, method, target, body=b''):
+        """Atiende una solicitud y devuelve (status, content_type, bytes)."""
+        url = urlsplit(target)
+        parts = [p for p in url.path.split('/') if p]
+        try:
+            if parts == ['jobs'] and method == 'POST':
+                job = self.submit(json.loads(body or b'{}'))
+                return self._json(202, self.status(job))
+            if parts == ['jobs'] and method == 'GET':
+                return self._json(200, [self.status(j) for j in self.jobs.values()])
+            if len(parts) in (2, 3) and parts[0] == 'jobs' and method == 'GET':
+                job = self.jobs.get(parts[1])
+                if job is None:
+                    return self._json(404, {'error': 'Trabajo no encontrado'})
+                if len(parts) == 2:
+                    return self._json(200, self.status(job))
+                if parts[2] == 'result':
+                    if job['state'] != 'done':
+                        return self._json(409, {'error': f"El trabajo está en estado '{job['state']}'"})
+                    part = int(parse_qs(url.query).get('part', ['1'])[0])
+                    if not 1 <= part <= len(job['outputs']):
+                        return self._json(404, {'error': f'Parte {part} no existe'})
+                    with open(job['outputs'][part - 1], 'rb') as f:
+                        return 200, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', f.read()
+            return self._json(404, {'error': 'Ruta no encontrada'})
+        except (ValueError, KeyError, json.JSONDecodeError) as e:
+            return self._json(400, {'error': str(e)})
+
+    @staticmethod
+    def _json(status, obj):
+        return status, 'application/json', json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    async def handle_connection(self, reader, writer):
+        status, ctype, payload = 400, 'application/json', b'{}'
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                k, v = line.decode('latin-1').split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+            length = int(headers.get('content-length', 0))
+            if length > MAX_BODY_BYTES:
+                status, ctype, payload = self._json(413, {'error': 'Solicitud demasiado grande'})
+            else:
+                body = await reader.readexactly(length) if length else b''
+                status, ctype, payload = await self.dispatch(method, target, body)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, ctype, payload = self._json(400, {'error': f'Solicitud HTTP inválida: {e}'})
+        reason = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found',
+                  409: 'Conflict', 413: 'Payload Too Large'}.get(status, '')
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {ctype}\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode('latin-1') + payload)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"[Servidor] Escuchando en http://{host}:{port} "
+              f"({self.max_procs} procesos, {self.memory_budget//1024**2} MB de presupuesto)")
+        async with server:
+            await server.serve_forever()
+
+
+class LocalClient:
+    """Cliente en el mismo proceso: llama a dispatch() sin abrir sockets (útil para pruebas)."""
+
+    def __init__(self, server):
+        self.server = server
+
+    async def request(self, method, target, obj=None):
+        body = json.dumps(obj).encode('utf-8') if obj is not None else b''
+        status, ctype, payload = await self.server.dispatch(method, target, body)
+        return status, (json.loads(payload) if ctype == 'application/json' else payload)
+
+    async def submit(self, mode, paths, subtract_discount=False):
+        return await self.request('POST', '/jobs', {'mode': mode, 'paths': paths,
+                                                    'subtract_discount': subtract_discount})
+
+    async def wait(self, job_id, interval=0.2):
+        while True:
+            status, info = await self.request('GET', f'/jobs/{job_id}')
+            if status != 200 or info['state'] in ('done', 'error'):
+                return info
+            await asyncio.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor local de reportes de ventas")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--puerto', type=int, default=8765)
+    parser.add_argument('--procesos', type=int, default=2, help="Trabajos simultáneos como máximo")
+    parser.add_argument('--memoria-mb', type=int, default=None,
+                        help="Presupuesto de memoria para trabajos simultáneos (por defecto media RAM)")
+    parser.add_argument('--carpeta', default=None, help="Carpeta de trabajo para archivos y resultados")
+    args = parser.parse_args(argv)
+
+    async def run():
+        server = JobServer(args.carpeta, args.procesos,
+                           args.memoria_mb * 1024**2 if args.memoria_mb else None)
+        await server.serve(args.host, args.puerto)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("[Servidor] Detenido.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import ast
+import os
+import sys
+import tempfile
+import types
+
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# la caché, la tabla de identidades y el almacén de las pruebas no tocan los del usuario
+os.environ['DOCUFLOW_CACHE_DIR'] = tempfile.mkdtemp(prefix='docuflow_test_cache_')
+os.environ.pop('DOCUFLOW_ALMACEN', None)
+
+
+def sales_frame(n_rows=60, n_clients=6, seed=0):
+    """Ventas sintéticas con las columnas que exige programGem."""
+    rng = pd.Series(range(n_rows))
+    client = rng % n_clients
+    return pd.DataFrame({
+        'UNIDADES': (rng % 5) - 2,
+        'NOMBRECLIENTE': 'CLIENTE ' + client.astype(str),
+        'TIPO_DE_DOCUMENTO': '13 CC',
+        'IDENTIFICACION': 1000 + client,
+        'PRIMER_APELLIDO': 'A', 'SEGUNDO_APELLIDO': 'B',
+        'PRIMER_NOMBRE': 'C', 'OTROS_NOMBRES': 'D',
+        'MontoBruto': (rng * 7 + seed) % 300 + 0.25,
+        'Descuento': (rng % 4) * 1.5,
+        'IVA': (rng % 3) * 2.0,
+    })
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    """Crea un .xlsx con ventas sintéticas y devuelve su ruta."""
+    def make(name='ventas.xlsx', df=None, **kwargs):
+        path = str(tmp_path / name)
+        (sales_frame(**kwargs) if df is None else df).to_excel(path, index=False)
+        return path
+    return make
+
+
+GUI_SKIP_MODULES = ('flet', 'tkinter')
+
+
+@pytest.fixture(scope='session')
+def gui():
+    """
+    Funciones de nivel superior de intefaz.py sin importar flet ni tkinter
+    (no están en el entorno de pruebas): se ejecutan sus imports, funciones y
+    variables, y se omite la interfaz (main).
+    """
+    path = os.path.join(ROOT, 'intefaz.py')
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    ns = {'__name__': 'intefaz'}
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            keep = not any(a.name.split('.')[0] in GUI_SKIP_MODULES for a in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            keep = (node.module or '').split('.')[0] not in GUI_SKIP_MODULES
+        else:
+            keep = isinstance(node, (ast.FunctionDef, ast.ClassDef, ast.Assign)) and getattr(node, 'name', None) != 'main'
+        if keep:
+            exec(compile(ast.Module([node], []), path, 'exec'), ns)
+    return types.SimpleNamespace(**ns)
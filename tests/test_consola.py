@@ -0,0 +1,31 @@
+import pytest
+
+import programGem as pg
+
+
+@pytest.fixture
+def console(monkeypatch, tmp_path):
+    """Corre run_interactive con respuestas fijas y registra las preguntas de división."""
+    asked = []
+    monkeypatch.setattr(pg, 'ask_split_into', lambda reason: asked.append(reason) or 'files')
+
+    def run(path, out_name, **kwargs):
+        answers = iter(['1', path, 'debito', 'n', str(tmp_path / out_name)])
+        monkeypatch.setattr('builtins.input', lambda prompt='': next(answers))
+        pg.run_interactive(**kwargs)
+        return asked
+    return run
+
+
+def test_split_question_follows_report_size(console, workbook, monkeypatch):
+    path = workbook(n_rows=60, n_clients=6, seed=7)
+    # entrada de 60 filas, reporte de 6 clientes
+    monkeypatch.setattr(pg, 'EXCEL_MAX_ROWS', 21)
+    assert console(path, 'a') == []
+    assert console(path, 'b') == []  # desde la caché
+    monkeypatch.setattr(pg, 'EXCEL_MAX_ROWS', 4)
+    # la entrada en caché ya dice que el reporte no cabe: se pregunta una vez y se reprocesa
+    assert len(console(path, 'c')) == 1
+    # la variante en archivos quedó en caché
+    assert len(console(path, 'd')) == 2
+    assert pg.cached_report_rows(pg.cache_key([path], 'debito', False, split_into='files')) == 6
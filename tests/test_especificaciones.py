@@ -0,0 +1,35 @@
+import pytest
+
+import programGem as pg
+
+BASE = {'nombre': 'prueba', 'claves': ['NOMBRECLIENTE'], 'sumas': {'MontoBruto': 'MontoBruto', 'Descuento': 'Descuento'}}
+
+
+@pytest.mark.parametrize('changes, message', [
+    ({'nombre': None}, "necesita un 'nombre'"),
+    ({'claves': []}, "'claves' no puede estar vacío"),
+    ({'filtros': [{'columna': 'UNIDADES', 'op': '=>', 'valor': 0}]}, 'Operador de filtro inválido: =>'),
+    ({'por_signo': {'Neto': ['MontoBruto', '*']}}, "Signo inválido para 'Neto'"),
+    ({'primero': {'MontoBruto': 'IVA'}}, 'Columnas de salida repetidas'),
+    ({'primero': {'Doc': 'NOMBRECLIENTE'}}, 'Columnas de entrada usadas más de una vez'),
+    ({'sumas': {'MontoBruto': 'MontoBruto', 'Bruto': 'MontoBruto'}}, 'Columnas de entrada usadas más de una vez'),
+    ({'ajustes': [{'restar': 'IVA', 'de': ['MontoBruto']}]}, 'Los ajustes solo pueden usar montos del reporte'),
+    ({'columnas': ['NOMBRECLIENTE', 'Iva']}, "'columnas' incluye columnas que el reporte no genera: \\['Iva'\\]"),
+])
+def test_invalid_specs_are_rejected(changes, message):
+    with pytest.raises(ValueError, match=message):
+        pg.compile_spec({**BASE, **changes})
+
+
+def test_compiled_plan():
+    spec = pg.compile_spec({**BASE, 'filtros': [{'columna': 'UNIDADES', 'op': 'en', 'valor': [1, 2]}],
+                            'primero': {'ID': 'IDENTIFICACION'},
+                            'por_signo': {'Bruto +': ['MontoBruto', '+']},
+                            'sumas': {'Descuento': 'Descuento'},
+                            'ajustes': [{'restar': 'Descuento', 'de': ['Bruto +']}]})
+    assert spec['columns'] == ['NOMBRECLIENTE', 'ID', 'Descuento', 'Bruto +']
+    assert spec['agg'] == {'IDENTIFICACION': 'first', 'Descuento': 'sum', 'Bruto +': 'sum'}
+    assert spec['required'] == ['UNIDADES', 'NOMBRECLIENTE', 'IDENTIFICACION', 'Descuento', 'MontoBruto']
+    assert spec['rename'] == {'IDENTIFICACION': 'ID'}
+    assert spec['output_name'] == 'reporte_prueba.xlsx'
+    assert (spec['label_col'], spec['id_col'], spec['by_client']) == ('NOMBRECLIENTE', 'IDENTIFICACION', False)
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import programGem as pg
+
+
+@pytest.fixture
+def frame():
+    rng = np.random.default_rng(7)
+    n = 3000
+    names = pd.Series(rng.integers(0, 300, n)).map(lambda c: f'CLIENTE {c}').astype(object)
+    names[rng.random(n) < 0.05] = np.nan  # claves nulas: groupby las descarta
+    ids = pd.Series(rng.integers(0, 300, n), dtype=float)
+    ids[rng.random(n) < 0.05] = np.nan
+    source = pd.Categorical(rng.choice(['b.xlsx', 'a.xlsx', 'c.xlsx'], n),
+                            categories=['b.xlsx', 'a.xlsx', 'c.xlsx', 'sin_filas.xlsx'])
+    first = pd.Series(rng.choice(['x', 'y', None], n), dtype=object)
+    return pd.DataFrame({'ORIGEN': source, 'NOMBRECLIENTE': names, 'IDENTIFICACION': ids,
+                         'UNIDADES': rng.integers(-3, 4, n), 'MontoBruto': rng.normal(100, 50, n).round(2),
+                         'TIPO': first})
+
+
+@pytest.fixture(autouse=True)
+def always_parallel(monkeypatch):
+    monkeypatch.setattr(pg, 'PARALLEL_MIN_ROWS', 0)
+
+
+@pytest.mark.parametrize('keys', [['NOMBRECLIENTE'], ['NOMBRECLIENTE', 'IDENTIFICACION'],
+                                  ['ORIGEN', 'NOMBRECLIENTE', 'IDENTIFICACION']])
+@pytest.mark.parametrize('workers', [2, 3])
+def test_parallel_groupby_matches_serial(frame, keys, workers):
+    agg = {'UNIDADES': 'sum', 'MontoBruto': 'sum', 'TIPO': 'first'}
+    expected = frame.groupby(keys, as_index=False, observed=True).agg(agg)
+    result = pg.parallel_groupby(frame, keys, agg, workers=workers)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False)
+
+
+def test_process_data_parallel_matches_serial():
+    df = pg._synthetic_sales(5000, 400)
+    for mode in ('debito', 'credito', 'split'):
+        pd.testing.assert_frame_equal(pg.process_data(df, mode, workers=2), pg.process_data(df, mode),
+                                      check_exact=False)
@@ -0,0 +1,53 @@
+import pandas as pd
+import pytest
+
+import programGem as pg
+
+
+def resolve(pairs, mapping_path=None):
+    """pairs: [(nombre, identificación, repeticiones)] -> {nombre original: canónico}."""
+    rows = [(name, ident) for name, ident, n in pairs for _ in range(n)]
+    df = pd.DataFrame(rows, columns=['NOMBRECLIENTE', 'IDENTIFICACION'])
+    original = df['NOMBRECLIENTE'].copy()
+    resolved = pg.resolve_client_identities(df, mapping_path)['NOMBRECLIENTE']
+    return dict(zip(original, resolved))
+
+
+def test_exact_normalization_merges_under_most_frequent_name():
+    result = resolve([('Juan  Pérez', '1', 1), ('JUAN PEREZ', '1', 3), ('PEREZ, JUAN', '1', 2)])
+    assert set(result.values()) == {'JUAN PEREZ'}
+
+
+def test_token_containment_and_jaccard_inside_one_id():
+    result = resolve([('JUAN CARLOS PEREZ', '1', 2), ('JUAN PEREZ', '1', 1), ('JUAN', '1', 1),
+                      ('MARIA DE LOS ANGELES GOMEZ DEL RIO', '2', 2), ('MARIA DE LOS ANGELES GOMEZ DEL VALLE', '2', 1),
+                      ('ANA LOPEZ', '3', 2), ('ANA GOMEZ', '3', 1)])
+    assert result['JUAN PEREZ'] == 'JUAN CARLOS PEREZ'
+    assert result['JUAN'] == 'JUAN'  # un solo token no basta para la contención
+    assert result['MARIA DE LOS ANGELES GOMEZ DEL VALLE'] == 'MARIA DE LOS ANGELES GOMEZ DEL RIO'  # Jaccard 6/8
+    assert result['ANA GOMEZ'] == 'ANA GOMEZ'
+
+
+def test_names_are_never_merged_across_ids():
+    result = resolve([('JUAN PEREZ', '1', 3), ('JUAN CARLOS PEREZ', '2', 1), ('juan perez', '2', 1)])
+    assert result['JUAN CARLOS PEREZ'] == 'JUAN CARLOS PEREZ'
+    assert result['juan perez'] == 'JUAN CARLOS PEREZ'
+
+
+def test_large_blocks_only_merge_exact_names(monkeypatch):
+    monkeypatch.setattr(pg, 'IDENTITY_MAX_BLOCK', 2)
+    result = resolve([('JUAN CARLOS PEREZ', '1', 3), ('JUAN PEREZ', '1', 1), ('CARLOS PEREZ', '1', 1),
+                      ('PEREZ JUAN', '1', 2)])
+    assert result == {'JUAN CARLOS PEREZ': 'JUAN CARLOS PEREZ', 'JUAN PEREZ': 'PEREZ JUAN',
+                      'CARLOS PEREZ': 'CARLOS PEREZ', 'PEREZ JUAN': 'PEREZ JUAN'}
+
+
+def test_new_variants_join_the_saved_canonical_name(tmp_path):
+    mapping = str(tmp_path / 'identidades.csv')
+    resolve([('JUAN PEREZ', '1', 1), ('ANA GOMEZ', '2', 1)], mapping)
+    # la variante nueva es más frecuente, pero el nombre ya publicado se mantiene
+    result = resolve([('JUAN PEREZ', '1', 1), ('JUAN CARLOS PEREZ', '1', 5)], mapping)
+    assert set(result.values()) == {'JUAN PEREZ'}
+    saved = pd.read_csv(mapping, dtype=str)
+    assert len(saved) == 3  # solo se agregó el par nuevo
+    assert saved.iloc[-1].tolist() == ['JUAN CARLOS PEREZ', '1', 'JUAN PEREZ']
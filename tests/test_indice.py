@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import programGem as pg
+from conftest import sales_frame
+
+
+@pytest.fixture
+def indexed(workbook, tmp_path):
+    df = sales_frame(n_rows=80, n_clients=5)
+    df['FECHA'] = pd.Timestamp('2024-01-01') + pd.to_timedelta(np.arange(80), unit='D')
+    df.loc[3, 'OTROS_NOMBRES'] = None
+    path = workbook(df=df)
+    index = {}
+    pg.process_files([path], 'debito', plan=pg.plan_execution([path], 'memoria'), index_out=index)
+    index_path = pg.save_drilldown_index(str(tmp_path / 'reporte.indice.npz'), index, [path])
+    return index_path, pd.read_excel(path)
+
+
+def test_explain_client_returns_contributing_rows(indexed, monkeypatch):
+    index_path, source = indexed
+    # la consulta no vuelve a abrir los libros
+    monkeypatch.setattr(pg.openpyxl, 'load_workbook', lambda *a, **k: pytest.fail('libro reabierto'))
+    rows = pg.explain_client(index_path, 'cliente 3')
+    expected = source[(source['NOMBRECLIENTE'] == 'CLIENTE 3') & (source['UNIDADES'] > 0)]
+    assert rows['FILA'].tolist() == (expected.index + 2).tolist()
+    assert rows['MontoBruto'].tolist() == expected['MontoBruto'].tolist()
+    assert (rows['FECHA'].to_numpy() == expected['FECHA'].to_numpy()).all()
+    assert set(rows['ARCHIVO']) == {'ventas.xlsx'}
+    assert rows['IDENTIFICACION'].tolist() == pg.explain_client(index_path, '1003')['IDENTIFICACION'].tolist()
+
+
+def test_explain_client_limits_rows_and_keeps_blanks(indexed):
+    index_path, source = indexed
+    rows = pg.explain_client(index_path, 'CLIENTE 3', max_rows=2)
+    assert len(rows) == 2
+    assert pg.explain_client(index_path, 'NADIE').empty
+    blank = pg.explain_client(index_path, source.loc[3, 'NOMBRECLIENTE'])
+    assert blank.loc[blank['FILA'] == 5, 'OTROS_NOMBRES'].isna().all()
+
+
+@pytest.fixture
+def custom_mode(monkeypatch):
+    for name in ('SPECS', 'FINAL_COLS', 'OUTPUT_NAMES'):
+        monkeypatch.setattr(pg, name, dict(getattr(pg, name)))
+    return pg.register_spec({'claves': ['PRIMER_APELLIDO'], 'sumas': {'MontoBruto': 'MontoBruto'}}, 'por_apellido')
+
+
+def test_custom_spec_index_is_labelled_by_its_key(custom_mode, workbook, tmp_path):
+    df = sales_frame(n_rows=20, n_clients=4)
+    df['PRIMER_APELLIDO'] = np.where(df.index % 2, 'GOMEZ', 'RUIZ')
+    path = workbook(df=df)
+    index = {}
+    pg.process_files([path], custom_mode, plan=pg.plan_execution([path], 'memoria'), index_out=index)
+    index_path = pg.save_drilldown_index(str(tmp_path / 'reporte.indice.npz'), index, [path])
+    rows = pg.explain_client(index_path, 'gomez')
+    assert rows['FILA'].tolist() == (df.index[df.index % 2 == 1] + 2).tolist()
+    assert pg.explain_client(index_path, '').empty
@@ -0,0 +1,25 @@
+import pandas as pd
+import pytest
+
+import programGem as pg
+from conftest import sales_frame
+
+
+def test_by_source_groups_only_observed_combinations(gui):
+    a, b = sales_frame(n_rows=20, n_clients=2), sales_frame(n_rows=20, n_clients=4, seed=1)
+    labels = ['a.xlsx', 'b.xlsx', 'vacio.xlsx']
+    for df, label in ((a, 'a.xlsx'), (b, 'b.xlsx')):
+        df[pg.SOURCE_COL] = pd.Categorical([label] * len(df), categories=labels)
+    result = gui.process_data_internal_sync(pd.concat([a, b], ignore_index=True), 'credito', by_source=True)
+    pairs = set(zip(result[pg.SOURCE_COL].astype(str), result['NOMBRECLIENTE']))
+    assert pairs == {('a.xlsx', f'CLIENTE {i}') for i in range(2)} | {('b.xlsx', f'CLIENTE {i}') for i in range(4)}
+
+
+@pytest.mark.parametrize('mode', ['debito', 'credito', 'split'])
+def test_gui_runs_the_console_spec(gui, mode):
+    df = sales_frame(n_rows=90, n_clients=6)
+    console = pg.process_data(df.copy(), mode)
+    window = gui.process_data_internal_sync(df.copy(), mode)
+    assert window.columns.tolist() == console.columns.tolist() == gui.SAVE_COLUMNS[mode]
+    pd.testing.assert_frame_equal(window.sort_values('NOMBRECLIENTE', ignore_index=True),
+                                  console.sort_values('NOMBRECLIENTE', ignore_index=True), check_dtype=False)
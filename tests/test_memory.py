@@ -0,0 +1,85 @@
+import contextlib
+import io
+
+import pandas as pd
+import pytest
+
+import programGem as pg
+
+MODES = ('debito', 'credito', 'split')
+N_ROWS, N_CLIENTS = 50000, 5000
+# process_data_internal_sync sobre el espacio de trabajo ya preparado: ~0.8x sin copias,
+# más de 1.1x con una copia defensiva del filtro (2x en split)
+GUI_MAX_FACTOR = 1.0
+# guardar solo reordena columnas que ya son numéricas: casi nada frente a copiar el reporte (1.0x)
+SAVE_MAX_FACTOR = 0.25
+
+
+def buffer_bytes(df):
+    """Tamaño de los buffers del DataFrame: los textos no se copian, solo sus punteros."""
+    return df.memory_usage(deep=False).sum()
+
+
+def quiet_peak(func, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return pg.peak_memory(func, *args, **kwargs)
+
+
+@pytest.fixture(scope='module')
+def sales():
+    return pg._synthetic_sales(N_ROWS, N_CLIENTS)
+
+
+@pytest.fixture(scope='module')
+def workspace(sales, gui):
+    """El DataFrame combinado y preparado que la GUI reutiliza entre reportes."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return gui.prepare_dataset(sales.copy())
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_cli_process_data_peak(sales, mode):
+    snapshot = sales.copy()
+    _, peak = quiet_peak(pg.process_data, sales, mode)
+    assert peak / buffer_bytes(sales) <= pg.MEMORY_MAX_FACTOR[mode]
+    pd.testing.assert_frame_equal(sales, snapshot)
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_gui_process_data_peak(workspace, gui, mode):
+    result, peak = quiet_peak(gui.process_data_internal_sync, workspace, mode)
+    assert 'ProcessingError' not in result.columns and len(result) > 0
+    assert peak / buffer_bytes(workspace) <= GUI_MAX_FACTOR
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_gui_save_path_peak(workspace, gui, mode):
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = gui.process_data_internal_sync(workspace, mode)
+    snapshot = result.copy()
+    to_save, peak = quiet_peak(gui.frame_to_save, result, gui.SAVE_COLUMNS[mode])
+    assert to_save.columns.tolist() == gui.SAVE_COLUMNS[mode]
+    assert peak / buffer_bytes(result) <= SAVE_MAX_FACTOR
+    pd.testing.assert_frame_equal(result, snapshot)
+
+
+def test_gui_runs_leave_workspace_unmodified(workspace, gui):
+    snapshot = workspace.copy()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for mode in MODES:
+            result = gui.process_data_internal_sync(workspace, mode)
+            to_save = gui.frame_to_save(result, gui.SAVE_COLUMNS[mode])
+            to_save['MontoBruto' if mode != 'split' else 'MontoBruto Positivo'] = 0.0
+        gui.process_data_internal_sync(workspace, 'debito', by_source=False, resolve_identities=True)
+    pd.testing.assert_frame_equal(workspace, snapshot)
+    assert workspace.attrs.get('preparado')
+
+
+def test_frame_to_save_fills_missing_amounts(gui):
+    final = pd.DataFrame({'NOMBRECLIENTE': ['A', 'B'], 'IDENTIFICACION': [1, 2],
+                          'MontoBruto': ['10.5', None], 'Descuento': [1.0, float('nan')], 'Iva': [0, 1]})
+    to_save = gui.frame_to_save(final, gui.SAVE_COLUMNS['debito'])
+    assert to_save['MontoBruto'].tolist() == [10.5, 0.0]
+    assert to_save['Descuento'].tolist() == [1.0, 0.0]
+    assert to_save['TIPO DE DOCUMENTO'].isna().all()
+    assert final['MontoBruto'].iloc[0] == '10.5'
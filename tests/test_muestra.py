@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+
+import programGem as pg
+from conftest import sales_frame
+
+
+def two_ids_frame():
+    """Un mismo nombre con dos identificaciones: la GUI los separa, la CLI los une."""
+    df = sales_frame(n_rows=40, n_clients=4)
+    df.loc[df['NOMBRECLIENTE'] == 'CLIENTE 1', 'IDENTIFICACION'] = [1001, 2001] * 5
+    return df
+
+
+def test_full_sample_matches_cli_run(workbook):
+    path = workbook(df=sales_frame(n_rows=40))
+    preview, strata = pg.preview_report([path], 'debito', rows=1000)
+    full = pg.process_files([path], 'debito', plan=pg.plan_execution([path], 'memoria'))
+    assert strata['FACTOR'].tolist() == [1.0]
+    pd.testing.assert_frame_equal(preview, full, check_dtype=False)
+
+
+def test_gui_preview_uses_gui_keys(workbook, gui):
+    path = workbook(df=two_ids_frame())
+    process_chunk, keys = gui.chunk_processor('debito')
+    preview, _ = pg.preview_report([path], 'debito', rows=1000, process_chunk=process_chunk, keys=keys)
+    full = gui.process_data_internal_sync(pg.load_files([path]), 'debito')
+    cli_preview, _ = pg.preview_report([path], 'debito', rows=1000)
+
+    assert len(preview) == len(full) == len(cli_preview) + 1
+    assert set(preview.loc[preview['NOMBRECLIENTE'] == 'CLIENTE 1', 'IDENTIFICACION']) == {1001, 2001}
+    for c in ('MontoBruto', 'Descuento', 'Iva'):
+        assert preview[c].sum() == pytest.approx(full[c].sum())
+
+
+def test_gui_preview_by_source_keeps_one_row_per_file(workbook, gui):
+    files = [workbook('a.xlsx', df=two_ids_frame()), workbook('b.xlsx', n_clients=3, seed=5)]
+    process_chunk, keys = gui.chunk_processor('credito', by_source=True)
+    preview, strata = pg.preview_report(files, 'credito', rows=1000, by_source=True,
+                                        process_chunk=process_chunk, keys=keys)
+    assert pg.SOURCE_COL in preview.columns
+    assert set(preview[pg.SOURCE_COL].astype(str)) == set(strata['ARCHIVO'])
+    full = gui.process_data_internal_sync(pg.load_files(files, tag_source=True), 'credito', by_source=True)
+    assert len(preview) == len(full)
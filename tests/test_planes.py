@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import programGem as pg
+from conftest import sales_frame
+
+
+@pytest.fixture
+def blank_rows_book(workbook):
+    """Libro con filas en blanco intercaladas (las filas 3 y 10 de Excel)."""
+    df = sales_frame(n_rows=30)
+    blank = pd.DataFrame([[np.nan] * df.shape[1]], columns=df.columns)
+    df = pd.concat([df.iloc[:1], blank, df.iloc[1:7], blank, df.iloc[7:]], ignore_index=True)
+    return workbook('con_blancos.xlsx', df=df)
+
+
+@pytest.mark.parametrize('mode', ['debito', 'credito', 'split'])
+def test_plans_agree_on_blank_rows(blank_rows_book, mode):
+    results, controls = {}, {}
+    for strategy in pg.STRATEGIES:
+        plan = pg.plan_execution([blank_rows_book], strategy)
+        controls[strategy] = []
+        results[strategy] = pg.process_files([blank_rows_book], mode, plan=plan, controls_out=controls[strategy])
+    first = results['memoria']
+    assert 'nan' not in set(first['NOMBRECLIENTE'].astype(str))
+    for strategy in pg.STRATEGIES[1:]:
+        pd.testing.assert_frame_equal(results[strategy].reset_index(drop=True), first.reset_index(drop=True),
+                                      check_dtype=False)
+        assert sum(c['FILAS'].sum() for c in controls[strategy]) == sum(c['FILAS'].sum() for c in controls['memoria']) == 30
+
+
+def test_row_positions_skip_blank_rows(blank_rows_book):
+    df = pg.load_files([blank_rows_book], track_rows=True)
+    assert len(df) == 30
+    assert df[pg.ROW_POS_COL].tolist()[:3] == [2, 4, 5]
+    assert 10 not in set(df[pg.ROW_POS_COL])
@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+
+import programGem as pg
+
+
+@pytest.fixture(autouse=True)
+def isolated_record(tmp_path, monkeypatch):
+    monkeypatch.setattr(pg, 'LAST_CHECKPOINT_PATH', str(tmp_path / 'cache' / 'ultimo_punto_control.txt'))
+
+
+def test_resume_uses_folder_of_interrupted_run(tmp_path, workbook, monkeypatch):
+    files = [workbook('a.xlsx'), workbook('b.xlsx', seed=3)]
+    expected = pg.process_files(files, 'debito', plan=pg.plan_execution(files, 'memoria'))
+    work_dir = str(tmp_path / 'mis_puntos')
+
+    process_files, calls = pg.process_files, []
+    def interrupted(*args, **kwargs):
+        calls.append(args[0])
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        return process_files(*args, **kwargs)
+    monkeypatch.setattr(pg, 'process_files', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        pg.process_files_checkpointed(files, 'debito', work_dir)
+    monkeypatch.setattr(pg, 'process_files', process_files)
+
+    # '--reanudar' sin carpeta
+    resume_dir = pg.resume_checkpoint_dir(None, resume=True)
+    assert resume_dir == work_dir
+    calls.clear()
+    monkeypatch.setattr(pg, 'process_files', interrupted)
+    result = pg.process_files_checkpointed(files, 'debito', resume_dir, resume=True)
+    assert calls == [[files[1]]]
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_resume_checkpoint_dir_defaults():
+    assert pg.resume_checkpoint_dir(None, resume=False) is None
+    assert pg.resume_checkpoint_dir('otra', resume=True) == 'otra'
+    assert pg.resume_checkpoint_dir(None, resume=True) == pg.CHECKPOINT_DIR
@@ -0,0 +1,140 @@
+import asyncio
+import base64
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+import servidor
+from servidor import JobServer, LocalClient
+
+
+def run(coro_fn, tmp_path, **kwargs):
+    """Ejecuta coro_fn(client, server) con un servidor que usa hilos en lugar de procesos."""
+    async def main():
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            server = JobServer(str(tmp_path / 'trabajos'), max_procs=1, executor=pool, **kwargs)
+            return await coro_fn(LocalClient(server), server)
+    return asyncio.run(main())
+
+
+def test_submit_runs_job_and_serves_result(tmp_path, workbook):
+    path = workbook()
+
+    async def scenario(client, server):
+        status, info = await client.submit('debito', [path])
+        assert status == 202 and info['state'] == 'queued' and info['queue_position'] == 1
+        done = await client.wait(info['id'], interval=0.05)
+        status, listing = await client.request('GET', '/jobs')
+        status_result, data = await client.request('GET', f"/jobs/{info['id']}/result")
+        status_missing, _ = await client.request('GET', f"/jobs/{info['id']}/result?part=9")
+        return done, listing, status_result, data, status_missing
+
+    done, listing, status_result, data, status_missing = run(scenario, tmp_path)
+    assert done['state'] == 'done' and done['error'] is None and done['parts']
+    assert [j['id'] for j in listing] == [done['id']]
+    assert status_result == 200
+    report = pd.read_excel(io.BytesIO(data))
+    assert 'NOMBRECLIENTE' in report.columns and len(report) > 0
+    assert status_missing == 404
+
+
+def test_uploaded_files_are_saved_and_processed(tmp_path, workbook):
+    with open(workbook(), 'rb') as f:
+        data = base64.b64encode(f.read()).decode('ascii')
+
+    async def scenario(client, server):
+        status, info = await client.request('POST', '/jobs', {
+            'mode': 'credito', 'files': [{'name': 'ene.xlsx', 'data': data}]})
+        assert status == 202
+        return await client.wait(info['id'], interval=0.05)
+
+    done = run(scenario, tmp_path)
+    assert done['state'] == 'done' and done['files'] == ['000_ene.xlsx']
+
+
+def test_failed_job_reports_error(tmp_path, workbook, monkeypatch):
+    def failing_report(*args, **kwargs):
+        raise RuntimeError('fallo de prueba')
+    monkeypatch.setattr(servidor, 'run_report', failing_report)
+    path = workbook()
+
+    async def scenario(client, server):
+        status, info = await client.submit('debito', [path])
+        done = await client.wait(info['id'], interval=0.05)
+        status_result, body = await client.request('GET', f"/jobs/{info['id']}/result")
+        return done, status_result, body
+
+    done, status_result, body = run(scenario, tmp_path)
+    assert done['state'] == 'error' and done['error'] == 'fallo de prueba'
+    assert status_result == 409 and 'error' in body
+
+
+def test_jobs_wait_for_memory_budget(tmp_path, workbook):
+    path = workbook()
+
+    async def scenario(client, server):
+        _, first = await client.submit('debito', [path])
+        _, second = await client.submit('debito', [path])
+        # el segundo no cabe junto al primero: espera en la cola
+        assert second['queue_position'] == 2
+        return await client.wait(first['id'], interval=0.05), await client.wait(second['id'], interval=0.05)
+
+    first, second = run(scenario, tmp_path, memory_budget=1)
+    assert first['state'] == second['state'] == 'done'
+    assert second['started'] >= first['finished']
+
+
+@pytest.mark.parametrize('body', [
+    b'[1, 2]', b'"debito"', b'null', b'{"mode": "debito", "paths": "a.xlsx"}',
+    b'{"mode": "debito", "files": ["x"]}',
+    b'{"mode": "debito", "files": [{"name": "a.xlsx"}]}',
+    b'{"mode": "debito", "files": [{"name": "a.xlsx", "data": "%%%"}]}',
+    b'{"mode": "otro", "paths": []}', b'{"mode": "debito"}',
+    b'{"mode": "debito", "paths": ["no_existe.xlsx"]}', b'{no es json',
+])
+def test_invalid_submissions_return_400(tmp_path, body):
+    async def scenario(client, server):
+        status, ctype, payload = await server.dispatch('POST', '/jobs', body)
+        return status, json.loads(payload), server.jobs
+
+    status, payload, jobs = run(scenario, tmp_path)
+    assert status == 400 and payload['error']
+    assert jobs == {}
+    work_dir = tmp_path / 'trabajos'
+    assert not work_dir.exists() or not any(work_dir.iterdir())
+
+
+def test_unknown_routes_and_jobs_return_404(tmp_path):
+    async def scenario(client, server):
+        return [(await client.request(method, target))[0] for method, target in
+                [('GET', '/jobs/nada'), ('GET', '/jobs/nada/result'), ('GET', '/otra'), ('DELETE', '/jobs')]]
+
+    assert run(scenario, tmp_path) == [404, 404, 404, 404]
+
+
+def test_handle_connection_answers_non_object_body(tmp_path):
+    async def scenario(client, server):
+        reader = asyncio.StreamReader()
+        body = b'[1]'
+        reader.feed_data(b'POST /jobs HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+        reader.feed_eof()
+        sent = []
+
+        class Writer:
+            def write(self, data):
+                sent.append(data)
+
+            async def drain(self):
+                pass
+
+            def close(self):
+                pass
+
+        await server.handle_connection(reader, Writer())
+        return b''.join(sent)
+
+    response = run(scenario, tmp_path)
+    assert response.startswith(b'HTTP/1.1 400 Bad Request')
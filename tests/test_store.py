@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import programGem as pg
+from conftest import sales_frame
+
+
+def test_float_ids_are_stored_as_integers(tmp_path):
+    df = sales_frame(n_rows=30, n_clients=3)
+    df['IDENTIFICACION'] = df['IDENTIFICACION'].astype(float)
+    df.loc[0, 'IDENTIFICACION'] = np.nan  # celda vacía: la columna queda float
+    result = pg.process_data(df, 'debito')
+    assert result['IDENTIFICACION'].dtype == float
+    path = str(tmp_path / 'reportes.sqlite')
+
+    run = pg.store_report(result, 'debito', ['ventas.xlsx'], path=path)
+
+    stored = pg.query_store(path=path)
+    assert set(stored['CORRIDA']) == {run}
+    assert not any(str(v).endswith('.0') for v in stored['IDENTIFICACION'].dropna())
+    for client in ('1001', 1001, 1001.0):
+        found = pg.query_store(client=client, path=path)
+        assert found['IDENTIFICACION'].tolist() == ['1001']
+    assert len(pg.query_store(client='CLIENTE', path=path)) == len(result)
+
+
+def test_query_filters_by_measure(tmp_path):
+    result = pg.process_data(sales_frame(), 'credito')
+    path = str(tmp_path / 'reportes.sqlite')
+    pg.store_report(result, 'credito', path=path)
+    pg.store_report(result, 'credito', path=path)
+    top = pg.query_store(mode='credito', measure='MontoBruto', top=2, path=path)
+    assert top['MontoBruto'].tolist() == sorted(result['MontoBruto'], reverse=True)[:2]
+    assert len(pg.query_store(run='todas', path=path)) == 2 * len(result)
+    assert len(pg.list_runs(path)) == 2
+
+
+def test_cache_clear_keeps_store_and_identities(tmp_path, workbook):
+    cache_dir = str(tmp_path / 'cache')
+    report = workbook('reporte.xlsx')
+    key = pg.cache_key([report], 'debito', False)
+    pg.cache_store(key, [report], {'mode': 'debito', 'subtract_discount': False, 'files': ['reporte.xlsx']},
+                   cache_dir=cache_dir)
+    kept = [os.path.join(cache_dir, name) for name in ('reportes.sqlite', 'identidades.csv')]
+    for p in kept:
+        open(p, 'w').close()
+    os.makedirs(os.path.join(cache_dir, 'puntos_control'))
+
+    assert pg.clear_cache(cache_dir) == 1
+    assert pg.cache_lookup(key, cache_dir) is None
+    assert sorted(os.listdir(cache_dir)) == ['identidades.csv', 'puntos_control', 'reportes.sqlite']
+
+
+def test_store_rejects_reports_not_keyed_by_client(tmp_path, monkeypatch):
+    for name in ('SPECS', 'FINAL_COLS', 'OUTPUT_NAMES'):
+        monkeypatch.setattr(pg, name, dict(getattr(pg, name)))
+    mode = pg.register_spec({'claves': ['PRIMER_APELLIDO'], 'sumas': {'MontoBruto': 'MontoBruto'}}, 'por_apellido')
+    result = pg.process_data(sales_frame(), mode)
+    path = str(tmp_path / 'reportes.sqlite')
+    with pytest.raises(ValueError, match='una fila por cliente'):
+        pg.store_report(result, mode, path=path)
+    assert not os.path.exists(path)
@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+
+from programGem import ReportView
+
+
+def test_sort_mixed_types_as_text():
+    df = pd.DataFrame({'IDENTIFICACION': pd.Series([20, '1003', np.nan, 100, 'A7'], dtype=object),
+                       'MontoBruto': [1.0, 2.0, 3.0, 4.0, 5.0]})
+    view = ReportView(df, page_size=10)
+    view.sort('IDENTIFICACION')
+    assert view.page(0)['IDENTIFICACION'].tolist()[:4] == [100, '1003', 20, 'A7']
+    assert pd.isna(view.page(0)['IDENTIFICACION'].iloc[-1])
+    view.sort('IDENTIFICACION', descending=True)
+    assert view.page(0)['IDENTIFICACION'].tolist()[:4] == ['A7', 20, '1003', 100]
+
+
+def test_sort_numeric_and_search_keep_order():
+    df = pd.DataFrame({'NOMBRECLIENTE': ['B', 'A', 'AB', 'C'], 'IDENTIFICACION': [3, 1, 2, 4],
+                       'MontoBruto': [5.0, np.nan, 1.0, 3.0]})
+    view = ReportView(df, page_size=2)
+    view.sort('MontoBruto', descending=True)
+    view.search('b')
+    assert view.page(0)['NOMBRECLIENTE'].tolist() == ['B', 'AB']
+    assert view.pages == 1